@@ -0,0 +1,112 @@
+import time
+import logging
+import threading
+from metrics import REGISTRY, BATCH_SIZE_BUCKETS
+
+# delete_message_batch accepts at most 10 entries per call
+MAX_BATCH_SIZE = 10
+
+ACK_BATCH_SIZE = REGISTRY.Histogram("consumer_ack_batch_size", "Receipt handles per delete_message_batch call", buckets=BATCH_SIZE_BUCKETS)
+
+class AckBuffer:
+    # collects receipt handles of processed messages and deletes them from SQS with delete_message_batch,
+    # flushing when a full batch is ready or when the oldest handle has waited longer than maxDelay
+    def __init__(self, sqsClient, queueURL, maxDelay=0.5, visibilityTimeout=30, maxAttempts=3):
+        self.sqsClient = sqsClient
+        self.queueURL = queueURL
+        self.maxDelay = maxDelay
+        self.visibilityTimeout = visibilityTimeout
+        self.maxAttempts = maxAttempts
+        self.pending = []  # [receiptHandle, receivedAt, attempts, addedAt]
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def Add(self, receiptHandle, receivedAt=None):
+        now = time.monotonic()
+        with self.lock:
+            self.pending.append([receiptHandle, receivedAt if receivedAt is not None else now, 0, now])
+            full = len(self.pending) >= MAX_BATCH_SIZE
+        if full:
+            self.Flush()
+
+    def Pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def Flush(self):
+        # only one flush runs at a time so a handle is never sent in two batches
+        with self.flushLock:
+            with self.lock:
+                entries, self.pending = self.pending, []
+            retry = []
+            for start in range(0, len(entries), MAX_BATCH_SIZE):
+                retry.extend(self._DeleteBatch(entries[start:start + MAX_BATCH_SIZE]))
+            if retry:
+                with self.lock:
+                    self.pending = retry + self.pending
+
+    def _DeleteBatch(self, entries):
+        now = time.monotonic()
+        live = []
+        for entry in entries:
+            # a handle older than the visibility timeout is no longer ours; the message may already belong to another consumer
+            if now - entry[1] >= self.visibilityTimeout:
+                logging.warning("Dropping receipt handle that outlived the visibility timeout")
+            else:
+                live.append(entry)
+        if not live:
+            return []
+
+        ACK_BATCH_SIZE.Observe(len(live))
+        try:
+            response = self.sqsClient.delete_message_batch(
+                QueueUrl=self.queueURL,
+                Entries=[{'Id': str(i), 'ReceiptHandle': entry[0]} for i, entry in enumerate(live)]
+            )
+        except Exception as e:
+            logging.error(f"Error deleting batch from SQS: {e}")
+            return self._Retry(live)
+
+        failed = []
+        for failure in response.get('Failed', []):
+            entry = live[int(failure['Id'])]
+            logging.warning(f"Failed to delete a response from SQS: {failure.get('Code')} {failure.get('Message', '')}")
+            # sender faults (e.g. an invalid receipt handle) will never succeed, so only retry the others
+            if not failure.get('SenderFault', False):
+                failed.append(entry)
+        logging.info(f"Deleted {len(response.get('Successful', []))} responses from SQS")
+        return self._Retry(failed)
+
+    def _Retry(self, entries):
+        retry = []
+        for entry in entries:
+            entry[2] += 1
+            if entry[2] < self.maxAttempts:
+                retry.append(entry)
+            else:
+                logging.error("Giving up on deleting a response from SQS")
+        return retry
+
+    def _DueForFlush(self):
+        with self.lock:
+            if not self.pending:
+                return False
+            return time.monotonic() - self.pending[0][3] >= self.maxDelay
+
+    def _Run(self):
+        while not self.stopped.wait(self.maxDelay / 2):
+            if self._DueForFlush():
+                self.Flush()
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="ack-flusher", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.Flush()
@@ -0,0 +1,77 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+from codec import ConfigureCodec, LoadRequest
+from consumer import FlattenOtherAttributes
+from storage import S3WidgetStore
+from synthetic import GenerateRequests
+
+# ---- ORIGINAL PATH (for comparison) ----
+def LegacyDecodeAndEncode(body):
+    # the s3 get_object body decoded to str, parsed, flattened and dumped again for put_object, which encodes a str body
+    # to bytes before sending it
+    return json.dumps(FlattenOtherAttributes(json.loads(body.decode('utf-8')))).encode('utf-8')
+
+def CodecDecodeAndEncode(body, store=S3WidgetStore(None, None)):
+    # parsed from the bytes as read, and only encoded again when flattening changed the request
+    return store.GetBody(FlattenOtherAttributes(LoadRequest(body)))
+
+def CpuPerRequest(function, bodies, repeat):
+    start = time.process_time_ns()
+    for _ in range(repeat):
+        for body in bodies:
+            function(body)
+    return (time.process_time_ns() - start) / (repeat * len(bodies))
+
+def PeakBytesPerRequest(function, bodies):
+    # the most memory held at once while handling one request (the body's copies and the decoded request), over the
+    # memory in use before it started
+    peaks = []
+    tracemalloc.start()
+    for body in bodies:
+        tracemalloc.reset_peak()
+        before = tracemalloc.get_traced_memory()[0]
+        function(body)
+        peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+    return sum(peaks) / len(peaks)
+
+def Bodies(requests, otherAttributes):
+    bodies = []
+    for request in requests:
+        if not otherAttributes:
+            request = {key: value for key, value in request.items() if key != "otherAttributes"}
+        bodies.append(json.dumps(request).encode("utf-8"))
+    return bodies
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='CPU and memory per request for decoding request bodies and encoding them for S3')
+    parser.add_argument('--requests', type=int, default=1000, help='Number of synthetic create/update requests per shape')
+    parser.add_argument('--repeat', type=int, default=10, help='Passes over the requests for the CPU timing')
+    args = parser.parse_args()
+
+    paths = [("original (decode + json.loads + json.dumps)", LegacyDecodeAndEncode, None), ("codec, json", CodecDecodeAndEncode, "json")]
+    if codec.orjson:
+        paths.append(("codec, orjson", CodecDecodeAndEncode, "orjson"))
+    else:
+        print("orjson is not installed; only the standard library codec is measured")
+    for attributes in [0, 10, 100]:
+        requests = GenerateRequests(args.requests, attributes=attributes, mix={"create": 0.5, "update": 0.5})
+        # with otherAttributes the widget is flattened and encoded again; without them the body is written as received
+        for otherAttributes in [True, False] if attributes else [False]:
+            bodies = Bodies(requests, otherAttributes)
+            shape = f"{attributes:>3} attributes, {'flattened' if otherAttributes else 'passthrough'}"
+            for name, function, codecName in paths:
+                if codecName:
+                    ConfigureCodec(codecName)
+                nsPerRequest = CpuPerRequest(function, bodies, args.repeat)
+                peak = PeakBytesPerRequest(function, bodies)
+                print(f"{shape:<28} {name:<44} {nsPerRequest:>9.0f} ns/request  {peak / 1024:>8.1f} KiB peak/request")
+    ConfigureCodec("auto")
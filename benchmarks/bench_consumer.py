@@ -0,0 +1,228 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import statistics
+import tracemalloc
+from contextlib import ExitStack
+from unittest.mock import patch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import codec
+import clients
+import storage
+import consumer
+from fakes import FakeS3, FakeSQS, FakeDynamoDB, Drained
+from synthetic import GenerateRequests, DEFAULT_MIX
+from digests import DigestCache
+
+# pipeline scenarios run consumer.main end to end against the fake clients
+SCENARIOS = [
+    {"name": "queue-memory", "storage": "memory"},
+    {"name": "queue-s3", "storage": "s3"},
+    {"name": "queue-s3-workers-batch-acks", "storage": "s3", "workers": 8, "batchAcks": True},
+    {"name": "queue-dynamodb", "storage": "dynamodb"},
+    {"name": "queue-dynamodb-workers-batch-writes", "storage": "dynamodb", "workers": 8, "batchAcks": True, "batchWrites": True},
+    {"name": "queue-s3-workers-coalesce", "storage": "s3", "workers": 8, "batchAcks": True, "coalesceWindow": 0.1},
+]
+
+def Percentile(sortedValues, percent):
+    if not sortedValues:
+        return 0.0
+    return sortedValues[min(len(sortedValues) - 1, int(round(percent / 100 * (len(sortedValues) - 1))))]
+
+# ---- MICROBENCHMARKS ----
+def TimePerCall(function, argsList, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for args in argsList:
+            function(*args)
+    return (time.perf_counter() - start) / (repeat * len(argsList)) * 1e9
+
+def RunMicrobenchmarks(requests, repeat):
+    writes = [request for request in requests if request["type"] != "delete"]
+    bodies = [json.dumps(request) for request in requests]
+    results = {
+        "IsValidWidgetId": TimePerCall(consumer.IsValidWidgetId, [(request["widgetId"],) for request in requests], repeat),
+        "ValidateRequest": TimePerCall(consumer.ValidateRequest, [(request, consumer.ROUTING_FIELDS) for request in requests], repeat),
+        "GetDynamoAttribute": TimePerCall(consumer.GetDynamoAttribute, [(request,) for request in writes], repeat),
+        "json.loads": TimePerCall(json.loads, [(body,) for body in bodies], repeat),
+        "json.dumps": TimePerCall(json.dumps, [(request,) for request in requests], repeat),
+        "WidgetDigest": TimePerCall(consumer.WidgetDigest, [(request,) for request in writes], repeat),
+    }
+    for storage, client, fake in [("s3", "S3_CLIENT", FakeS3()), ("dynamodb", "DYNAMODB_CLIENT", FakeDynamoDB())]:
+        with patch.object(consumer, client, fake), patch.object(consumer, "WIDGET_STORES", {}):
+            results[f"CreateOrUpdateWidget[{storage}]"] = TimePerCall(
+                lambda request: consumer.CreateOrUpdateWidget(dict(request), "destination", storage, operation="created"),
+                [(request,) for request in writes], repeat
+            )
+    # every write re-sends a state that is already stored, so each one is answered by the digest cache
+    with patch.object(consumer, "S3_CLIENT", FakeS3()), patch.object(consumer, "WIDGET_STORES", {}), patch.object(consumer, "DIGEST_CACHE", DigestCache()):
+        write = lambda request: consumer.CreateOrUpdateWidget(dict(request), "destination", "s3", operation="updated")
+        for request in writes:
+            write(request)
+        results["CreateOrUpdateWidget[s3, unchanged]"] = TimePerCall(write, [(request,) for request in writes], repeat)
+    return {name: {"nsPerCall": value} for name, value in results.items()}
+
+def MedianOfRuns(samples):
+    # metric -> median over the runs, for every metric each run reported
+    return {metric: statistics.median(sample[metric] for sample in samples) for metric in samples[0]}
+
+# ---- PIPELINE SCENARIOS ----
+# the module globals main assigns, directly or through its Configure* helpers; each run restores them, so no scenario
+# inherits another's writer, caches, limiters or retry queue
+MAIN_GLOBALS = [
+    (consumer, ["DYNAMODB_BATCH_WRITER", "DEDUP_CACHE", "VISIBILITY_HEARTBEAT", "SNAPSHOT_INTERVAL", "SNAPSHOT_COMPRESS", "DEAD_LETTER_SINK",
+                "RETRY_QUEUE", "DIGEST_CACHE", "CHECK_STORED_DIGESTS", "WRITE_LIMITER", "OWNER_WRITE_LIMITER"]),
+    (storage, ["DYNAMO_MARSHALLER"]),
+    (codec, ["CODEC"]),
+    (consumer.CLAIM_CHECK_FETCHER, ["bucket"]),
+]
+
+# the thread-owning objects main can start, and how each is stopped
+THREAD_OWNERS = {"KeyedWorkerPool": "Shutdown", "AckBuffer": "Stop", "VisibilityHeartbeat": "Stop", "DynamoBatchWriter": "Stop", "Coalescer": "Stop",
+                 "RetryQueue": "Stop", "ReceiverScaler": "Stop"}
+
+def RecordCreated(cls, created):
+    def Create(*args, **kwargs):
+        instance = cls(*args, **kwargs)
+        created.append(instance)
+        return instance
+    return Create
+
+def RunPipeline(scenario, bodies, latency):
+    # main never returns in queue mode; FakeSQS stops it with Drained once every message is acknowledged, and whatever
+    # main started is then stopped here, newest first, so no thread outlives its run
+    sqs, s3, dynamo = FakeSQS(bodies, latency), FakeS3(latency), FakeDynamoDB(latency)
+    created = []
+    with ExitStack() as stack:
+        for owner, names in MAIN_GLOBALS:
+            for name in names:
+                stack.enter_context(patch.object(owner, name, getattr(owner, name)))
+        for name in THREAD_OWNERS:
+            stack.enter_context(patch.object(consumer, name, RecordCreated(getattr(consumer, name), created)))
+        stack.enter_context(patch.dict(clients.CLIENT_SETTINGS))
+        stack.enter_context(patch.dict(clients.CLIENTS))
+        for name, client in [("SQS_CLIENT", sqs), ("S3_CLIENT", s3), ("DYNAMODB_CLIENT", dynamo)]:
+            stack.enter_context(patch.object(consumer, name, client))
+        stack.enter_context(patch.object(consumer, "WIDGET_STORES", {}))
+        start = time.perf_counter()
+        try:
+            consumer.main(None, "destination", scenario["storage"], "queue", workers=scenario.get("workers", 1),
+                          batchAcks=scenario.get("batchAcks", False), batchWrites=scenario.get("batchWrites", False),
+                          coalesceWindow=scenario.get("coalesceWindow", 0))
+        except Drained:
+            pass
+        elapsed = time.perf_counter() - start
+        for instance in reversed(created):
+            getattr(instance, THREAD_OWNERS[type(instance).__name__])()
+        consumer.CloseWidgetStores()
+    return sqs, s3.calls + dynamo.calls, elapsed
+
+def RunScenario(scenario, bodies, latency, measureAllocations, runs=3):
+    # one untimed warm-up run, then the median of `runs` timed runs, so a single noisy run cannot fail the baseline check
+    RunPipeline(scenario, bodies, latency)
+    samples = []
+    for _ in range(runs):
+        sqs, writeCalls, elapsed = RunPipeline(scenario, bodies, latency)
+        latencies = sorted(sqs.latencies)
+        samples.append({
+            "requests": len(latencies),
+            "requestsPerSecond": len(latencies) / elapsed,
+            "p50LatencyMs": Percentile(latencies, 50) * 1000,
+            "p95LatencyMs": Percentile(latencies, 95) * 1000,
+            "p99LatencyMs": Percentile(latencies, 99) * 1000,
+            "sqsCalls": sqs.calls,
+            "storageCalls": writeCalls,
+        })
+    result = MedianOfRuns(samples)
+    if measureAllocations:
+        # a second run under tracemalloc, since tracing skews the timings above
+        tracemalloc.start()
+        RunPipeline(scenario, bodies, 0.0)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result["peakAllocatedKB"] = peak / 1024
+    return result
+
+# ---- BASELINE COMPARISON ----
+# metric name -> True when higher is better
+COMPARED_METRICS = {"nsPerCall": False, "requestsPerSecond": True, "p99LatencyMs": False, "peakAllocatedKB": False}
+
+def FindRegressions(results, baseline, threshold):
+    regressions = []
+    for section in ["micro", "pipeline"]:
+        for name, metrics in results.get(section, {}).items():
+            baselineMetrics = baseline.get(section, {}).get(name, {})
+            for metric, higherIsBetter in COMPARED_METRICS.items():
+                if metric not in metrics or not baselineMetrics.get(metric):
+                    continue
+                change = (metrics[metric] - baselineMetrics[metric]) / baselineMetrics[metric]
+                if (higherIsBetter and change < -threshold) or (not higherIsBetter and change > threshold):
+                    regressions.append(f"{section}/{name} {metric}: {baselineMetrics[metric]:.2f} -> {metrics[metric]:.2f} ({change:+.0%})")
+    return regressions
+
+def ParseMix(text):
+    mix = {}
+    for part in text.split(","):
+        name, weight = part.split("=")
+        mix[name.strip()] = float(weight)
+    return mix
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Throughput/latency benchmarks for the consumer pipeline against in-memory AWS stand-ins')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of synthetic requests per scenario')
+    parser.add_argument('--widgets', type=int, default=200, help='Number of distinct widgets the requests touch')
+    parser.add_argument('--attributes', type=int, default=5, help='Number of otherAttributes per create/update request')
+    parser.add_argument('--mix', type=ParseMix, default=DEFAULT_MIX, help='Request type weights, e.g. create=0.4,update=0.45,delete=0.15')
+    parser.add_argument('--latency', type=float, default=0.001, help='Simulated round-trip latency per AWS call in seconds')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the synthetic request stream')
+    parser.add_argument('--repeat', type=int, default=20, help='Passes over the requests for each microbenchmark')
+    parser.add_argument('--runs', type=int, default=3, help='Timed runs per microbenchmark and scenario, after a warm-up; the median is reported')
+    parser.add_argument('--scenario', action='append', help='Only run the named pipeline scenario (repeatable)')
+    parser.add_argument('--skip-allocations', action='store_true', help='Do not measure peak allocations with tracemalloc')
+    parser.add_argument('--output', default='bench_results.json', help='Where to write the JSON results')
+    parser.add_argument('--baseline', help='JSON results from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='Relative change that counts as a regression')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    requests = GenerateRequests(args.requests, args.widgets, args.mix, args.attributes, args.seed)
+    bodies = [json.dumps(request) for request in requests]
+
+    results = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+        "micro": {},
+        "pipeline": {},
+    }
+    # a warm-up pass, then the median of the timed ones
+    RunMicrobenchmarks(requests, args.repeat)
+    microRuns = [RunMicrobenchmarks(requests, args.repeat) for _ in range(args.runs)]
+    for name in microRuns[0]:
+        results["micro"][name] = MedianOfRuns([run[name] for run in microRuns])
+    for name, metrics in results["micro"].items():
+        print(f"{name:<40} {metrics['nsPerCall']:>12.0f} ns/call")
+
+    for scenario in SCENARIOS:
+        if args.scenario and scenario["name"] not in args.scenario:
+            continue
+        result = RunScenario(scenario, bodies, args.latency, not args.skip_allocations, args.runs)
+        results["pipeline"][scenario["name"]] = result
+        print(f"{scenario['name']:<40} {result['requestsPerSecond']:>10.1f} req/s  p50 {result['p50LatencyMs']:.2f} ms  "
+              f"p99 {result['p99LatencyMs']:.2f} ms  {result['sqsCalls']} sqs / {result['storageCalls']} storage calls")
+
+    with open(args.output, 'w') as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = FindRegressions(results, json.load(file), args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.baseline}")
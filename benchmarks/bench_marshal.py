@@ -0,0 +1,55 @@
+import os
+import sys
+import copy
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from consumer import FlattenOtherAttributes
+from storage import DynamoMarshaller
+from bench_consumer import TimePerCall
+from synthetic import GenerateRequests
+
+NUMERIC_ATTRIBUTES = ["width", "length", "price", "quantity", "rating", "width-*", "length-*", "price-*", "quantity-*", "rating-*"]
+
+# ---- ORIGINAL MARSHALLING (for comparison) ----
+def LegacyGetDynamoAttribute(value):
+    # the original recursive isinstance chain; bools became N and None was dropped
+    if isinstance(value, str):
+        return {"S": value}
+    elif isinstance(value, int) or isinstance(value, float):
+        return {"N": str(value)}
+    elif isinstance(value, list):
+        return {"L": [LegacyGetDynamoAttribute(item) for item in value]}
+    elif isinstance(value, dict):
+        return {"M": {key: LegacyGetDynamoAttribute(val) for key, val in value.items()}}
+
+def LegacyGetDynamoItem(request):
+    # otherAttributes stayed a nested L of M values
+    dynamoDict = {"id": {"S": request["widgetId"]}}
+    for key, value in request.items():
+        dynamoDict[key] = LegacyGetDynamoAttribute(value)
+    return dynamoDict
+
+def Flattened(requests):
+    return [FlattenOtherAttributes(copy.deepcopy(request)) for request in requests]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-request cost of building DynamoDB items with the original and cached marshallers')
+    parser.add_argument('--requests', type=int, default=1000, help='Number of synthetic create/update requests per attribute count')
+    parser.add_argument('--repeat', type=int, default=10, help='Passes over the requests')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    for attributes in [0, 10, 100]:
+        requests = [request for request in GenerateRequests(args.requests, attributes=attributes, mix={"create": 0.5, "update": 0.5})]
+        widgets = Flattened(requests)
+        plain, hinted = DynamoMarshaller(), DynamoMarshaller(NUMERIC_ATTRIBUTES)
+        results = [
+            ("original (nested otherAttributes)", TimePerCall(LegacyGetDynamoItem, [(request,) for request in requests], args.repeat)),
+            ("DynamoMarshaller (flattened)", TimePerCall(plain.MarshalItem, [(widget,) for widget in widgets], args.repeat)),
+            ("DynamoMarshaller + numeric hints", TimePerCall(hinted.MarshalItem, [(widget,) for widget in widgets], args.repeat)),
+        ]
+        for name, nsPerCall in results:
+            print(f"{attributes:>3} attributes  {name:<36} {nsPerCall:>10.0f} ns/request")
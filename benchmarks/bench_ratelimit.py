@@ -0,0 +1,82 @@
+import os
+import sys
+import argparse
+from statistics import mean, pstdev
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import TokenBucket
+
+class SimulatedClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class SimulatedDestination:
+    # accepts `capacity` writes per second (with a small burst allowance, like dynamodb's burst capacity) and
+    # throttles the rest
+    def __init__(self, capacity, clock, burstSeconds=0.2):
+        self.capacity = capacity
+        self.clock = clock
+        self.burst = capacity * burstSeconds
+        self.tokens = self.burst
+        self.updatedAt = clock()
+
+    def Write(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updatedAt) * self.capacity)
+        self.updatedAt = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+def Simulate(capacity, seconds, initialRate, decrease, stepCapacity=None):
+    # a saturated writer (it always has more work than the destination can take) behind the limiter; the destination's
+    # capacity can change half way through to show how the rate follows it
+    clock = SimulatedClock()
+    destination = SimulatedDestination(capacity, clock)
+    bucket = TokenBucket(initialRate, decrease=decrease, clock=clock)
+    written, throttled, rates = [0] * seconds, [0] * seconds, []
+    while clock.now < seconds:
+        second = int(clock.now)
+        if stepCapacity and second >= seconds // 2:
+            destination.capacity = stepCapacity
+        delay = bucket.Reserve()
+        # with no limit yet, writes are as fast as a fleet of workers can send them
+        clock.now += delay if delay > 0 else (1.0 / (capacity * 4) if bucket.rate is None else 0.0)
+        if int(clock.now) >= seconds:
+            break
+        if destination.Write():
+            written[int(clock.now)] += 1
+        else:
+            throttled[int(clock.now)] += 1
+            bucket.Throttled()
+        if int(clock.now) != second:
+            rates.append(bucket.rate or 0.0)
+    return written, throttled, rates
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Simulate the adaptive write limiter against a destination with fixed capacity')
+    parser.add_argument('--capacity', type=float, default=500, help='Writes per second the destination accepts')
+    parser.add_argument('--step-capacity', type=float, help='Capacity for the second half of the run (e.g. after a scale-down)')
+    parser.add_argument('--seconds', type=int, default=120, help='Simulated seconds')
+    parser.add_argument('--initial-rate', type=float, help='Starting rate; unlimited until the first throttle when omitted')
+    parser.add_argument('--decrease', type=float, default=0.7, help='Multiplicative decrease on a throttle')
+    args = parser.parse_args()
+
+    written, throttled, rates = Simulate(args.capacity, args.seconds, args.initial_rate, args.decrease, args.step_capacity)
+    # skip the first quarter of each half, where the rate is still converging
+    settled = [second for second in range(args.seconds) if second % (args.seconds // 2) >= args.seconds // 8] if args.step_capacity else list(range(args.seconds // 4, args.seconds))
+    halves = [("run", settled)] if not args.step_capacity else [
+        (f"capacity {args.capacity:g}", [second for second in settled if second < args.seconds // 2]),
+        (f"capacity {args.step_capacity:g}", [second for second in settled if second >= args.seconds // 2]),
+    ]
+    for name, seconds in halves:
+        capacity = args.capacity if name in ("run", f"capacity {args.capacity:g}") else args.step_capacity
+        perSecond = [written[second] for second in seconds]
+        throttles = sum(throttled[second] for second in seconds)
+        print(f"{name:<18} throughput {mean(perSecond):8.1f}/s ({mean(perSecond) / capacity:6.1%} of capacity)  "
+              f"stdev {pstdev(perSecond):6.1f}/s  throttled {throttles / max(1, sum(perSecond) + throttles):6.2%} of writes")
@@ -0,0 +1,60 @@
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import consumer
+from s3source import S3RequestSource
+from fakes import FakeS3
+
+BUCKET = 'requests'
+
+def FillBucket(s3, count):
+    with open(os.path.join('sample-requests', '1612306368338')) as file:
+        template = json.load(file)
+    for i in range(count):
+        s3.objects[(BUCKET, str(1612306368338 + i))] = json.dumps(template).encode('utf-8')
+
+def DrainOneAtATime(s3):
+    # the original loop: list one key, get it, delete it
+    consumer.S3_CLIENT = s3
+    drained = 0
+    while True:
+        request, key = consumer.RetrieveRequestFromS3(BUCKET)
+        if not request:
+            return drained
+        consumer.DeleteFromStorage(key, BUCKET)
+        drained += 1
+
+def DrainStreaming(s3, readAhead):
+    source = S3RequestSource(s3, BUCKET, readAhead=readAhead, fetchWorkers=readAhead)
+    drained = 0
+    for request, key in source.Requests():
+        source.MarkDone(key)
+        drained += 1
+    source.Close()
+    return drained
+
+def Run(name, drain, count, latency):
+    s3 = FakeS3(latency)
+    FillBucket(s3, count)
+    start = time.perf_counter()
+    drained = drain(s3)
+    elapsed = time.perf_counter() - start
+    assert drained == count and not s3.objects, f"{name} left objects behind"
+    print(f"{name:<28} {drained / elapsed:>10.1f} objects/sec  {s3.calls:>6} S3 calls")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark draining a request bucket against an in-memory S3 stand-in')
+    parser.add_argument('--objects', type=int, default=500, help='Number of request objects in the bucket')
+    parser.add_argument('--latency', type=float, default=0.005, help='Simulated round-trip latency per S3 call in seconds')
+    parser.add_argument('--read-ahead', type=int, default=32, help='Read-ahead depth for the streaming reader')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    Run("one object at a time", DrainOneAtATime, args.objects, args.latency)
+    Run(f"streaming (read-ahead {args.read_ahead})", lambda s3: DrainStreaming(s3, args.read_ahead), args.objects, args.latency)
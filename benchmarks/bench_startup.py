@@ -0,0 +1,70 @@
+import os
+import sys
+import time
+import json
+import argparse
+import subprocess
+from statistics import median
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# each probe runs in a fresh interpreter so nothing is cached between runs; it prints its timings in ms as json
+PROBES = {
+    "import consumer": """
+start = time.perf_counter()
+import consumer
+result = {"import": (time.perf_counter() - start) * 1000}
+start = time.perf_counter()
+consumer.SQS_CLIENT.meta
+result["first sqs client"] = (time.perf_counter() - start) * 1000
+""",
+    "eager clients (original)": """
+start = time.perf_counter()
+import boto3
+boto3.client('s3')
+boto3.client('dynamodb', "us-east-1")
+boto3.client('sqs', "us-east-1")
+result = {"import": (time.perf_counter() - start) * 1000}
+""",
+    "import lambda_function": """
+start = time.perf_counter()
+import lambda_function
+result = {"import": (time.perf_counter() - start) * 1000}
+""",
+}
+
+def RunProbe(code):
+    script = f"import time, json, logging\nlogging.disable(logging.CRITICAL)\n{code}\nprint(json.dumps(result))"
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True,
+                            env=dict(os.environ, AWS_DEFAULT_REGION=os.environ.get("AWS_DEFAULT_REGION", "us-east-1")))
+    return json.loads(output.stdout.strip().splitlines()[-1])
+
+def TimeWarmInvocations(invocations):
+    # per-invocation cost of getting an sqs client in a warm lambda: a new client every time versus the shared one
+    import boto3
+    from clients import GetClient
+    start = time.perf_counter()
+    for _ in range(invocations):
+        boto3.client('sqs', "us-east-1")
+    fresh = (time.perf_counter() - start) / invocations * 1000
+    GetClient('sqs', "us-east-1")
+    start = time.perf_counter()
+    for _ in range(invocations):
+        GetClient('sqs', "us-east-1")
+    shared = (time.perf_counter() - start) / invocations * 1000
+    return fresh, shared
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Cold-start cost of importing the consumer and lambda, and warm-invocation client cost')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh interpreters per probe; the median is reported')
+    parser.add_argument('--invocations', type=int, default=50, help='Simulated warm lambda invocations')
+    args = parser.parse_args()
+
+    for name, code in PROBES.items():
+        runs = [RunProbe(code) for _ in range(args.runs)]
+        timings = "  ".join(f"{metric} {median(run[metric] for run in runs):.1f} ms" for metric in runs[0])
+        print(f"{name:<28} {timings}")
+
+    fresh, shared = TimeWarmInvocations(args.invocations)
+    print(f"{'warm lambda sqs client':<28} new client per call {fresh:.2f} ms  shared client {shared:.4f} ms")
@@ -0,0 +1,72 @@
+import os
+import re
+import sys
+import logging
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from validation import ValidateRequest, ValidateRequests, IsValidId, ROUTING_FIELDS
+from bench_consumer import TimePerCall
+from synthetic import GenerateRequests
+
+# ---- ORIGINAL CHECKS (for comparison) ----
+def LegacyValidateRequest(data):
+    # the lambda's original validate_request: compiles its regex on every call and walks the fields several times
+    for field in ['type', 'requestId', 'widgetId', 'owner', 'label', 'description', 'otherAttributes']:
+        if field not in data:
+            return False
+    for field in ['type', 'requestId', 'widgetId', 'owner', 'label', 'description']:
+        if not isinstance(data[field], str) or not data[field].strip():
+            return False
+    if data['type'].lower() not in ['create', 'update', 'delete']:
+        return False
+    uuid_regex = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\Z', re.I)
+    if not re.match(uuid_regex, data['requestId']) or not re.match(uuid_regex, data['widgetId']):
+        return False
+    if not isinstance(data['otherAttributes'], list):
+        return False
+    for attr in data['otherAttributes']:
+        if not (isinstance(attr, dict) and 'name' in attr and 'value' in attr):
+            return False
+        if not (isinstance(attr['name'], str) and attr['name'].strip() and
+                isinstance(attr['value'], str) and attr['value'].strip()):
+            return False
+    return True
+
+def LegacyIsValidWidgetId(widgetId):
+    # the consumer's original character-by-character check
+    if len(widgetId) != 36:
+        return False
+    if widgetId[8] != "-" or widgetId[13] != "-" or widgetId[18] != "-" or widgetId[23] != "-":
+        return False
+    hexCharacters = set("0123456789abcdefABCDEF")
+    for i, char in enumerate(widgetId):
+        if i in [8, 13, 18, 23]:
+            continue
+        if char not in hexCharacters:
+            return False
+    return True
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Per-request cost of the original and shared request validators')
+    parser.add_argument('--requests', type=int, default=2000, help='Number of synthetic requests')
+    parser.add_argument('--attributes', type=int, default=5, help='Number of otherAttributes per create/update request')
+    parser.add_argument('--repeat', type=int, default=20, help='Passes over the requests')
+    args = parser.parse_args()
+
+    logging.disable(logging.CRITICAL)
+    requests = GenerateRequests(args.requests, attributes=args.attributes)
+    # the lambda checks the full schema, which only creates and updates carry
+    fullRequests = [request for request in requests if request["type"] != "delete"]
+    results = [
+        ("lambda: original validate_request", TimePerCall(LegacyValidateRequest, [(request,) for request in fullRequests], args.repeat)),
+        ("lambda: ValidateRequest", TimePerCall(ValidateRequest, [(request,) for request in fullRequests], args.repeat)),
+        ("lambda: ValidateRequests (per request)", TimePerCall(ValidateRequests, [(fullRequests,)], args.repeat) / len(fullRequests)),
+        ("consumer: original IsValidWidgetId", TimePerCall(LegacyIsValidWidgetId, [(request["widgetId"],) for request in requests], args.repeat)),
+        ("consumer: IsValidId", TimePerCall(IsValidId, [(request["widgetId"],) for request in requests], args.repeat)),
+        ("consumer: ValidateRequest (routing)", TimePerCall(ValidateRequest, [(request, ROUTING_FIELDS) for request in requests], args.repeat)),
+        ("consumer: ValidateRequests (per request)", TimePerCall(ValidateRequests, [(requests, ROUTING_FIELDS)], args.repeat) / len(requests)),
+    ]
+    for name, nsPerCall in results:
+        print(f"{name:<44} {nsPerCall:>10.0f} ns/request")
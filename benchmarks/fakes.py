@@ -0,0 +1,154 @@
+import io
+import time
+import threading
+from botocore.response import StreamingBody
+
+# in-memory stand-ins for the boto3 clients used by the consumer; every call sleeps for `latency` seconds to
+# simulate a network round trip, so benchmarks measure how many round trips a code path makes
+
+class FakeS3:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.objects = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _RoundTrip(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self._RoundTrip()
+        with self.lock:
+            self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        self._RoundTrip()
+        with self.lock:
+            body = self.objects[(Bucket, Key)]
+        return {'Body': StreamingBody(io.BytesIO(body), len(body)), 'ContentLength': len(body)}
+
+    def delete_object(self, Bucket, Key):
+        self._RoundTrip()
+        with self.lock:
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def delete_objects(self, Bucket, Delete):
+        self._RoundTrip()
+        with self.lock:
+            for item in Delete['Objects']:
+                self.objects.pop((Bucket, item['Key']), None)
+        return {'Errors': []}
+
+    def list_objects_v2(self, Bucket, MaxKeys=1000, StartAfter=None, ContinuationToken=None, Prefix=''):
+        self._RoundTrip()
+        with self.lock:
+            keys = sorted(key for bucket, key in self.objects if bucket == Bucket and key.startswith(Prefix))
+        after = ContinuationToken or StartAfter
+        if after:
+            keys = [key for key in keys if key > after]
+        page = keys[:MaxKeys]
+        response = {'KeyCount': len(page), 'IsTruncated': len(keys) > MaxKeys}
+        if page:
+            response['Contents'] = [{'Key': key} for key in page]
+        if response['IsTruncated']:
+            response['NextContinuationToken'] = page[-1]
+        return response
+
+class Drained(Exception):
+    # raised by FakeSQS.receive_message once every message has been received and acknowledged, to stop consumer.main
+    pass
+
+class FakeSQS:
+    def __init__(self, bodies, latency=0.0, timeout=60):
+        self.latency = latency
+        self.timeout = timeout
+        self.messages = [{'Body': body, 'ReceiptHandle': f"handle-{i}"} for i, body in enumerate(bodies)]
+        self.position = 0
+        self.receivedAt = {}
+        self.latencies = []
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _RoundTrip(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def receive_message(self, QueueUrl, MaxNumberOfMessages=1, WaitTimeSeconds=0, **kwargs):
+        with self.lock:
+            batch = self.messages[self.position:self.position + MaxNumberOfMessages]
+            self.position += len(batch)
+            now = time.perf_counter()
+            for message in batch:
+                self.receivedAt[message['ReceiptHandle']] = now
+        if batch:
+            self._RoundTrip()
+            return {'Messages': batch}
+        # nothing left to hand out: wait for in-flight messages to be acknowledged, then stop the consumer
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline:
+            with self.lock:
+                if not self.receivedAt:
+                    raise Drained()
+            time.sleep(0.001)
+        raise Drained()
+
+    def _Ack(self, receiptHandle):
+        with self.lock:
+            receivedAt = self.receivedAt.pop(receiptHandle, None)
+            if receivedAt is not None:
+                self.latencies.append(time.perf_counter() - receivedAt)
+
+    def delete_message(self, QueueUrl, ReceiptHandle):
+        self._RoundTrip()
+        self._Ack(ReceiptHandle)
+        return {}
+
+    def delete_message_batch(self, QueueUrl, Entries):
+        self._RoundTrip()
+        for entry in Entries:
+            self._Ack(entry['ReceiptHandle'])
+        return {'Successful': [{'Id': entry['Id']} for entry in Entries], 'Failed': []}
+
+class FakeDynamoDB:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.items = {}
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _RoundTrip(self):
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def put_item(self, TableName, Item, **kwargs):
+        self._RoundTrip()
+        with self.lock:
+            self.items[(TableName, Item['id']['S'])] = Item
+        return {}
+
+    def delete_item(self, TableName, Key, **kwargs):
+        self._RoundTrip()
+        with self.lock:
+            self.items.pop((TableName, Key['id']['S']), None)
+        return {}
+
+    def batch_write_item(self, RequestItems):
+        self._RoundTrip()
+        with self.lock:
+            for tableName, writeRequests in RequestItems.items():
+                for writeRequest in writeRequests:
+                    if 'PutRequest' in writeRequest:
+                        item = writeRequest['PutRequest']['Item']
+                        self.items[(tableName, item['id']['S'])] = item
+                    else:
+                        self.items.pop((tableName, writeRequest['DeleteRequest']['Key']['id']['S']), None)
+        return {'UnprocessedItems': {}}
@@ -0,0 +1,65 @@
+import uuid
+import random
+import string
+
+# synthetic request streams shaped like the files in sample-requests/
+OWNERS = ["Mary Matthews", "John Jones", "Sue Smith", "Henry Hops"]
+ATTRIBUTES = [
+    ("width-unit", lambda rng: rng.choice(["cm", "in"])),
+    ("length-unit", lambda rng: rng.choice(["cm", "in"])),
+    ("width", lambda rng: str(rng.randint(1, 500))),
+    ("length", lambda rng: str(rng.randint(1, 500))),
+    ("price", lambda rng: f"{rng.uniform(1, 1000):.2f}"),
+    ("quantity", lambda rng: str(rng.randint(0, 1000))),
+    ("rating", lambda rng: f"{rng.uniform(0, 5):.6f}"),
+    ("color", lambda rng: rng.choice(["red", "green", "blue", "yellow"])),
+    ("vendor", lambda rng: rng.choice(["Acme", "Globex", "Initech"])),
+]
+DEFAULT_MIX = {"create": 0.4, "update": 0.45, "delete": 0.15}
+
+def RandomText(rng, length):
+    return "".join(rng.choice(string.ascii_uppercase) for _ in range(length))
+
+def RandomUUID(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+def GenerateRequests(count, widgets=100, mix=None, attributes=5, seed=0):
+    # creates come first for a widget, updates and deletes only target widgets that exist, and a deleted widget can be
+    # created again later; the same seed always produces the same stream
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    types, weights = list(mix), list(mix.values())
+    widgetIds = [RandomUUID(rng) for _ in range(widgets)]
+    owners = {widgetId: rng.choice(OWNERS) for widgetId in widgetIds}
+    live = set()
+    requests = []
+    for _ in range(count):
+        requestType = rng.choices(types, weights)[0]
+        if requestType == "create" or not live:
+            candidates = [widgetId for widgetId in widgetIds if widgetId not in live] or widgetIds
+            widgetId = rng.choice(candidates)
+            requestType = "create" if widgetId not in live else "update"
+        else:
+            widgetId = rng.choice(sorted(live))
+
+        request = {
+            "type": requestType,
+            "requestId": RandomUUID(rng),
+            "widgetId": widgetId,
+            "owner": owners[widgetId],
+        }
+        if requestType == "delete":
+            live.discard(widgetId)
+        else:
+            live.add(widgetId)
+            request["label"] = RandomText(rng, 5)
+            request["description"] = RandomText(rng, rng.randint(20, 120))
+            request["otherAttributes"] = []
+            for i in range(attributes):
+                name, value = ATTRIBUTES[i % len(ATTRIBUTES)]
+                # past the first round of attribute names, suffix them so every name stays unique
+                if i >= len(ATTRIBUTES):
+                    name = f"{name}-{i // len(ATTRIBUTES)}"
+                request["otherAttributes"].append({"name": name, "value": value(rng)})
+        requests.append(request)
+    return requests
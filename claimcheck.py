@@ -0,0 +1,72 @@
+import uuid
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from codec import DumpsText, LoadRequest
+
+# a pointer message carries this key (with the bucket, key and size of the stored body) plus the request's routing
+# fields, so consumers can route and deduplicate it before the body is fetched
+POINTER_KEY = "claimCheck"
+ROUTING_FIELDS = ("type", "requestId", "widgetId", "owner")
+KEY_PREFIX = "claim-checks/"
+CHUNK_SIZE = 64 * 1024
+
+def IsPointer(message):
+    return isinstance(message, dict) and isinstance(message.get(POINTER_KEY), dict)
+
+def MakePointer(request, bucket, key, size):
+    pointer = {field: request[field] for field in ROUTING_FIELDS if field in request}
+    pointer[POINTER_KEY] = {"bucket": bucket, "key": key, "size": size}
+    return pointer
+
+def Offload(s3Client, bucket, request, body, prefix=KEY_PREFIX):
+    # writes the full body to s3 and returns the pointer message to send in its place. the objects are never deleted
+    # by the consumer (a redelivered pointer must still resolve), so expire the prefix with a lifecycle rule
+    data = body.encode('utf-8') if isinstance(body, str) else body
+    key = f"{prefix}{uuid.uuid4().hex}.json"
+    s3Client.put_object(Bucket=bucket, Key=key, Body=data, ContentType='application/json')
+    return DumpsText(MakePointer(request, bucket, key, len(data)))
+
+class ClaimCheckFetcher:
+    # resolves pointer messages back into requests. fetches run concurrently on a small thread pool, and each body is
+    # streamed in chunks into a single buffer sized from ContentLength that is parsed directly, instead of read()
+    # building the body up and .decode() copying it again before parsing. the request keeps the buffer as its body.
+    # producers can write any message to the queue, so only pointers into the claim-check bucket and prefix are
+    # followed; without a bucket no pointer is
+    def __init__(self, s3Client, fetchWorkers=8, bucket=None, prefix=KEY_PREFIX):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.prefix = prefix
+        self.executor = ThreadPoolExecutor(max_workers=fetchWorkers, thread_name_prefix="claim-check")
+
+    def Submit(self, pointer):
+        return self.executor.submit(self.Fetch, pointer)
+
+    def Fetch(self, pointer):
+        location = pointer[POINTER_KEY]
+        if self.bucket is None or location.get("bucket") != self.bucket or not isinstance(location.get("key"), str) or not location["key"].startswith(self.prefix):
+            raise ValueError(f"Claim check {location.get('bucket')}/{location.get('key')} is not under {self.bucket}/{self.prefix}")
+        response = self.s3Client.get_object(Bucket=location["bucket"], Key=location["key"])
+        body = response["Body"]
+        try:
+            buffer = bytearray(response.get("ContentLength") or location.get("size") or 0)
+            view, offset = memoryview(buffer), 0
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                end = offset + len(chunk)
+                if end > len(buffer):
+                    # the object is larger than advertised; grow the buffer instead of failing
+                    view.release()
+                    buffer.extend(bytes(end - len(buffer)))
+                    view = memoryview(buffer)
+                view[offset:end] = chunk
+                offset = end
+            view.release()
+            del buffer[offset:]
+        finally:
+            body.close()
+        request = LoadRequest(buffer)
+        if not isinstance(request, dict):
+            raise ValueError(f"Claim check {location['key']} does not hold a request")
+        return request
+
+    def Close(self):
+        self.executor.shutdown(wait=True)
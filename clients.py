@@ -0,0 +1,71 @@
+import time
+import logging
+import threading
+
+# settings used for every client; ConfigureClients changes them, and clients made with the old settings are replaced
+CLIENT_SETTINGS = {
+    "maxPoolConnections": 10,
+    "tcpKeepalive": True,
+    "retryMode": "standard",
+    "maxAttempts": 3,
+    "connectTimeout": 5,
+    "readTimeout": 60,
+}
+
+CLIENTS = {}  # (service, region) -> client
+CLIENTS_LOCK = threading.Lock()
+SESSION = None
+
+def ConfigureClients(**settings):
+    unknown = set(settings) - set(CLIENT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown client settings: {', '.join(sorted(unknown))}")
+    with CLIENTS_LOCK:
+        CLIENT_SETTINGS.update({name: value for name, value in settings.items() if value is not None})
+        CLIENTS.clear()
+
+def GetClientConfig():
+    from botocore.config import Config
+    return Config(
+        max_pool_connections=CLIENT_SETTINGS["maxPoolConnections"],
+        tcp_keepalive=CLIENT_SETTINGS["tcpKeepalive"],
+        retries={"mode": CLIENT_SETTINGS["retryMode"], "max_attempts": CLIENT_SETTINGS["maxAttempts"]},
+        connect_timeout=CLIENT_SETTINGS["connectTimeout"],
+        read_timeout=CLIENT_SETTINGS["readTimeout"],
+    )
+
+def GetClient(service, region=None):
+    # clients are thread safe once built, but building them (and the shared session) is not, so that happens under
+    # the lock. the common path is a single dict lookup
+    global SESSION
+    key = (service, region)
+    client = CLIENTS.get(key)
+    if client is not None:
+        return client
+    with CLIENTS_LOCK:
+        client = CLIENTS.get(key)
+        if client is None:
+            start = time.perf_counter()
+            # boto3 is imported here rather than at the top so importing this module stays cheap
+            import boto3
+            if SESSION is None:
+                SESSION = boto3.session.Session()
+            client = SESSION.client(service, region_name=region, config=GetClientConfig())
+            CLIENTS[key] = client
+            logging.info(f"Created {service} client in {(time.perf_counter() - start) * 1000:.1f} ms")
+    return client
+
+class LazyClient:
+    # stands in for a boto3 client and forwards every attribute to the shared client for its service and region,
+    # creating it on first use. attributes set on the proxy itself (e.g. by unittest.mock.patch) take precedence
+    def __init__(self, service, region=None):
+        self.service = service
+        self.region = region
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("service", "region"):
+            raise AttributeError(name)
+        return getattr(GetClient(self.service, self.region), name)
+
+    def __repr__(self):
+        return f"LazyClient({self.service!r}, {self.region!r})"
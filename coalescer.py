@@ -0,0 +1,94 @@
+import time
+import logging
+import threading
+from collections import OrderedDict, deque
+from metrics import ShouldLogRequest
+
+class Coalescer:
+    # holds requests for `window` seconds and keeps only the final state of each widget. emit(request, callbacks,
+    # releases) is called with the surviving request and the onComplete callbacks of every request it replaced, so
+    # superseded messages are acknowledged once the surviving write succeeds, and their onRelease callbacks, so they can
+    # be handed back if it fails. a delete is always forwarded, even after a create in
+    # the same window, since that create may be a redelivery of a widget that already exists. entries leave in the order
+    # they were taken out of pending (by the flush thread, or by Add when pending overflows) and only one thread emits at
+    # a time, so two entries for the same widget are never emitted out of order
+    def __init__(self, window, emit, maxPending=1000):
+        self.window = window
+        self.emit = emit
+        self.maxPending = maxPending
+        self.pending = OrderedDict()  # widgetId -> [request, callbacks, firstSeen, releases]
+        self.ready = deque()  # entries taken out of pending, waiting for their turn to be emitted
+        self.lock = threading.Lock()
+        self.emitLock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.received = 0
+        self.emitted = 0
+
+    def Add(self, request, onComplete, onRelease=None):
+        widgetId = request["widgetId"]
+        overflow = False
+        with self.lock:
+            self.received += 1
+            entry = self.pending.get(widgetId)
+            if entry is None:
+                entry = self.pending[widgetId] = [request, [onComplete], time.monotonic(), []]
+                # never hold more than maxPending widgets; the oldest goes out early instead
+                while len(self.pending) > self.maxPending:
+                    self.ready.append(self.pending.popitem(last=False)[1])
+                    overflow = True
+            else:
+                entry[0] = request
+                entry[1].append(onComplete)
+            if onRelease:
+                entry[3].append(onRelease)
+        if overflow:
+            self._Drain()
+
+    def Pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def Flush(self, force=True):
+        now = time.monotonic()
+        with self.lock:
+            due = []
+            for widgetId, entry in self.pending.items():
+                # entries are kept in the order they were first seen, so the first one that is not due ends the scan
+                if not force and now - entry[2] < self.window:
+                    break
+                due.append(widgetId)
+            for widgetId in due:
+                self.ready.append(self.pending.pop(widgetId))
+        self._Drain()
+
+    def _Drain(self):
+        with self.emitLock:
+            while True:
+                with self.lock:
+                    if not self.ready:
+                        return
+                    request, callbacks, _, releases = self.ready.popleft()
+                    self.emitted += 1
+                if len(callbacks) > 1 and ShouldLogRequest():
+                    logging.info(f"Coalesced {len(callbacks)} requests for widget with ID {request['widgetId']}")
+                try:
+                    self.emit(request, callbacks, releases)
+                except Exception as e:
+                    # the messages are not acknowledged, so they are redelivered
+                    logging.error(f"Error emitting coalesced request for widget with ID {request['widgetId']}: {e}")
+
+    def _Run(self):
+        while not self.stopped.wait(self.window / 2):
+            self.Flush(force=False)
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="coalescer", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.Flush()
@@ -0,0 +1,77 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # optional; without it everything goes through the standard library
+    orjson = None
+
+# ---- JSON CODEC ----
+# set by main with --json-codec; orjson parses straight from bytes, bytearrays and memoryviews and encodes to bytes,
+# several times faster than json, and json is the fallback whenever orjson is missing or declines a document
+CODECS = ("auto", "orjson", "json")
+CODEC = "orjson" if orjson else "json"
+
+def ConfigureCodec(name="auto"):
+    global CODEC
+    if name == "orjson" and orjson is None:
+        raise ValueError("--json-codec orjson needs the orjson package installed")
+    CODEC = ("orjson" if orjson else "json") if name == "auto" else name
+    return CODEC
+
+def Loads(data):
+    # data may be str, bytes, bytearray or a memoryview over a buffer; none of them is decoded to str first
+    if CODEC == "orjson":
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects NaN and Infinity, so such documents parse the way they always did; a body that is not json at
+            # all still raises json's ValueError. integers past 64 bits are not rejected but come back as floats, so
+            # producers that send those need --json-codec json
+            pass
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    return json.loads(data)
+
+def Dumps(obj):
+    # returns utf-8 bytes. json's output is the same as json.dumps gave before, so stored bodies do not change without orjson
+    if CODEC == "orjson":
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # types orjson does not serialize (Decimal, non-str keys, integers past 64 bits)
+            pass
+    return json.dumps(obj).encode("utf-8")
+
+def DumpsText(obj):
+    return Dumps(obj).decode("utf-8")
+
+# ---- REQUESTS THAT KEEP THEIR BODY ----
+class Request(dict):
+    # a decoded request that keeps the body it was decoded from (str, bytes or bytearray), so a store can write that body
+    # as it is instead of encoding the dict again. the body is only right while the request is unchanged, so code that
+    # changes a request (FlattenOtherAttributes) calls Forget. the dict's own methods are not overridden to do that,
+    # since that would put a python call on every item set while flattening
+    __slots__ = ("raw",)
+
+    def __init__(self, values=(), raw=None):
+        super().__init__(values)
+        self.raw = raw
+
+    def Forget(self):
+        self.raw = None
+
+def LoadRequest(data):
+    # like Loads, but a json object comes back as a Request holding data. a memoryview over a whole buffer keeps the
+    # buffer, so holding on to it copies nothing; one over part of a buffer keeps no body. a request with otherAttributes
+    # is flattened before it is written, which drops the body anyway, so it stays the plain dict the parser built;
+    # neither codec can build a Request itself, so only requests that can be written as received pay for the copy
+    request = Loads(data)
+    if not isinstance(request, dict) or "otherAttributes" in request:
+        return request
+    if isinstance(data, memoryview):
+        data = data.obj if data.contiguous and data.nbytes == memoryview(data.obj).nbytes else None
+    return Request(request, raw=data)
+
+def RawBody(widget):
+    # the body a widget was decoded from, if it is still the same as the widget
+    return getattr(widget, "raw", None)
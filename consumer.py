@@ -1,13 +1,102 @@
-import boto3
-import json
 import time
+import re
+import signal
 import logging
 import argparse
+import threading
+from functools import partial
+from clients import LazyClient, ConfigureClients
+from workerpool import KeyedWorkerPool
+from acks import AckBuffer
+from dynamowriter import DynamoBatchWriter
+from s3source import S3RequestSource
+from replay import Replay
+from coalescer import Coalescer
+from dedup import DedupCache
+from heartbeat import VisibilityHeartbeat
+from scheduler import ReceiveScheduler, ReceiverScaler
+from supervisor import ProcessSupervisor
+from claimcheck import ClaimCheckFetcher, IsPointer
+from snapshots import S3SnapshotStore
+from digests import WidgetDigest, DigestCache
+from ratelimit import AdaptiveRateLimiter, IsThrottle
+from codec import CODECS, ConfigureCodec, Loads, LoadRequest, Request
+from deadletter import PermanentError, IsPermanent, DescribeError, OpenDeadLetterSink, RetryQueue
+from metrics import REGISTRY, BATCH_SIZE_BUCKETS, MetricsServer, StatsDumper, SetRequestLogSampleRate, ShouldLogRequest
+from validation import IsValidId, ValidateRequest, ValidateRequests, ROUTING_FIELDS, OPTIONAL_ROUTING_FIELDS
+from storage import ConfigureMarshaller, GetDynamoAttribute, GetDynamoItem, GetOwnerPrefix, DIGEST_ATTRIBUTE, RESERVED_ATTRIBUTES, S3WidgetStore, DynamoDBWidgetStore, MemoryWidgetStore, LocalWidgetStore
 
 # ---- SETUP CLIENTS / LOGGING ---- 
-S3_CLIENT = boto3.client('s3')
-DYNAMODB_CLIENT = boto3.client('dynamodb', "us-east-1")
-SQS_CLIENT = boto3.client('sqs', "us-east-1")
+# each client is created on first use and shared by every thread
+S3_CLIENT = LazyClient('s3')
+DYNAMODB_CLIENT = LazyClient('dynamodb', "us-east-1")
+SQS_CLIENT = LazyClient('sqs', "us-east-1")
+
+# receive_message returns at most 10 messages, and long-polls for at most 20 seconds
+MAX_RECEIVE_MESSAGES = 10
+LONG_POLL_SECONDS = 20
+
+# resolves claim-check pointer messages (requests too large for sqs, stored in s3); its threads start on first use.
+# main points it at --claim-check-bucket, and until then every pointer is rejected
+CLAIM_CHECK_FETCHER = ClaimCheckFetcher(S3_CLIENT)
+
+# set by main when --batch-writes is used with the dynamodb storage strategy
+DYNAMODB_BATCH_WRITER = None
+
+# set by main when --dedup-cache-size is greater than zero
+DEDUP_CACHE = None
+
+# set by main when --heartbeat is used with a queue
+VISIBILITY_HEARTBEAT = None
+
+# set by main when --digest-cache-size is greater than zero or --digest-check is used; writes of a widget state that is
+# already stored are skipped
+DIGEST_CACHE = None
+DEFAULT_DIGEST_CACHE_SIZE = 10000
+# set by main with --digest-check; on a cache miss the s3 and dynamodb stores are asked for the stored digest
+CHECK_STORED_DIGESTS = False
+
+# set by main with --rate-limit, --write-rate or --owner-write-rate; writes to s3 and dynamodb wait for a token from
+# the destination's bucket and from the bucket of the widget's owner prefix, whose rates back off when throttled
+WRITE_LIMITER = None
+OWNER_WRITE_LIMITER = None
+RATE_LIMITED_STRATEGIES = ("s3", "dynamodb")
+
+# set by main; requests that can never be processed are sent here with the reason (--dead-letter)
+DEAD_LETTER_SINK = None
+
+# set by main; retries transient failures with backoff away from the receive loop (--max-retries)
+RETRY_QUEUE = None
+
+# how often the s3-snapshot strategy writes changed owners' snapshots, and whether they are gzipped; set by main
+SNAPSHOT_INTERVAL = 30
+SNAPSHOT_COMPRESS = False
+
+# one widget store per (storage strategy, destination), created on first use
+WIDGET_STORES = {}
+WIDGET_STORES_LOCK = threading.Lock()
+
+# ---- METRICS ----
+MESSAGES_RECEIVED = REGISTRY.Counter("consumer_messages_received_total", "Messages received from the queue")
+RECEIVE_BATCH_SIZE = REGISTRY.Histogram("consumer_receive_batch_size", "Messages returned per non-empty receive", buckets=BATCH_SIZE_BUCKETS)
+MESSAGES_IN_FLIGHT = REGISTRY.Gauge("consumer_messages_in_flight", "Messages received but not yet acknowledged or released")
+MESSAGES_ACKNOWLEDGED = REGISTRY.Counter("consumer_messages_acknowledged_total", "Messages acknowledged after processing")
+MESSAGES_RELEASED = REGISTRY.Counter("consumer_messages_released_total", "Messages handed back to the queue for a retry")
+STAGE_SECONDS = REGISTRY.Histogram("consumer_stage_seconds", "Time spent in each stage of the pipeline", ("stage",))
+REQUESTS_PROCESSED = REGISTRY.Counter("consumer_requests_total", "Requests sent to the destination by type", ("type",))
+INVALID_REQUESTS = REGISTRY.Counter("consumer_invalid_requests_total", "Requests skipped because they failed validation")
+DUPLICATE_REQUESTS = REGISTRY.Counter("consumer_duplicate_requests_total", "Requests skipped because they already completed")
+ERRORS = REGISTRY.Counter("consumer_errors_total", "Errors by stage and exception type", ("stage", "exception"))
+DEAD_LETTERS = REGISTRY.Counter("consumer_dead_letters_total", "Requests that failed for good, by stage and whether the failure was permanent", ("stage", "kind"))
+SUPPRESSED_WRITES = REGISTRY.Counter("consumer_suppressed_writes_total", "Writes skipped because the widget was already stored in that state, by what knew it", ("source",))
+SUPPRESSED_BYTES = REGISTRY.Counter("consumer_suppressed_bytes_total", "Bytes of widget json not written because the write was skipped")
+THROTTLED_WRITES = REGISTRY.Counter("consumer_throttled_writes_total", "Writes the destination throttled, by storage strategy", ("strategy",))
+WRITE_RATE_LIMIT = REGISTRY.Gauge("consumer_write_rate_limit", "Lowest writes per second currently allowed to a destination; 0 while unlimited",
+                                  function=lambda: WRITE_LIMITER.LowestRate() if WRITE_LIMITER else 0.0)
+PENDING_RETRIES = REGISTRY.Gauge("consumer_pending_retries", "Requests waiting for a retry", function=lambda: RETRY_QUEUE.Pending() if RETRY_QUEUE else 0)
+
+# pulls the widgetId out of a raw message body without parsing all of it, so the supervisor can route messages cheaply
+WIDGET_ID_PATTERN = re.compile(r'"widgetId"\s*:\s*"([^"\\]*)"')
 
 # logFile = 'consumer.log'
 logging.basicConfig(
@@ -17,146 +106,676 @@ logging.basicConfig(
 )
 
 # ---- HELPER FUNCTIONS ----
-def GetDynamoAttribute(value):
-    if isinstance(value, str):
-        return {"S": value}
-    elif isinstance(value, int) or isinstance(value, float):
-        return {"N": str(value)}
-    elif isinstance(value, list):
-        return {"L": [GetDynamoAttribute(item) for item in value]}
-    elif isinstance(value, dict):
-        return {"M": {key: GetDynamoAttribute(val) for key, val in value.items()}}
+def GetWidgetStore(storageStrategy, destination):
+    with WIDGET_STORES_LOCK:
+        store = WIDGET_STORES.get((storageStrategy, destination))
+        if store is None:
+            if storageStrategy == "s3":
+                store = S3WidgetStore(S3_CLIENT, destination, CHECK_STORED_DIGESTS)
+            elif storageStrategy == "dynamodb":
+                store = DynamoDBWidgetStore(DYNAMODB_CLIENT, destination, CHECK_STORED_DIGESTS)
+            elif storageStrategy == "s3-snapshot":
+                store = S3SnapshotStore(S3_CLIENT, destination, SNAPSHOT_INTERVAL, SNAPSHOT_COMPRESS).Start()
+            elif storageStrategy == "memory":
+                store = MemoryWidgetStore()
+            elif storageStrategy == "local":
+                store = LocalWidgetStore(destination)
+            else:
+                raise ValueError(f"Unknown storage strategy: {storageStrategy}")
+            WIDGET_STORES[(storageStrategy, destination)] = store
+        return store
+
+def CloseWidgetStores():
+    # flushes and closes every store; deferred stores write whatever is still pending
+    with WIDGET_STORES_LOCK:
+        stores = list(WIDGET_STORES.values())
+        WIDGET_STORES.clear()
+    for store in stores:
+        store.Close()
+
+def ConfigureDigests(cacheSize, checkStored=False):
+    global DIGEST_CACHE, CHECK_STORED_DIGESTS
+    CHECK_STORED_DIGESTS = checkStored
+    # the store checks rely on the cache to know which widgets still have a write landing, so they always get one
+    DIGEST_CACHE = DigestCache(cacheSize if cacheSize > 0 else DEFAULT_DIGEST_CACHE_SIZE) if cacheSize > 0 or checkStored else None
+
+def FlattenOtherAttributes(request):
+    # ensure 'other attributes' is at the top level of 'request' as per assignment description
+    # each {"name", "value"} pair becomes its own attribute; names that would overwrite a request field, or an attribute
+    # the stores set themselves (such as the dynamodb key), are skipped
+    if "otherAttributes" in request:
+        if isinstance(request, Request):
+            # the request no longer matches the body it arrived in
+            request.Forget()
+        otherAttributes = request.pop("otherAttributes")
+        for attribute in otherAttributes if isinstance(otherAttributes, list) else []:
+            if isinstance(attribute, dict) and isinstance(attribute.get("name"), str) and attribute["name"] not in request and attribute["name"] not in RESERVED_ATTRIBUTES:
+                request[attribute["name"]] = attribute.get("value")
+    return request
 
 def IsValidWidgetId(widgetId):
-    if len(widgetId) != 36:
-        return False
-    # ensure the positions of the dashes are correct
-    if widgetId[8] != "-" or widgetId[13] != "-" or widgetId[18] != "-" or widgetId[23] != "-":
-        return False
-    # check that all other characters are hexadecimal
-    hexCharacters = set("0123456789abcdefABCDEF")
-    for i, char in enumerate(widgetId):
-        if i in [8, 13, 18, 23]:
-            continue  # skip dash positions
-        if char not in hexCharacters:
-            return False
-    return True
+    return IsValidId(widgetId)
 
 # ---- RETRIEVE REQUESTS FROM SOURCES ----
 def RetrieveRequestFromS3(bucketSource):
     try:
+        start = time.perf_counter()
         # the request data's key is numeric with the same number of digits each time; thus, grabbing the first element should be the smallest key
         response = S3_CLIENT.list_objects_v2(Bucket=bucketSource, MaxKeys=1)
         if 'Contents' in response:
             key = response['Contents'][0]['Key']
             # obtain the actual content of the object
             myObject = S3_CLIENT.get_object(Bucket=bucketSource, Key=key)
-            request = json.loads(myObject['Body'].read().decode('utf-8'))
-            logging.info(f"Request with key {key} retrieved.")
+            body = myObject['Body'].read()
+            parseStart = time.perf_counter()
+            STAGE_SECONDS.Observe(parseStart - start, "receive")
+            # parsed straight from the bytes read; the request keeps them so the s3 store can write them back unchanged
+            request = LoadRequest(body)
+            STAGE_SECONDS.Observe(time.perf_counter() - parseStart, "parse")
+            if ShouldLogRequest():
+                logging.info(f"Request with key {key} retrieved.")
             return request, key
     except Exception as e:
+        ERRORS.Inc("receive", type(e).__name__)
         logging.error(f"Error retrieving request: {e}")
     return None, None
 
-def RetrieveRequestsFromQueue(queueURL, maxMessages=10, waitTime=20):
+def RetrieveRequestsFromQueue(queueURL, maxMessages=MAX_RECEIVE_MESSAGES, waitTime=LONG_POLL_SECONDS):
+    start = time.perf_counter()
     response = SQS_CLIENT.receive_message(
         QueueUrl=queueURL,
         MaxNumberOfMessages=maxMessages,
         WaitTimeSeconds=waitTime
     )
-    return response.get('Messages', [])
+    messages = response.get('Messages', [])
+    STAGE_SECONDS.Observe(time.perf_counter() - start, "receive")
+    if messages:
+        MESSAGES_RECEIVED.Inc(amount=len(messages))
+        RECEIVE_BATCH_SIZE.Observe(len(messages))
+    return messages
 
 # ---- PROCESS (CREATE/UPDATE/DELETE) REQUESTS AT THE DESTINATION -----
-def ProcessRequest(request, destination, storageStrategy):
+# onComplete is called once the request is finished at the destination; with a batch writer that happens later, on its flush thread,
+# and onFailure(error, attempts) is called there instead if the writer gives up on it
+def ProcessRequest(request, destination, storageStrategy, onComplete=None, onFailure=None):
+    start = time.perf_counter()
+    errors = ValidateRequest(request, ROUTING_FIELDS, OPTIONAL_ROUTING_FIELDS)
+    STAGE_SECONDS.Observe(time.perf_counter() - start, "validate")
+    if errors:
+        INVALID_REQUESTS.Inc()
+        raise PermanentError(f"Invalid request {request.get('requestId') if isinstance(request, dict) else None}: {errors}")
     widgetId = request["widgetId"]
-    if IsValidWidgetId(widgetId):
-        requestType = request["type"].lower()
-        if requestType == "create":
-            CreateOrUpdateWidget(request, destination, storageStrategy, operation="created")
-        elif requestType == "update":
-            CreateOrUpdateWidget(request, destination, storageStrategy, operation="updated")
-        elif requestType == "delete":
-            DeleteWidget(widgetId, destination, storageStrategy)
-        else:
-            logging.warning(f"Unknown request type: {requestType}")
+    if DEDUP_CACHE:
+        # sqs delivers at least once; a request that already completed is acknowledged without writing it again
+        if DEDUP_CACHE.Seen(request):
+            DUPLICATE_REQUESTS.Inc()
+            if ShouldLogRequest():
+                logging.info(f"Skipping duplicate request {request.get('requestId')} for widget with ID {widgetId}")
+            if onComplete:
+                onComplete()
+            return
+        onComplete = partial(CompleteRequest, request, onComplete)
+    requestType = request["type"].lower()
+    REQUESTS_PROCESSED.Inc(requestType)
+    if requestType == "create":
+        CreateOrUpdateWidget(request, destination, storageStrategy, operation="created", onComplete=onComplete, onFailure=onFailure)
+    elif requestType == "update":
+        CreateOrUpdateWidget(request, destination, storageStrategy, operation="updated", onComplete=onComplete, onFailure=onFailure)
+    else:
+        DeleteWidget(widgetId, destination, storageStrategy, onComplete=onComplete, owner=request.get("owner"), onFailure=onFailure)
+
+def CompleteRequest(request, onComplete):
+    DEDUP_CACHE.Add(request)
+    if onComplete:
+        onComplete()
+
+def SkipUnchangedWrite(request, digest, size, destination, storageStrategy):
+    # the cache answers for widgets written by this process; the store is only asked on a miss, and never while a write of
+    # the widget is still landing, since the stored state is about to change
+    widgetId = request["widgetId"]
+    if DIGEST_CACHE.Unchanged(widgetId, digest):
+        source = "cache"
+    elif CHECK_STORED_DIGESTS and not DIGEST_CACHE.Writing(widgetId) and GetWidgetStore(storageStrategy, destination).Unchanged(request, digest):
+        DIGEST_CACHE.Remember(widgetId, digest)
+        source = "store"
+    else:
+        return False
+    SUPPRESSED_WRITES.Inc(source)
+    SUPPRESSED_BYTES.Inc(amount=size)
+    if ShouldLogRequest():
+        logging.info(f"Widget with ID {widgetId} is unchanged; skipping the write")
+    return True
+
+def ConfigureClaimChecks(bucket=None):
+    CLAIM_CHECK_FETCHER.bucket = bucket
+
+def ConfigureRateLimits(storageStrategy, rateLimit=False, writeRate=0, ownerWriteRate=0):
+    global WRITE_LIMITER, OWNER_WRITE_LIMITER
+    WRITE_LIMITER = AdaptiveRateLimiter(writeRate or None) if rateLimit or writeRate > 0 else None
+    # s3 throttles each key prefix on its own, so an adaptive bucket per owner only helps there; dynamodb throttles per table
+    perOwner = ownerWriteRate > 0 or (rateLimit and storageStrategy == "s3")
+    OWNER_WRITE_LIMITER = AdaptiveRateLimiter(ownerWriteRate or None) if perOwner else None
+
+def LimitWrite(storageStrategy, destination, owner):
+    # waits until the write may go ahead. the wait holds up the worker and, through the full worker queues, the receive
+    # loop, so the consumer slows down instead of sending writes the destination would throttle
+    if storageStrategy not in RATE_LIMITED_STRATEGIES:
+        return 0.0
+    waited = 0.0
+    if WRITE_LIMITER:
+        waited += WRITE_LIMITER.Acquire(destination)
+    if OWNER_WRITE_LIMITER and owner:
+        waited += OWNER_WRITE_LIMITER.Acquire((destination, GetOwnerPrefix(owner)))
+    if waited:
+        STAGE_SECONDS.Observe(waited, "rate-limit")
+    return waited
 
-def CreateOrUpdateWidget(request, destination, storageStrategy, operation):
+def WriteThrottled(error, storageStrategy, destination, owner):
+    # the throttled write itself is retried by the caller
+    if IsThrottle(error):
+        RecordThrottle(storageStrategy, destination, owner)
+
+def RecordThrottle(storageStrategy, destination, owner=None):
+    # s3 throttles a hot owner prefix, dynamodb the whole table
+    THROTTLED_WRITES.Inc(storageStrategy)
+    if storageStrategy == "s3" and OWNER_WRITE_LIMITER and owner:
+        OWNER_WRITE_LIMITER.Throttled((destination, GetOwnerPrefix(owner)))
+    elif WRITE_LIMITER:
+        WRITE_LIMITER.Throttled(destination)
+
+def DigestLanded(widgetId, token, digest, onComplete):
+    DIGEST_CACHE.Landed(widgetId, token, digest)
+    if onComplete:
+        onComplete()
+
+def DigestFailed(widgetId, token, onFailure, *args):
+    # the write may or may not have landed, so nothing is known about the stored widget until the next one lands
+    DIGEST_CACHE.Landed(widgetId, token, None)
+    if onFailure:
+        onFailure(*args)
+
+def CreateOrUpdateWidget(request, destination, storageStrategy, operation, onComplete=None, onFailure=None):
+    start = time.perf_counter()
+    token = None
     try:
         widgetId = request["widgetId"]
-        
-        # ensure 'other attributes' is at the top level of 'request' as per assignment description
-        if "otherAttributes" in request:
-            otherAttributes = request.pop("otherAttributes")
-            request.update(otherAttributes)
-
-        if storageStrategy == "s3":
-            owner = request["owner"].replace(" ", "-").lower()
-            s3Key = f"widgets/{owner}/{widgetId}"
-            data = json.dumps(request)
-            S3_CLIENT.put_object(Body=data, Bucket=destination, Key=s3Key, ContentType='application/json')
-            logging.info(f"Widget with ID {widgetId} {operation} in S3 at {destination}")
-
-        elif storageStrategy == "dynamodb":   
-            dynamoDict = {"id": {"S": widgetId}}
-            for key, value in request.items():
-                dynamoDict[key] = GetDynamoAttribute(value)
-            DYNAMODB_CLIENT.put_item(TableName=destination, Item=dynamoDict)
-            logging.info(f"Widget with ID {widgetId} {operation} in DynamoDB at {destination}")
+        FlattenOtherAttributes(request)
+        if storageStrategy != "s3" and isinstance(request, Request):
+            # only the s3 store writes the body the request arrived in; the others may hold on to the widget, and the
+            # body with it
+            request.Forget()
+
+        digest = None
+        if DIGEST_CACHE:
+            digest, size = WidgetDigest(request)
+            if SkipUnchangedWrite(request, digest, size, destination, storageStrategy):
+                STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+                if onComplete:
+                    onComplete()
+                return
+            # the digest is only trusted once the write has landed
+            token = DIGEST_CACHE.Begin(widgetId)
+            onComplete = partial(DigestLanded, widgetId, token, digest, onComplete)
+            onFailure = partial(DigestFailed, widgetId, token, onFailure)
+
+        start += LimitWrite(storageStrategy, destination, request.get("owner"))
+        if storageStrategy == "dynamodb" and DYNAMODB_BATCH_WRITER:
+            item = GetDynamoItem(request)
+            if CHECK_STORED_DIGESTS:
+                item[DIGEST_ATTRIBUTE] = {"S": digest}
+            # the writer calls onComplete once the batch containing this widget has landed
+            DYNAMODB_BATCH_WRITER.Put(item, onComplete, onFailure)
+            STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+            return
+
+        store = GetWidgetStore(storageStrategy, destination)
+        if store.deferred:
+            # the store calls onComplete once the widget has been written
+            store.Put([request], onComplete)
+            STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+            if ShouldLogRequest():
+                logging.info(f"Widget with ID {widgetId} {operation} in {store.name} at {destination}")
+            return
+        store.Put([request], [digest] if digest else None)
+        STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+        if ShouldLogRequest():
+            logging.info(f"Widget with ID {widgetId} {operation} in {store.name} at {destination}")
 
     except Exception as e:
-        logging.error(f"Error creating widget: {e}")
+        # the caller decides whether to retry, dead-letter or release the request
+        if token is not None:
+            DIGEST_CACHE.Landed(widgetId, token, None)
+        ERRORS.Inc("write", type(e).__name__)
+        WriteThrottled(e, storageStrategy, destination, request.get("owner") if isinstance(request, dict) else None)
+        raise
+    if onComplete:
+        onComplete()
 
-def DeleteWidget(widgetId, destination, storageStrategy):
+def DeleteWidget(widgetId, destination, storageStrategy, onComplete=None, owner=None, onFailure=None):
+    start = time.perf_counter()
+    token = None
+    if DIGEST_CACHE:
+        token = DIGEST_CACHE.Begin(widgetId)
+        onComplete = partial(DigestLanded, widgetId, token, None, onComplete)
+        onFailure = partial(DigestFailed, widgetId, token, onFailure)
     try:
-        if storageStrategy == "s3":
-            s3Key = f"widgets/{widgetId}"
-            S3_CLIENT.delete_object(Bucket=destination, Key=s3Key)
-            logging.info(f"Widget with ID {widgetId} deleted from S3 at {s3Key}")
+        start += LimitWrite(storageStrategy, destination, owner)
+        if storageStrategy == "dynamodb" and DYNAMODB_BATCH_WRITER:
+            DYNAMODB_BATCH_WRITER.Delete(widgetId, onComplete, onFailure)
+            STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+            return
 
-        elif storageStrategy == "dynamodb":
-            DYNAMODB_CLIENT.delete_item(TableName=destination, Key={"id": {"S": widgetId}})
-            logging.info(f"Widget with ID {widgetId} deleted from DynamoDB at {destination}")
+        store = GetWidgetStore(storageStrategy, destination)
+        if store.deferred:
+            store.Delete([{"widgetId": widgetId, "owner": owner}], onComplete)
+            STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+            if ShouldLogRequest():
+                logging.info(f"Widget with ID {widgetId} deleted from {store.name} at {destination}")
+            return
+        store.Delete([{"widgetId": widgetId, "owner": owner}])
+        STAGE_SECONDS.Observe(time.perf_counter() - start, "write")
+        if ShouldLogRequest():
+            logging.info(f"Widget with ID {widgetId} deleted from {store.name} at {destination}")
 
     except Exception as e:
-        logging.error(f"Error deleting widget with ID {widgetId}: {e}")
+        if token is not None:
+            DIGEST_CACHE.Landed(widgetId, token, None)
+        ERRORS.Inc("write", type(e).__name__)
+        WriteThrottled(e, storageStrategy, destination, owner)
+        raise
+    if onComplete:
+        onComplete()
+
+def ProcessRequestBatch(requests, destination, storageStrategy):
+    # writes a batch with the store's batch calls. consecutive creates/updates and consecutive deletes are grouped into
+    # one call each (keeping only the last request per widget), so the order between writes and deletes is preserved
+    store = GetWidgetStore(storageStrategy, destination)
+    puts, deletes = {}, {}
+    for request, errors in zip(requests, ValidateRequests(requests, ROUTING_FIELDS, OPTIONAL_ROUTING_FIELDS)):
+        if errors:
+            logging.warning(f"Skipping invalid request {request.get('requestId') if isinstance(request, dict) else None}: {errors}")
+            continue
+        widgetId = request["widgetId"]
+        requestType = request["type"].lower()
+        if requestType == "create" or requestType == "update":
+            if deletes:
+                store.Delete(list(deletes.values()))
+                deletes = {}
+            puts.pop(widgetId, None)
+            puts[widgetId] = FlattenOtherAttributes(request)
+        else:
+            if puts:
+                store.Put(list(puts.values()))
+                puts = {}
+            deletes[widgetId] = {"widgetId": widgetId, "owner": request.get("owner")}
+    if puts:
+        store.Put(list(puts.values()))
+    if deletes:
+        store.Delete(list(deletes.values()))
+
+# ---- FAILURES ----
+def DeadLetter(body, error, stage, attempts=1):
+    # returns True once the request is in the dead-letter sink, so its message can be acknowledged
+    kind = "permanent" if IsPermanent(error) else "retries exhausted"
+    DEAD_LETTERS.Inc(stage, kind)
+    reason = DescribeError(error)
+    if DEAD_LETTER_SINK is None:
+        logging.error(f"Request failed during {stage} ({kind}, {attempts} attempts): {reason}")
+        return False
+    try:
+        DEAD_LETTER_SINK.Send(body, reason, stage, attempts)
+    except Exception as e:
+        logging.error(f"Error sending a request to the dead-letter {DEAD_LETTER_SINK.name}: {e}")
+        return False
+    logging.warning(f"Sent a request to the dead-letter {DEAD_LETTER_SINK.name} after {stage} failed ({kind}, {attempts} attempts): {reason}")
+    return True
+
+def RunWithRetries(key, attempt, onFailure, wait=False):
+    # transient failures are retried by RETRY_QUEUE; onFailure(error, attempts) runs for a permanent failure, or once
+    # the retries run out
+    if RETRY_QUEUE:
+        RETRY_QUEUE.Run(key, attempt, onFailure, wait)
+        return
+    try:
+        attempt()
+    except Exception as e:
+        onFailure(e, 1)
 
 # ---- DELETE FROM SOURCE AFTER PROCESSING ----
 def DeleteFromStorage(key, bucketSource):
+    start = time.perf_counter()
     try:
         S3_CLIENT.delete_object(Bucket=bucketSource, Key=key)
-        logging.info(f"Request with key {key} deleted from {bucketSource}")
+        STAGE_SECONDS.Observe(time.perf_counter() - start, "ack")
+        if ShouldLogRequest():
+            logging.info(f"Request with key {key} deleted from {bucketSource}")
     except Exception as e:
+        ERRORS.Inc("ack", type(e).__name__)
         logging.error(f"Error deleting request with key {key}: {e}")
 
+def ProcessStorageRequest(request, destination, storageStrategy, onComplete, wait=False, onRelease=None):
+    def Failed(error, attempts):
+        ERRORS.Inc("process", type(error).__name__)
+        # a request that is dead-lettered, or that failed permanently with no sink, is removed from the bucket since
+        # processing it again cannot help; one that only ran out of retries stays there to be listed again
+        if DeadLetter(request, error, "process", attempts) or (DEAD_LETTER_SINK is None and IsPermanent(error)):
+            onComplete()
+        elif onRelease:
+            onRelease()
+    RunWithRetries(str(request.get("widgetId")) if isinstance(request, dict) else "", partial(ProcessRequest, request, destination, storageStrategy, onComplete=onComplete, onFailure=Failed), Failed, wait)
+
 def DeleteFromQueue(queueURL, receiptHandle):
     SQS_CLIENT.delete_message(QueueUrl=queueURL, ReceiptHandle=receiptHandle)
-    logging.info("Deleted a response from SQS")
+    if ShouldLogRequest():
+        logging.info("Deleted a response from SQS")
+
+def AcknowledgeMessage(queueURL, receiptHandle, ackBuffer=None, receivedAt=None):
+    start = time.perf_counter()
+    MESSAGES_IN_FLIGHT.Dec()
+    MESSAGES_ACKNOWLEDGED.Inc()
+    if VISIBILITY_HEARTBEAT:
+        VISIBILITY_HEARTBEAT.Done(receiptHandle)
+        # the heartbeat has kept the handle valid until now, so its age counts from here
+        receivedAt = None
+    try:
+        if ackBuffer:
+            ackBuffer.Add(receiptHandle, receivedAt)
+        else:
+            DeleteFromQueue(queueURL, receiptHandle)
+    except Exception as e:
+        # the message becomes visible again and is redelivered; the dedup cache skips the repeated write
+        ERRORS.Inc("ack", type(e).__name__)
+        logging.error(f"Error acknowledging a message: {e}")
+        return
+    STAGE_SECONDS.Observe(time.perf_counter() - start, "ack")
+
+def ReleaseMessage(receiptHandle):
+    # make an unprocessable message visible again right away instead of waiting out its visibility timeout
+    MESSAGES_IN_FLIGHT.Dec()
+    MESSAGES_RELEASED.Inc()
+    if VISIBILITY_HEARTBEAT:
+        VISIBILITY_HEARTBEAT.Release([receiptHandle])
+
+def FailQueueMessage(body, error, stage, attempts, acknowledge, receiptHandle):
+    # a dead-lettered message is acknowledged; one that failed permanently with no sink is dropped, since redelivering it
+    # cannot help; one that ran out of retries goes back to the queue (and to its redrive policy)
+    ERRORS.Inc(stage, type(error).__name__)
+    if DeadLetter(body, error, stage, attempts) or (DEAD_LETTER_SINK is None and IsPermanent(error)):
+        acknowledge()
+    else:
+        ReleaseMessage(receiptHandle)
+
+def ProcessQueueMessage(messageBody, receiptHandle, destination, storageStrategy, queueURL, ackBuffer=None, receivedAt=None, rawBody=None):
+    # rawBody is the message as received, which is what gets dead-lettered so it can be redriven unchanged
+    acknowledge = partial(AcknowledgeMessage, queueURL, receiptHandle, ackBuffer, receivedAt)
+    failed = lambda error, attempts: FailQueueMessage(rawBody if rawBody is not None else messageBody, error, "process", attempts, acknowledge, receiptHandle)
+    widgetId = str(messageBody.get("widgetId")) if isinstance(messageBody, dict) else ""
+    RunWithRetries(widgetId, partial(ProcessRequest, messageBody, destination, storageStrategy, onComplete=acknowledge, onFailure=failed), failed)
+
+def ProcessCoalescedRequest(request, callbacks, destination, storageStrategy, releases=()):
+    # the surviving request of a coalescing window; finishing it acknowledges every message it replaced, and failing it
+    # for good hands them all back, as FailQueueMessage does for a single message
+    def AcknowledgeAll():
+        for callback in callbacks:
+            callback()
+    def Failed(error, attempts):
+        ERRORS.Inc("process", type(error).__name__)
+        if DeadLetter(request, error, "process", attempts) or (DEAD_LETTER_SINK is None and IsPermanent(error)):
+            AcknowledgeAll()
+        else:
+            for release in releases:
+                release()
+    RunWithRetries(str(request.get("widgetId")), partial(ProcessRequest, request, destination, storageStrategy, onComplete=AcknowledgeAll, onFailure=Failed), Failed)
+
+def DispatchQueueMessages(requests, receivedAt, destination, storageStrategy, queueURL, pool=None, ackBuffer=None, coalescer=None):
+    if VISIBILITY_HEARTBEAT:
+        for request in requests:
+            VISIBILITY_HEARTBEAT.Track(request['ReceiptHandle'], receivedAt)
+    MESSAGES_IN_FLIGHT.Inc(amount=len(requests))
+    parsed = []
+    for request in requests:
+        start = time.perf_counter()
+        try:
+            messageBody = LoadRequest(request['Body'])
+        except Exception as e:
+            # a body that is not json never will be, so it is not worth a retry
+            FailQueueMessage(request['Body'], e, "parse", 1, partial(AcknowledgeMessage, queueURL, request['ReceiptHandle'], ackBuffer, receivedAt), request['ReceiptHandle'])
+            continue
+        STAGE_SECONDS.Observe(time.perf_counter() - start, "parse")
+        # start every claim-check fetch in the batch before waiting on any of them
+        parsed.append((request, messageBody, CLAIM_CHECK_FETCHER.Submit(messageBody) if IsPointer(messageBody) else None))
+    for request, messageBody, fetch in parsed:
+        if fetch:
+            try:
+                messageBody = fetch.result()
+            except Exception as e:
+                # a transient failure is retried by redelivering the pointer; a missing or malformed body is dead-lettered
+                FailQueueMessage(request['Body'], e, "fetch", 1, partial(AcknowledgeMessage, queueURL, request['ReceiptHandle'], ackBuffer, receivedAt), request['ReceiptHandle'])
+                continue
+        if coalescer and isinstance(messageBody, dict) and "widgetId" in messageBody:
+            coalescer.Add(messageBody, partial(AcknowledgeMessage, queueURL, request['ReceiptHandle'], ackBuffer, receivedAt), partial(ReleaseMessage, request['ReceiptHandle']))
+        elif pool:
+            # route by widgetId so requests for the same widget are never reordered
+            pool.Submit(str(messageBody.get("widgetId")) if isinstance(messageBody, dict) else "", ProcessQueueMessage, messageBody, request['ReceiptHandle'], destination, storageStrategy,
+                        queueURL, ackBuffer, receivedAt, request['Body'])
+        else:
+            ProcessQueueMessage(messageBody, request['ReceiptHandle'], destination, storageStrategy, queueURL, ackBuffer, receivedAt, request['Body'])
+
+def ReceiveFromQueue(queueURL, dispatch, scheduler):
+    start = time.monotonic()
+    requests = RetrieveRequestsFromQueue(queueURL, waitTime=scheduler.WaitTime())
+    receivedAt = time.monotonic()
+    if requests:
+        dispatch(requests, receivedAt)
+    delay = scheduler.Next(len(requests), receivedAt - start)
+    if delay:
+        time.sleep(delay)
+
+def RunQueueReceiver(queueURL, dispatch, scheduler, isActive):
+    # an extra receiver thread; it only pulls while the scaler says the queue is deep enough to need it
+    while True:
+        if isActive():
+            ReceiveFromQueue(queueURL, dispatch, scheduler)
+        else:
+            time.sleep(1)
+
+# ---- MULTI-PROCESS MODE ----
+def ExtractWidgetId(body):
+    match = WIDGET_ID_PATTERN.search(body)
+    if match:
+        return match.group(1)
+    try:
+        return str(Loads(body).get("widgetId", ""))
+    except Exception:
+        return ""
+
+def RunWorkerProcess(index, workQueue, destination, storageStrategy, queueURL, workers=1, batchAcks=False, visibilityTimeout=30, batchWrites=False, numericAttributes=(), clientSettings=None,
+                     statsInterval=0, requestLogSample=1.0, deadLetter=None, maxRetries=4, digestCacheSize=0, checkDigests=False, rateLimit=False, writeRate=0,
+                     ownerWriteRate=0, jsonCodec="auto", claimCheckBucket=None):
+    # runs in a process of its own (with its own boto3 clients, created on first use there).
+    # the supervisor decides when to stop by queueing a sentinel, so signals are left to it
+    global DYNAMODB_BATCH_WRITER, DEAD_LETTER_SINK, RETRY_QUEUE
+    ConfigureCodec(jsonCodec)
+    ConfigureClaimChecks(claimCheckBucket)
+    ConfigureDigests(digestCacheSize, checkDigests)
+    ConfigureRateLimits(storageStrategy, rateLimit, writeRate, ownerWriteRate)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    ConfigureMarshaller(numericAttributes)
+    ConfigureClients(**(clientSettings or {}))
+    SetRequestLogSampleRate(requestLogSample)
+    # each process counts its own work, so children log their stats rather than sharing the parent's endpoint
+    statsDumper = StatsDumper(statsInterval, prefix=f"Worker process {index} stats").Start() if statsInterval > 0 else None
+    DEAD_LETTER_SINK = OpenDeadLetterSink(deadLetter, SQS_CLIENT) if deadLetter else None
+    RETRY_QUEUE = RetryQueue(maxRetries + 1).Start() if maxRetries > 0 else None
+    pool = KeyedWorkerPool(workers) if workers > 1 else None
+    ackBuffer = AckBuffer(SQS_CLIENT, queueURL, visibilityTimeout=visibilityTimeout).Start() if batchAcks else None
+    if batchWrites and storageStrategy == "dynamodb":
+        DYNAMODB_BATCH_WRITER = DynamoBatchWriter(DYNAMODB_CLIENT, destination, onThrottle=partial(RecordThrottle, "dynamodb", destination)).Start()
+    logging.info(f"Worker process {index} started")
+    while True:
+        item = workQueue.get()
+        if item is None:
+            break
+        body, receiptHandle, receivedAt = item
+        DispatchQueueMessages([{'Body': body, 'ReceiptHandle': receiptHandle}], receivedAt, destination, storageStrategy, queueURL, pool, ackBuffer)
+    # drain everything still in flight before exiting
+    if pool:
+        pool.Shutdown()
+    if RETRY_QUEUE:
+        RETRY_QUEUE.Stop()
+    if DYNAMODB_BATCH_WRITER:
+        DYNAMODB_BATCH_WRITER.Stop()
+    CloseWidgetStores()
+    if ackBuffer:
+        ackBuffer.Stop()
+    if statsDumper:
+        statsDumper.Stop()
+    logging.info(f"Worker process {index} drained and stopped")
+
+def RunSupervisor(queueURL, processes, workerArgs, maxIdleBackoff=5.0):
+    supervisor = ProcessSupervisor(processes, RunWorkerProcess, workerArgs).Start()
+    stopping = threading.Event()
+    def RequestStop(signum, frame):
+        logging.info("Received shutdown signal; draining in-flight work")
+        stopping.set()
+    signal.signal(signal.SIGTERM, RequestStop)
+    signal.signal(signal.SIGINT, RequestStop)
+
+    scheduler = ReceiveScheduler(maxDelay=maxIdleBackoff, batchSize=MAX_RECEIVE_MESSAGES)
+    while not stopping.is_set():
+        start = time.monotonic()
+        requests = RetrieveRequestsFromQueue(queueURL, waitTime=scheduler.WaitTime())
+        # the monotonic clock is system-wide on linux, so the workers' ack buffers can age the handles from this receive
+        receivedAt = time.monotonic()
+        for request in requests:
+            supervisor.Submit(ExtractWidgetId(request['Body']), (request['Body'], request['ReceiptHandle'], receivedAt))
+        stopping.wait(scheduler.Next(len(requests), time.monotonic() - start))
+    supervisor.Stop()
+    logging.info("All worker processes drained")
 
 # ---- DRIVER CODE ----
-def main(bucketSource, destination, storageStrategy, queueURL):
+def RunReplay(replayPath, destination, storageStrategy, parseWorkers=1):
+    report = Replay(replayPath, lambda batch: ProcessRequestBatch(batch, destination, storageStrategy), parseWorkers=parseWorkers)
+    CloseWidgetStores()
+    peakRss = f"{report['peakRssMB']:.1f} MB" if report['peakRssMB'] is not None else "unknown"
+    logging.info(
+        f"Replayed {report['requests']} requests from {replayPath} in {report['seconds']:.2f}s "
+        f"({report['requestsPerSecond']:.1f} requests/sec, p50 {report['p50LatencyMs']:.2f} ms, p99 {report['p99LatencyMs']:.2f} ms, "
+        f"peak RSS {peakRss}); {report['skipped']} unparseable, {report['failed']} failed"
+    )
+    return report
+
+def main(bucketSource, destination, storageStrategy, queueURL, workers=1, batchAcks=False, visibilityTimeout=30, batchWrites=False, readAhead=0, replayPath=None, parseWorkers=1, coalesceWindow=0,
+         dedupCacheSize=0, dedupTTL=None, dedupDB=None, heartbeat=False, maxIdleBackoff=5.0, maxReceivers=1, processes=1,
+         numericAttributes=(), clientSettings=None, snapshotInterval=30, snapshotCompress=False, metricsPort=0, metricsHost="127.0.0.1", statsInterval=0,
+         requestLogSample=1.0, deadLetter=None, maxRetries=4, digestCacheSize=0, checkDigests=False, rateLimit=False, writeRate=0, ownerWriteRate=0,
+         jsonCodec="auto", claimCheckBucket=None):
+    global DYNAMODB_BATCH_WRITER, DEDUP_CACHE, VISIBILITY_HEARTBEAT, SNAPSHOT_INTERVAL, SNAPSHOT_COMPRESS, DEAD_LETTER_SINK, RETRY_QUEUE
+    SNAPSHOT_INTERVAL, SNAPSHOT_COMPRESS = snapshotInterval, snapshotCompress
+    logging.info(f"Using the {ConfigureCodec(jsonCodec)} json codec")
+    ConfigureClaimChecks(claimCheckBucket)
+    ConfigureDigests(digestCacheSize, checkDigests)
+    ConfigureRateLimits(storageStrategy, rateLimit, writeRate, ownerWriteRate)
+    ConfigureMarshaller(numericAttributes)
+    clientSettings = dict(clientSettings or {})
+    if not clientSettings.get("maxPoolConnections"):
+        # enough connections for every thread that can be talking to aws at once, so none of them waits on the pool
+        clientSettings["maxPoolConnections"] = max(10, workers + maxReceivers + readAhead + 4)
+    ConfigureClients(**clientSettings)
+    SetRequestLogSampleRate(requestLogSample)
+    if metricsPort:
+        MetricsServer(metricsPort, metricsHost).Start()
+    if statsInterval > 0:
+        StatsDumper(statsInterval).Start()
+    if replayPath:
+        return RunReplay(replayPath, destination, storageStrategy, parseWorkers)
+    if queueURL and processes > 1 and storageStrategy == "s3-snapshot":
+        # every process would rewrite the same owners' snapshots from its own partial view
+        raise ValueError("The s3-snapshot storage strategy needs a single writer and cannot be used with --processes")
+    if queueURL and processes > 1 and (heartbeat or coalesceWindow > 0 or dedupCacheSize > 0):
+        # the worker processes only write and acknowledge; none of these would be applied
+        raise ValueError("--heartbeat, --coalesce-window and --dedup-cache-size cannot be used with --processes")
+    if queueURL and processes > 1:
+        return RunSupervisor(queueURL, processes, (destination, storageStrategy, queueURL, workers, batchAcks, visibilityTimeout, batchWrites, numericAttributes, clientSettings,
+                                                       statsInterval, requestLogSample, deadLetter, maxRetries, digestCacheSize, checkDigests,
+                                                       # each process has its own buckets, so the configured rates are shared out between them
+                                                       rateLimit, writeRate / processes, ownerWriteRate / processes, jsonCodec, claimCheckBucket), maxIdleBackoff)
+    # the streaming s3 source lists after the last key it handed out; without it the smallest key is re-listed,
+    # so concurrency and deferred writes only apply to the queue or the streaming source
+    s3Source = S3RequestSource(S3_CLIENT, bucketSource, readAhead=readAhead) if bucketSource and not queueURL and readAhead > 0 else None
+    concurrent = queueURL or s3Source
+    if not concurrent and storageStrategy == "s3-snapshot":
+        # the one-object-at-a-time s3 source re-lists a request until it is deleted, so write every change through
+        SNAPSHOT_INTERVAL = 0
+    if dedupCacheSize > 0:
+        DEDUP_CACHE = DedupCache(dedupCacheSize, dedupTTL, dedupDB)
+    if deadLetter:
+        DEAD_LETTER_SINK = OpenDeadLetterSink(deadLetter, SQS_CLIENT)
+    if maxRetries > 0:
+        RETRY_QUEUE = RetryQueue(maxRetries + 1).Start()
+    # several receivers dispatch at once, so they always go through the pool (even a single worker) to keep requests for
+    # one widget in order
+    pool = KeyedWorkerPool(workers) if concurrent and (workers > 1 or (queueURL and maxReceivers > 1)) else None
+    ackBuffer = AckBuffer(SQS_CLIENT, queueURL, visibilityTimeout=visibilityTimeout).Start() if queueURL and batchAcks else None
+    if queueURL and storageStrategy == "s3-snapshot" and SNAPSHOT_INTERVAL >= visibilityTimeout / 2 and not heartbeat:
+        # messages are only acknowledged once the snapshot holding them is written, so without the heartbeat most of them
+        # would be redelivered before then
+        logging.warning("The snapshot interval is close to the visibility timeout; turning on --heartbeat so held messages are not redelivered")
+        heartbeat = True
+    if queueURL and heartbeat:
+        VISIBILITY_HEARTBEAT = VisibilityHeartbeat(SQS_CLIENT, queueURL, visibilityTimeout).Start()
+    if concurrent and batchWrites and storageStrategy == "dynamodb":
+        DYNAMODB_BATCH_WRITER = DynamoBatchWriter(DYNAMODB_CLIENT, destination, onThrottle=partial(RecordThrottle, "dynamodb", destination)).Start()
+    coalescer = None
+    if queueURL and coalesceWindow > 0:
+        if coalesceWindow >= visibilityTimeout / 2:
+            logging.warning("The coalescing window is close to the visibility timeout; held messages may be redelivered")
+        def EmitCoalesced(request, callbacks, releases):
+            if pool:
+                pool.Submit(str(request.get("widgetId")), ProcessCoalescedRequest, request, callbacks, destination, storageStrategy, releases)
+            else:
+                ProcessCoalescedRequest(request, callbacks, destination, storageStrategy, releases)
+        coalescer = Coalescer(coalesceWindow, EmitCoalesced).Start()
+    # back off while the source is empty instead of polling it at a fixed rate
+    scheduler = ReceiveScheduler(maxDelay=maxIdleBackoff, batchSize=MAX_RECEIVE_MESSAGES if queueURL else None)
+    if queueURL:
+        dispatch = partial(DispatchQueueMessages, destination=destination, storageStrategy=storageStrategy, queueURL=queueURL,
+                           pool=pool, ackBuffer=ackBuffer, coalescer=coalescer)
+        if maxReceivers > 1:
+            scaler = ReceiverScaler(SQS_CLIENT, queueURL, maxReceivers).Start()
+            for index in range(1, maxReceivers):
+                receiverScheduler = ReceiveScheduler(maxDelay=maxIdleBackoff, batchSize=MAX_RECEIVE_MESSAGES)
+                threading.Thread(target=RunQueueReceiver, args=(queueURL, dispatch, receiverScheduler, partial(scaler.IsActive, index)),
+                                 name=f"queue-receiver-{index}", daemon=True).start()
     while True:
-        if bucketSource and not queueURL:
+        if s3Source:
+            received = 0
+            for request, key in s3Source.Requests():
+                received += 1
+                onComplete = lambda key=key: s3Source.MarkDone(key)
+                onRelease = lambda key=key: s3Source.Release(key)
+                if pool:
+                    pool.Submit(str(request.get("widgetId")), ProcessStorageRequest, request, destination, storageStrategy, onComplete, False, onRelease)
+                else:
+                    ProcessStorageRequest(request, destination, storageStrategy, onComplete, onRelease=onRelease)
+            # the bucket is drained; remove whatever has finished before listing again
+            if pool:
+                pool.Join()
+            s3Source.Flush()
+            delay = scheduler.Next(received)
+            if delay:
+                time.sleep(delay)
+        elif bucketSource and not queueURL:
             request, key = RetrieveRequestFromS3(bucketSource)
             if request:
-                try:
-                    ProcessRequest(request, destination, storageStrategy)
-                    DeleteFromStorage(key, bucketSource)
-                except Exception as e:
-                    logging.error(f"Error processing request from storage: {e}")
-            else:
-                time.sleep(0.1)
+                # this source lists the smallest key every time, so it waits for a request's retries before moving on
+                ProcessStorageRequest(request, destination, storageStrategy, lambda: DeleteFromStorage(key, bucketSource), wait=True)
+            delay = scheduler.Next(1 if request else 0)
+            if delay:
+                time.sleep(delay)
         elif queueURL:
-            requests = RetrieveRequestsFromQueue(queueURL)
-            if requests:
-                for request in requests:
-                    try:
-                        messageBody = json.loads(request['Body'])
-                        ProcessRequest(messageBody, destination, storageStrategy)
-                        DeleteFromQueue(queueURL, request['ReceiptHandle'])
-                    except Exception as e:
-                        logging.error(f"Error processing request from queue: {e}")
-            else:
-                time.sleep(0.1)
+            ReceiveFromQueue(queueURL, dispatch, scheduler)
         else:
             logging.error("Neither storage nor queue URL was specified. Exiting...")
             break
@@ -168,7 +787,7 @@ if __name__ == "__main__":
     # python3 consumer.py --queue-url https://sqs.us-east-1.amazonaws.com/487854293488/cs5260-requests --request-destination usu-cs5260-tylerj-web --storage-strategy s3
 
     parser = argparse.ArgumentParser(description='Consumer program to process requests to create, update, or delete widgets')
-    parser.add_argument('--storage-strategy', required=True, choices=['s3', 'dynamodb'], help='Choose \'s3\' to store widgets in a bucket or \'dynamodb\' to store widgets in a dynamodb table')
+    parser.add_argument('--storage-strategy', required=True, choices=['s3', 's3-snapshot', 'dynamodb', 'memory', 'local'], help='Choose \'s3\' to store widgets in a bucket, \'s3-snapshot\' to store them as compacted per-owner snapshots in a bucket, \'dynamodb\' to store widgets in a dynamodb table, \'local\' to store widgets in a local directory or \'memory\' to keep them in memory (for load testing)')
     parser.add_argument('--request-destination', required=True, help='Choose where to store the widgets')
 
     # initialize a mutually exclusive group
@@ -177,6 +796,45 @@ if __name__ == "__main__":
     # adding request-source and queue-url ensures one of them is required but not both
     group.add_argument('--request-source', help='S3 bucket where the requests are fetched from')
     group.add_argument('--queue-url', help='URL of the SQS queue')
+    group.add_argument('--replay', help='Replay requests from a JSONL file or a directory of request files, then exit')
+
+    parser.add_argument('--workers', type=int, default=1, help='Number of worker threads processing queue messages concurrently (requests for the same widget stay in order)')
+    parser.add_argument('--batch-acks', action='store_true', help='Delete processed messages from SQS in batches of up to 10 instead of one call per message')
+    parser.add_argument('--batch-writes', action='store_true', help='Group dynamodb writes into batch_write_item calls of up to 25 items')
+    parser.add_argument('--read-ahead', type=int, default=0, help='Stream the request source bucket, listing keys in pages and prefetching this many object bodies ahead')
+    parser.add_argument('--parse-workers', type=int, default=1, help='Number of processes parsing requests in --replay mode')
+    parser.add_argument('--coalesce-window', type=float, default=0, help='Hold queue messages for this many seconds and only write the final state of each widget')
+    parser.add_argument('--dedup-cache-size', type=int, default=0, help='Remember this many completed requestIds and skip redelivered duplicates')
+    parser.add_argument('--dedup-ttl', type=float, help='Forget completed requestIds after this many seconds')
+    parser.add_argument('--dedup-db', help='SQLite file that keeps the dedup cache across restarts')
+    parser.add_argument('--heartbeat', action='store_true', help='Extend the visibility of in-flight messages until they are processed, and release failed messages right away')
+    parser.add_argument('--max-idle-backoff', type=float, default=5.0, help='Longest delay in seconds between receives while the source is empty')
+    parser.add_argument('--max-receivers', type=int, default=1, help='Scale up to this many concurrent queue receivers based on ApproximateNumberOfMessages')
+    parser.add_argument('--processes', type=int, default=1, help='Process queue messages in this many worker processes, routed by widgetId')
+    parser.add_argument('--numeric-attributes', type=lambda text: [name.strip() for name in text.split(',') if name.strip()], default=[],
+                        help='Comma-separated attribute names or patterns (e.g. price,quantity,width*) whose numeric strings are stored as DynamoDB numbers')
+    parser.add_argument('--max-pool-connections', type=int, help='Connections kept open per AWS client; defaults to enough for every worker and receiver')
+    parser.add_argument('--retry-mode', choices=['standard', 'adaptive', 'legacy'], default='standard', help='botocore retry mode for AWS calls')
+    parser.add_argument('--max-attempts', type=int, default=3, help='Attempts per AWS call, including the first')
+    parser.add_argument('--connect-timeout', type=float, default=5, help='Seconds to wait for a connection to AWS')
+    parser.add_argument('--read-timeout', type=float, default=60, help='Seconds to wait for an AWS response; keep it above the 20 second receive wait')
+    parser.add_argument('--no-keepalive', action='store_true', help='Do not enable TCP keep-alive on AWS connections')
+    parser.add_argument('--snapshot-interval', type=float, default=30, help='With the s3-snapshot strategy, seconds between snapshot writes for changed owners')
+    parser.add_argument('--snapshot-compress', action='store_true', help='With the s3-snapshot strategy, gzip the snapshot files')
+    parser.add_argument('--metrics-port', type=int, default=0, help='Serve Prometheus metrics at http://<metrics-host>:<port>/metrics')
+    parser.add_argument('--metrics-host', default='127.0.0.1', help='Address the metrics endpoint listens on')
+    parser.add_argument('--stats-interval', type=float, default=0, help='Log a summary of the metrics every this many seconds')
+    parser.add_argument('--request-log-sample', type=float, default=1.0, help='Fraction of per-request info logs to write; 0 turns them off')
+    parser.add_argument('--dead-letter', help='Local file or SQS queue URL where requests that can never be processed are sent, with the reason')
+    parser.add_argument('--max-retries', type=int, default=4, help='Retries with backoff for a request that failed with a transient error; 0 turns retries off')
+    parser.add_argument('--digest-cache-size', type=int, default=0, help='Remember the content digest of this many written widgets and skip writes that would store the same state again')
+    parser.add_argument('--digest-check', action='store_true', help='On a digest cache miss, compare against the digest stored with the widget in S3 (HEAD) or DynamoDB (consistent GetItem)')
+    parser.add_argument('--rate-limit', action='store_true', help='Slow down writes to S3 and DynamoDB when the destination throttles them, adapting the rate to its capacity')
+    parser.add_argument('--write-rate', type=float, default=0, help='Most writes per second to the destination (e.g. the table\'s provisioned write capacity); turns on --rate-limit')
+    parser.add_argument('--owner-write-rate', type=float, default=0, help='Most writes per second to one owner\'s widgets (one S3 key prefix); turns on --rate-limit')
+    parser.add_argument('--json-codec', choices=CODECS, default='auto', help='JSON library for decoding requests and encoding widgets; auto uses orjson when it is installed')
+    parser.add_argument('--claim-check-bucket', help='Bucket the lambda offloads large requests to (CLAIM_CHECK_BUCKET); pointer messages into any other bucket are rejected')
+    parser.add_argument('--visibility-timeout', type=int, default=30, help='Visibility timeout of the SQS queue in seconds; receipt handles older than this are never used')
 
     args = parser.parse_args()
 
@@ -184,5 +842,48 @@ if __name__ == "__main__":
     REQUEST_DESTINATION = args.request_destination # required
     STORAGE_STRATEGY = args.storage_strategy # required
     QUEUE_URL = args.queue_url # optional - the sqs queue it is coming from
+    WORKERS = args.workers # optional - defaults to processing one request at a time
+    BATCH_ACKS = args.batch_acks # optional - defaults to one delete_message call per request
+    VISIBILITY_TIMEOUT = args.visibility_timeout # optional - defaults to the SQS default of 30 seconds
+    BATCH_WRITES = args.batch_writes # optional - defaults to one put_item/delete_item call per request
+    READ_AHEAD = args.read_ahead # optional - defaults to fetching one request from the bucket at a time
+    REPLAY_PATH = args.replay # optional - a local file or directory of requests to replay
+    PARSE_WORKERS = args.parse_workers # optional - defaults to parsing replayed requests in this process
+    COALESCE_WINDOW = args.coalesce_window # optional - defaults to writing every request
+    DEDUP_CACHE_SIZE = args.dedup_cache_size # optional - defaults to no dedup cache
+    DEDUP_TTL = args.dedup_ttl # optional - defaults to keeping entries until they are evicted
+    DEDUP_DB = args.dedup_db # optional - defaults to an in-memory cache
+    HEARTBEAT = args.heartbeat # optional - defaults to relying on the queue's visibility timeout
+    MAX_IDLE_BACKOFF = args.max_idle_backoff # optional - defaults to 5 seconds
+    MAX_RECEIVERS = args.max_receivers # optional - defaults to a single receiver
+    PROCESSES = args.processes # optional - defaults to processing in this process
+    NUMERIC_ATTRIBUTES = args.numeric_attributes # optional - defaults to storing every string as a string
+    SNAPSHOT_WRITE_INTERVAL = args.snapshot_interval # optional - defaults to writing snapshots every 30 seconds
+    COMPRESS_SNAPSHOTS = args.snapshot_compress # optional - defaults to uncompressed snapshots
+    METRICS_PORT = args.metrics_port # optional - defaults to no metrics endpoint
+    METRICS_HOST = args.metrics_host # optional - defaults to listening on localhost only
+    STATS_INTERVAL = args.stats_interval # optional - defaults to no periodic stats log
+    REQUEST_LOG_SAMPLE = args.request_log_sample # optional - defaults to logging every request
+    DEAD_LETTER = args.dead_letter # optional - defaults to logging requests that can never be processed
+    MAX_RETRIES = args.max_retries # optional - defaults to 4 retries
+    DIGEST_CACHE_SIZE = args.digest_cache_size # optional - defaults to writing every create and update
+    CHECK_DIGESTS = args.digest_check # optional - defaults to trusting only the digest cache
+    RATE_LIMIT = args.rate_limit # optional - defaults to writing as fast as the workers go
+    WRITE_RATE = args.write_rate # optional - defaults to no fixed ceiling per destination
+    OWNER_WRITE_RATE = args.owner_write_rate # optional - defaults to no fixed ceiling per owner
+    JSON_CODEC = args.json_codec # optional - defaults to orjson when it is installed, otherwise the standard library
+    CLAIM_CHECK_BUCKET = args.claim_check_bucket # optional - defaults to rejecting every claim-check pointer
+    CLIENT_SETTINGS = { # optional - connection pool, retry and timeout settings shared by every AWS client
+        "maxPoolConnections": args.max_pool_connections,
+        "retryMode": args.retry_mode,
+        "maxAttempts": args.max_attempts,
+        "connectTimeout": args.connect_timeout,
+        "readTimeout": args.read_timeout,
+        "tcpKeepalive": not args.no_keepalive,
+    }
 
-    main(REQUEST_SOURCE, REQUEST_DESTINATION, STORAGE_STRATEGY, QUEUE_URL)
\ No newline at end of file
+    main(REQUEST_SOURCE, REQUEST_DESTINATION, STORAGE_STRATEGY, QUEUE_URL, WORKERS, BATCH_ACKS, VISIBILITY_TIMEOUT, BATCH_WRITES, READ_AHEAD, REPLAY_PATH, PARSE_WORKERS, COALESCE_WINDOW,
+         DEDUP_CACHE_SIZE, DEDUP_TTL, DEDUP_DB, HEARTBEAT, MAX_IDLE_BACKOFF, MAX_RECEIVERS, PROCESSES,
+         NUMERIC_ATTRIBUTES, CLIENT_SETTINGS, SNAPSHOT_WRITE_INTERVAL, COMPRESS_SNAPSHOTS, METRICS_PORT, METRICS_HOST, STATS_INTERVAL,
+         REQUEST_LOG_SAMPLE, DEAD_LETTER, MAX_RETRIES, DIGEST_CACHE_SIZE, CHECK_DIGESTS, RATE_LIMIT, WRITE_RATE, OWNER_WRITE_RATE,
+         JSON_CODEC, CLAIM_CHECK_BUCKET)
\ No newline at end of file
@@ -0,0 +1,206 @@
+import json
+import time
+import heapq
+import random
+import logging
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# aws error codes that mean the request itself is wrong, so sending it again can never succeed
+PERMANENT_ERROR_CODES = {
+    "ValidationException", "SerializationException", "InvalidParameterValue", "InvalidParameterCombination",
+    "InvalidArgument", "InvalidRequest", "MalformedXML", "EntityTooLarge", "KeyTooLongError", "NoSuchKey",
+    "ItemCollectionSizeLimitExceededException",
+}
+# errors raised while parsing or shaping a request: bad json, missing fields, values of the wrong type that cannot be stored
+PERMANENT_ERROR_TYPES = (ValueError, TypeError, KeyError, AttributeError)
+PERMANENT_ERROR_NAMES = {"ParamValidationError"}
+
+class PermanentError(Exception):
+    # raised for a request that can never be processed as sent, such as one that fails validation
+    pass
+
+def IsPermanent(error):
+    # anything not known to be permanent (throttling, timeouts, 5xx, lost connections) is treated as transient
+    code = getattr(error, "response", {}).get("Error", {}).get("Code")
+    if code is not None:
+        return code in PERMANENT_ERROR_CODES
+    return isinstance(error, (PermanentError,) + PERMANENT_ERROR_TYPES) or type(error).__name__ in PERMANENT_ERROR_NAMES
+
+def DescribeError(error):
+    return f"{type(error).__name__}: {error}"
+
+class LocalDeadLetterSink:
+    # appends one json line per dead letter: when and where it failed, why, after how many attempts, and the original body
+    name = "file"
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def Send(self, body, reason, stage, attempts=1):
+        line = json.dumps({"failedAt": time.time(), "stage": stage, "reason": reason, "attempts": attempts, "body": body}, default=str)
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as file:
+                file.write(line + "\n")
+
+    def Close(self):
+        pass
+
+class SqsDeadLetterSink:
+    # sends the original body unchanged to a dead-letter queue, so it can be redriven once fixed; the failure is carried in
+    # message attributes
+    name = "queue"
+
+    def __init__(self, sqsClient, queueURL):
+        self.sqsClient = sqsClient
+        self.queueURL = queueURL
+
+    def Send(self, body, reason, stage, attempts=1):
+        self.sqsClient.send_message(
+            QueueUrl=self.queueURL,
+            MessageBody=body if isinstance(body, str) else json.dumps(body, default=str),
+            MessageAttributes={
+                "reason": {"DataType": "String", "StringValue": reason[:1024]},
+                "stage": {"DataType": "String", "StringValue": stage},
+                "attempts": {"DataType": "Number", "StringValue": str(attempts)},
+            }
+        )
+
+    def Close(self):
+        pass
+
+def OpenDeadLetterSink(target, sqsClient):
+    # an sqs queue url or a local file path
+    if target.startswith("https://sqs.") or target.startswith("http://"):
+        return SqsDeadLetterSink(sqsClient, target)
+    return LocalDeadLetterSink(target)
+
+class RetryQueue:
+    # retries transient failures with exponential backoff on threads of its own, so a failing write never holds up the
+    # receive loop or a worker. tasks stay in order per key (widgetId): while a key has a task waiting for a retry, later
+    # tasks for it queue behind it rather than overtaking it. attempt() raises on failure, and onFailure(error, attempts)
+    # runs once a task fails permanently or runs out of attempts
+    def __init__(self, maxAttempts=5, baseDelay=0.5, maxDelay=30, workers=2):
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.keys = {}  # key -> deque of [attempt, onFailure, attempts made]; the head is the one being retried
+        self.due = []  # heap of (dueAt, sequence, key)
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="retry")
+        self.stopped = False
+        self.thread = None
+        self.retried = 0
+
+    def Backoff(self, attempts):
+        return min(self.maxDelay, self.baseDelay * (2 ** (attempts - 1))) * random.uniform(0.5, 1.5)
+
+    def Run(self, key, attempt, onFailure, wait=False):
+        # makes the first attempt right away in the calling thread, unless the key already has tasks waiting. with wait,
+        # the retries also run here (for a source that cannot move on until the request is finished)
+        task = [attempt, onFailure, 0]
+        if wait:
+            while True:
+                error = self._Attempt(task)
+                if error is None:
+                    return
+                if not self._ShouldRetry(error, task):
+                    self._Fail(task, error)
+                    return
+                time.sleep(self.Backoff(task[2]))
+        with self.condition:
+            waiting = self.keys.get(key)
+            if waiting is not None:
+                waiting.append(task)
+                return
+        error = self._Attempt(task)
+        if error is None:
+            return
+        if not self._ShouldRetry(error, task):
+            self._Fail(task, error)
+            return
+        with self.condition:
+            waiting = self.keys.get(key)
+            if waiting is not None:
+                # another thread started retrying this key in the meantime; go after it
+                waiting.append(task)
+                return
+            self.keys[key] = deque([task])
+            self._Schedule(key, self.Backoff(task[2]))
+
+    def Pending(self):
+        with self.condition:
+            return sum(len(tasks) for tasks in self.keys.values())
+
+    def _Attempt(self, task):
+        task[2] += 1
+        try:
+            task[0]()
+        except Exception as e:
+            return e
+        return None
+
+    def _ShouldRetry(self, error, task):
+        return not IsPermanent(error) and task[2] < self.maxAttempts
+
+    def _Fail(self, task, error):
+        try:
+            task[1](error, task[2])
+        except Exception as e:
+            logging.error(f"Error handling a failed request: {e}")
+
+    def _Schedule(self, key, delay):
+        # called with the condition held
+        heapq.heappush(self.due, (time.monotonic() + delay, next(self.sequence), key))
+        self.condition.notify()
+
+    def _RunHead(self, key):
+        with self.condition:
+            task = self.keys[key][0]
+        error = self._Attempt(task)
+        with self.condition:
+            self.retried += 1
+            if error is not None and self._ShouldRetry(error, task):
+                self._Schedule(key, self.Backoff(task[2]))
+                return
+        if error is not None:
+            self._Fail(task, error)
+        with self.condition:
+            tasks = self.keys[key]
+            tasks.popleft()
+            if tasks:
+                # the next task for the key had been waiting its turn; it gets its first attempt now
+                self._Schedule(key, 0)
+            else:
+                del self.keys[key]
+
+    def _Run(self):
+        while True:
+            with self.condition:
+                while not self.stopped and (not self.due or self.due[0][0] > time.monotonic()):
+                    self.condition.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                if self.stopped:
+                    return
+                key = heapq.heappop(self.due)[2]
+            self.executor.submit(self._RunHead, key)
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="retry-scheduler", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        # retries still waiting are dropped; their messages were never acknowledged, so the source delivers them again
+        with self.condition:
+            self.stopped = True
+            abandoned = sum(len(tasks) for tasks in self.keys.values())
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.executor.shutdown(wait=True)
+        if abandoned:
+            logging.warning(f"Stopped with {abandoned} requests waiting for a retry; they will be delivered again")
@@ -0,0 +1,90 @@
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+# one byte per request type is appended to the 16-byte requestId, since producers have been seen reusing a requestId
+# for a create and the delete that follows it
+TYPE_CODES = {"create": b"c", "update": b"u", "delete": b"d"}
+
+class DedupCache:
+    # remembers the requestIds of recently completed requests so a redelivered message is not written twice. entries
+    # are held as compact bytes in an lru of at most maxEntries, optionally expiring after ttl seconds. with a path the
+    # cache is also kept in a local sqlite database and reloaded on start, so it survives restarts
+    def __init__(self, maxEntries=100000, ttl=None, path=None):
+        self.maxEntries = maxEntries
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> completedAt (wall clock, so it stays meaningful across restarts)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            # wal with normal sync keeps a commit per completed request cheap
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS completed (key BLOB PRIMARY KEY, completedAt REAL NOT NULL)")
+            self.connection.commit()
+            self._Load()
+
+    def _Load(self):
+        cutoff = time.time() - self.ttl if self.ttl else 0
+        rows = self.connection.execute(
+            "SELECT key, completedAt FROM completed WHERE completedAt >= ? ORDER BY completedAt DESC LIMIT ?", (cutoff, self.maxEntries)
+        ).fetchall()
+        for key, completedAt in reversed(rows):
+            self.entries[bytes(key)] = completedAt
+        logging.info(f"Loaded {len(rows)} completed request IDs from the dedup database")
+
+    @staticmethod
+    def GetKey(request):
+        try:
+            return uuid.UUID(request["requestId"]).bytes + TYPE_CODES.get(str(request.get("type", "")).lower(), b"?")
+        except (KeyError, TypeError, ValueError, AttributeError):
+            return None
+
+    def Seen(self, request):
+        key = self.GetKey(request)
+        if key is None:
+            return False
+        with self.lock:
+            completedAt = self.entries.get(key)
+            if completedAt is not None and self.ttl and time.time() - completedAt > self.ttl:
+                del self.entries[key]
+                completedAt = None
+            if completedAt is None:
+                self.misses += 1
+                return False
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return True
+
+    def Add(self, request):
+        key = self.GetKey(request)
+        if key is None:
+            return
+        now = time.time()
+        with self.lock:
+            self.entries[key] = now
+            self.entries.move_to_end(key)
+            evicted = []
+            while len(self.entries) > self.maxEntries:
+                evicted.append(self.entries.popitem(last=False)[0])
+            if self.connection:
+                self.connection.execute("INSERT OR REPLACE INTO completed (key, completedAt) VALUES (?, ?)", (key, now))
+                if evicted:
+                    self.connection.executemany("DELETE FROM completed WHERE key = ?", [(evictedKey,) for evictedKey in evicted])
+                self.connection.commit()
+
+    def Stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+    def Close(self):
+        if self.connection:
+            with self.lock:
+                self.connection.close()
+                self.connection = None
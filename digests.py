@@ -0,0 +1,62 @@
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# fields that change with every request but are not part of the widget's state; a re-sent update has a new requestId
+# (and may be a create rather than an update) yet leaves the stored widget as it was
+VOLATILE_FIELDS = ("type", "requestId")
+
+def WidgetDigest(widget):
+    # (digest, size) of the widget's canonical json, taken after otherAttributes have been flattened. keys are sorted
+    # so the same state always hashes the same way, whatever order the producer sent the attributes in
+    body = json.dumps({key: value for key, value in widget.items() if key not in VOLATILE_FIELDS},
+                      sort_keys=True, separators=(",", ":"), default=str).encode("utf-8")
+    return hashlib.blake2b(body, digest_size=16).hexdigest(), len(body)
+
+class DigestCache:
+    # remembers the digest of the last state written for each widget (least recently used first out) so a write of
+    # the same state can be skipped. a write in progress replaces the widget's digest with a token, and the new digest
+    # is only recorded if that token is still there when the write lands; a newer write (or a delete) that started in
+    # the meantime wins. it only knows about writes made through it, so it must be the only writer to the destination
+    def __init__(self, maxSize=100000):
+        self.maxSize = maxSize
+        self.digests = OrderedDict()  # widgetId -> digest, or the token of the write in progress
+        self.lock = threading.Lock()
+
+    def Writing(self, widgetId):
+        # whether a write or delete of the widget has started and not yet landed
+        with self.lock:
+            value = self.digests.get(widgetId)
+            return value is not None and not isinstance(value, str)
+
+    def Unchanged(self, widgetId, digest):
+        with self.lock:
+            if self.digests.get(widgetId) != digest:
+                return False
+            self.digests.move_to_end(widgetId)
+            return True
+
+    def Begin(self, widgetId):
+        token = object()
+        self._Set(widgetId, token)
+        return token
+
+    def Landed(self, widgetId, token, digest=None):
+        # digest is None once a delete has landed, or when a write failed and the stored widget is no longer known
+        with self.lock:
+            if self.digests.get(widgetId) is token:
+                if digest is None:
+                    del self.digests[widgetId]
+                else:
+                    self.digests[widgetId] = digest
+
+    def Remember(self, widgetId, digest):
+        self._Set(widgetId, digest)
+
+    def _Set(self, widgetId, value):
+        with self.lock:
+            self.digests[widgetId] = value
+            self.digests.move_to_end(widgetId)
+            while len(self.digests) > self.maxSize:
+                self.digests.popitem(last=False)
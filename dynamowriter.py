@@ -0,0 +1,165 @@
+import time
+import random
+import logging
+import threading
+from metrics import REGISTRY, BATCH_SIZE_BUCKETS, ShouldLogRequest
+from ratelimit import IsThrottle
+from deadletter import IsPermanent
+
+# batch_write_item accepts at most 25 put/delete requests per call
+MAX_BATCH_SIZE = 25
+
+class UnprocessedWriteError(Exception):
+    # passed to onFailure for a write dynamodb still had not processed after every attempt; it is transient, so the
+    # request is handed back to its source rather than dropped
+    pass
+
+def WriteRequestId(writeRequest):
+    if "PutRequest" in writeRequest:
+        return writeRequest["PutRequest"]["Item"]["id"]["S"]
+    return writeRequest["DeleteRequest"]["Key"]["id"]["S"]
+
+WRITE_BATCH_SIZE = REGISTRY.Histogram("consumer_dynamodb_batch_size", "Writes per batch_write_item batch", buckets=BATCH_SIZE_BUCKETS)
+
+class DynamoBatchWriter:
+    # groups widget puts and deletes into batch_write_item calls. writes for the same id that are still pending are
+    # collapsed to the last one (dynamodb rejects duplicate keys in one batch) and every callback waiting on that id
+    # runs once the surviving write has landed. if the writer gives up on a write, every onFailure(error, attempts)
+    # waiting on it runs instead, so the messages can be released rather than left in flight. a batch that fails with a
+    # permanent error (one bad item fails the whole call) is not retried but written one item at a time, so only the bad
+    # item fails, with its own error, and can be dead-lettered. onThrottle is called
+    # whenever dynamodb leaves items unprocessed or throttles the call, so a rate limiter can back off
+    def __init__(self, dynamoClient, tableName, maxDelay=0.2, maxAttempts=8, baseBackoff=0.05, onThrottle=None):
+        self.dynamoClient = dynamoClient
+        self.onThrottle = onThrottle
+        self.tableName = tableName
+        self.maxDelay = maxDelay
+        self.maxAttempts = maxAttempts
+        self.baseBackoff = baseBackoff
+        self.pending = {}  # id -> [writeRequest, callbacks, failure callbacks]
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def Put(self, item, onComplete=None, onFailure=None):
+        self._Add(item["id"]["S"], {"PutRequest": {"Item": item}}, onComplete, onFailure)
+
+    def Delete(self, widgetId, onComplete=None, onFailure=None):
+        self._Add(widgetId, {"DeleteRequest": {"Key": {"id": {"S": widgetId}}}}, onComplete, onFailure)
+
+    def _Add(self, widgetId, writeRequest, onComplete, onFailure=None):
+        with self.lock:
+            entry = self.pending.get(widgetId)
+            if entry:
+                # last writer wins; the superseded request's callback still waits for this write
+                entry[0] = writeRequest
+            else:
+                entry = self.pending[widgetId] = [writeRequest, [], []]
+            if onComplete:
+                entry[1].append(onComplete)
+            if onFailure:
+                entry[2].append(onFailure)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+            full = len(self.pending) >= MAX_BATCH_SIZE
+        if full:
+            self.Flush()
+
+    def Pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def Flush(self):
+        # flushes are serialised so a newer write for an id can never land before an older one
+        with self.flushLock:
+            with self.lock:
+                entries, self.pending, self.oldest = list(self.pending.values()), {}, None
+            for start in range(0, len(entries), MAX_BATCH_SIZE):
+                self._WriteBatch(entries[start:start + MAX_BATCH_SIZE])
+
+    def _WriteBatch(self, entries):
+        requestItems = {self.tableName: [entry[0] for entry in entries]}
+        WRITE_BATCH_SIZE.Observe(len(entries))
+        lastError, errors, attempts = None, {}, 0
+        for attempt in range(self.maxAttempts):
+            attempts = attempt + 1
+            try:
+                response = self.dynamoClient.batch_write_item(RequestItems=requestItems)
+                requestItems = response.get("UnprocessedItems") or {}
+                throttled = bool(requestItems)
+            except Exception as e:
+                logging.error(f"Error writing batch to DynamoDB: {e}")
+                if IsPermanent(e):
+                    errors = self._WriteEach(requestItems.get(self.tableName, []))
+                    requestItems = {}
+                    break
+                lastError = e
+                throttled = IsThrottle(e)
+            if throttled and self.onThrottle:
+                self.onThrottle()
+            if not requestItems:
+                break
+            # exponential backoff with jitter before resubmitting whatever dynamodb did not process
+            time.sleep(self.baseBackoff * (2 ** attempt) * random.uniform(0.5, 1.5))
+
+        # whatever is still unprocessed was throttled or failed transiently on every attempt
+        for writeRequest in requestItems.get(self.tableName, []):
+            widgetId = WriteRequestId(writeRequest)
+            errors[widgetId] = UnprocessedWriteError(f"DynamoDB did not process the write of widget {widgetId} after {attempts} attempts"
+                                                     + (f" (last error: {lastError})" if lastError else ""))
+
+        for writeRequest, callbacks, failures in entries:
+            widgetId = WriteRequestId(writeRequest)
+            if widgetId in errors:
+                # the callbacks never run, so the messages are not acknowledged; the failure callbacks release or
+                # dead-letter them
+                logging.error(f"Giving up on writing widget with ID {widgetId} to DynamoDB")
+                for failure in failures:
+                    try:
+                        failure(errors[widgetId], attempts)
+                    except Exception as e:
+                        logging.error(f"Error releasing widget with ID {widgetId}: {e}")
+                continue
+            if ShouldLogRequest():
+                logging.info(f"Widget with ID {widgetId} written to DynamoDB at {self.tableName}")
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f"Error acknowledging widget with ID {widgetId}: {e}")
+
+    def _WriteEach(self, writeRequests):
+        # returns widgetId -> error for the writes that failed on their own
+        errors = {}
+        for writeRequest in writeRequests:
+            try:
+                if "PutRequest" in writeRequest:
+                    self.dynamoClient.put_item(TableName=self.tableName, Item=writeRequest["PutRequest"]["Item"])
+                else:
+                    self.dynamoClient.delete_item(TableName=self.tableName, Key=writeRequest["DeleteRequest"]["Key"])
+            except Exception as e:
+                logging.error(f"Error writing widget with ID {WriteRequestId(writeRequest)} to DynamoDB: {e}")
+                errors[WriteRequestId(writeRequest)] = e
+        return errors
+
+    def _DueForFlush(self):
+        with self.lock:
+            return self.oldest is not None and time.monotonic() - self.oldest >= self.maxDelay
+
+    def _Run(self):
+        while not self.stopped.wait(self.maxDelay / 2):
+            if self._DueForFlush():
+                self.Flush()
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="dynamodb-writer", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.Flush()
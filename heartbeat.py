@@ -0,0 +1,105 @@
+import time
+import logging
+import threading
+
+# change_message_visibility_batch accepts at most 10 entries per call
+MAX_BATCH_SIZE = 10
+
+class VisibilityHeartbeat:
+    # keeps in-flight messages invisible while they are being processed. every message that is still in flight when
+    # half of its visibility has been used up gets its visibility extended with change_message_visibility_batch.
+    # messages that cannot be processed are released right away (visibility 0) so they are retried quickly
+    def __init__(self, sqsClient, queueURL, visibilityTimeout=30, maxAge=900):
+        self.sqsClient = sqsClient
+        self.queueURL = queueURL
+        self.visibilityTimeout = visibilityTimeout
+        # a message that has been in flight this long is no longer extended, so a stuck write cannot hold it forever
+        self.maxAge = maxAge
+        self.inFlight = {}  # receiptHandle -> [receivedAt, visibleAt]
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.extended = 0
+        self.released = 0
+
+    def Track(self, receiptHandle, receivedAt=None):
+        receivedAt = receivedAt if receivedAt is not None else time.monotonic()
+        with self.lock:
+            self.inFlight[receiptHandle] = [receivedAt, receivedAt + self.visibilityTimeout]
+
+    def Done(self, receiptHandle):
+        with self.lock:
+            self.inFlight.pop(receiptHandle, None)
+
+    def InFlight(self):
+        with self.lock:
+            return len(self.inFlight)
+
+    def Release(self, receiptHandles):
+        with self.lock:
+            for receiptHandle in receiptHandles:
+                self.inFlight.pop(receiptHandle, None)
+        failed = self._ChangeVisibility(receiptHandles, 0)
+        with self.lock:
+            self.released += len(receiptHandles) - len(failed)
+
+    def Beat(self):
+        now = time.monotonic()
+        due = []
+        with self.lock:
+            for receiptHandle, (receivedAt, visibleAt) in list(self.inFlight.items()):
+                if now - receivedAt >= self.maxAge:
+                    logging.warning("Message has been in flight too long; no longer extending its visibility")
+                    del self.inFlight[receiptHandle]
+                elif visibleAt - now <= self.visibilityTimeout / 2:
+                    due.append(receiptHandle)
+        if not due:
+            return
+        failed = set(self._ChangeVisibility(due, self.visibilityTimeout))
+        visibleAt = time.monotonic() + self.visibilityTimeout
+        with self.lock:
+            for receiptHandle in due:
+                entry = self.inFlight.get(receiptHandle)
+                if entry is None:
+                    continue
+                if receiptHandle in failed:
+                    # the handle is no longer valid (the message was deleted or has already been redelivered)
+                    del self.inFlight[receiptHandle]
+                else:
+                    entry[1] = visibleAt
+                    self.extended += 1
+
+    def _ChangeVisibility(self, receiptHandles, visibilityTimeout):
+        # returns the receipt handles that could not be changed
+        failed = []
+        for start in range(0, len(receiptHandles), MAX_BATCH_SIZE):
+            batch = receiptHandles[start:start + MAX_BATCH_SIZE]
+            try:
+                response = self.sqsClient.change_message_visibility_batch(
+                    QueueUrl=self.queueURL,
+                    Entries=[{'Id': str(i), 'ReceiptHandle': receiptHandle, 'VisibilityTimeout': visibilityTimeout} for i, receiptHandle in enumerate(batch)]
+                )
+            except Exception as e:
+                logging.error(f"Error changing message visibility: {e}")
+                failed.extend(batch)
+                continue
+            for failure in response.get('Failed', []):
+                logging.warning(f"Failed to change message visibility: {failure.get('Code')} {failure.get('Message', '')}")
+                failed.append(batch[int(failure['Id'])])
+        return failed
+
+    def _Run(self):
+        # beat often enough that no message gets closer than a third of its timeout to becoming visible
+        interval = max(self.visibilityTimeout / 6, 0.05)
+        while not self.stopped.wait(interval):
+            self.Beat()
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="visibility-heartbeat", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
@@ -1,7 +1,20 @@
+import os
 import json
-import boto3
-import re
 import logging
+from clients import GetClient
+from validation import ValidateRequest
+from claimcheck import Offload, POINTER_KEY
+
+QUEUE_URL = 'https://sqs.us-east-1.amazonaws.com/487854293488/cs5260-requests'
+
+# send_message_batch accepts at most 10 entries and 256 KB of message bodies per call
+MAX_BATCH_ENTRIES = 10
+MAX_BATCH_BYTES = 256 * 1024
+
+# requests whose json is larger than the threshold are written to this bucket and sent as a pointer message;
+# leave CLAIM_CHECK_BUCKET unset to send every request inline
+CLAIM_CHECK_BUCKET = os.environ.get('CLAIM_CHECK_BUCKET')
+CLAIM_CHECK_THRESHOLD = int(os.environ.get('CLAIM_CHECK_THRESHOLD', 200 * 1024))
 
 # logFile = 'lambda_function.log'
 logging.basicConfig(
@@ -14,16 +27,20 @@ def lambda_handler(event, context):
     try:
         request_data = event
 
+        # a list of requests is validated and sent in batches, with a result for each request
+        if isinstance(request_data, list):
+            return handle_batch(request_data, QUEUE_URL)
+
         # validate the request data
-        if not validate_request(request_data):
+        errors = check_request(request_data)
+        if errors:
             return {
                 'statusCode': 400,
-                'body': json.dumps({'message': 'Invalid request data'})
+                'body': json.dumps({'message': 'Invalid request data', 'errors': errors})
             }
 
         # send the response to my SQS
-        queue_url = 'https://sqs.us-east-1.amazonaws.com/487854293488/cs5260-requests'
-        sqs_response = send_to_sqs(request_data, queue_url)
+        sqs_response = send_to_sqs(request_data, QUEUE_URL)
         return sqs_response
         
     except Exception as e:
@@ -33,44 +50,95 @@ def lambda_handler(event, context):
             'body': json.dumps({'message': f'Error occurred: {str(e)}'})
         }
 
+def check_request(data):
+    # a request carrying its own claim check would reach the consumer looking like a pointer, so it is refused
+    errors = ValidateRequest(data)
+    if isinstance(data, dict) and POINTER_KEY in data:
+        errors.append({'field': POINTER_KEY, 'error': 'is reserved for claim-check pointers'})
+    return errors
+
 def validate_request(data):
-    # Check required fields
-    required_fields = ['type', 'requestId', 'widgetId', 'owner', 'label', 'description', 'otherAttributes']
-    for field in required_fields:
-        if field not in data:
-            return False
-
-    # Check if fields are non-empty strings
-    for field in ['type', 'requestId', 'widgetId', 'owner', 'label', 'description']:
-        if not isinstance(data[field], str) or not data[field].strip():
-            return False
-
-    # Check for valid types
-    valid_types = ['create', 'update', 'delete']
-    if data['type'].lower() not in valid_types:
-        return False
-
-    # Check UUID format for requestId and widgetId
-    uuid_regex = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[1-5][0-9a-f]{3}-[89ab][0-9a-f]{3}-[0-9a-f]{12}\Z', re.I)
-    if not re.match(uuid_regex, data['requestId']) or not re.match(uuid_regex, data['widgetId']):
-        return False
-
-    # Validate otherAttributes structure
-    if not isinstance(data['otherAttributes'], list):
-        return False
-    for attr in data['otherAttributes']:
-        if not (isinstance(attr, dict) and 'name' in attr and 'value' in attr):
-            return False
-        if not (isinstance(attr['name'], str) and attr['name'].strip() and 
-                isinstance(attr['value'], str) and attr['value'].strip()):
-            return False
-
-    return True
+    return not check_request(data)
+
+def prepare_body(data):
+    body = json.dumps(data)
+    if CLAIM_CHECK_BUCKET and len(body.encode('utf-8')) > CLAIM_CHECK_THRESHOLD:
+        return Offload(GetClient('s3'), CLAIM_CHECK_BUCKET, data, body)
+    return body
 
 def send_to_sqs(data, queue_url):
-    sqs = boto3.client('sqs')
+    # the client is created on the first invocation and reused while the lambda stays warm
+    sqs = GetClient('sqs')
     response = sqs.send_message(
         QueueUrl=queue_url,
-        MessageBody=json.dumps(data)
+        MessageBody=prepare_body(data)
     )
     return response
+
+def handle_batch(requests, queue_url):
+    results = [None] * len(requests)
+    bodies = {}
+    for index, errors in enumerate(map(check_request, requests)):
+        if errors:
+            results[index] = {'index': index, 'status': 'invalid', 'errors': errors}
+            continue
+        try:
+            bodies[index] = prepare_body(requests[index])
+        except Exception as e:
+            logging.error(f"Error offloading request to S3: {str(e)}")
+            results[index] = {'index': index, 'status': 'failed', 'error': str(e)}
+
+    for index, outcome in send_batch_to_sqs(bodies, queue_url).items():
+        results[index] = dict({'index': index}, **outcome)
+
+    queued = sum(1 for result in results if result['status'] == 'queued')
+    logging.info(f"Queued {queued} of {len(requests)} requests")
+    return {
+        # 207 tells the caller to look at the individual results
+        'statusCode': 200 if queued == len(requests) else 207,
+        'body': json.dumps({'queued': queued, 'failed': len(requests) - queued, 'results': results})
+    }
+
+def group_batches(bodies):
+    # packs (index, body) pairs into batches of at most MAX_BATCH_ENTRIES entries and MAX_BATCH_BYTES bytes;
+    # bodies that could never fit are returned separately
+    batches, too_large = [], []
+    batch, batch_bytes = [], 0
+    for index, body in bodies.items():
+        size = len(body.encode('utf-8'))
+        if size > MAX_BATCH_BYTES:
+            too_large.append(index)
+            continue
+        if len(batch) == MAX_BATCH_ENTRIES or batch_bytes + size > MAX_BATCH_BYTES:
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append((index, body))
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches, too_large
+
+def send_batch_to_sqs(bodies, queue_url):
+    # bodies maps request index -> message body; returns request index -> {'status', 'messageId' or 'error'}
+    sqs = GetClient('sqs')
+    batches, too_large = group_batches(bodies)
+    outcomes = {index: {'status': 'failed', 'error': f'message is larger than {MAX_BATCH_BYTES} bytes'} for index in too_large}
+    for batch in batches:
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=queue_url,
+                Entries=[{'Id': str(index), 'MessageBody': body} for index, body in batch]
+            )
+        except Exception as e:
+            logging.error(f"Error sending batch to SQS: {str(e)}")
+            for index, _ in batch:
+                outcomes[index] = {'status': 'failed', 'error': str(e)}
+            continue
+        for success in response.get('Successful', []):
+            outcomes[int(success['Id'])] = {'status': 'queued', 'messageId': success['MessageId']}
+        for failure in response.get('Failed', []):
+            outcomes[int(failure['Id'])] = {'status': 'failed', 'error': f"{failure.get('Code')}: {failure.get('Message', '')}"}
+        # an entry missing from both lists was not confirmed, so the caller should retry it
+        for index, _ in batch:
+            outcomes.setdefault(index, {'status': 'failed', 'error': 'no result from SQS'})
+    return outcomes
@@ -0,0 +1,240 @@
+import bisect
+import random
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; spans a cache hit through a slow aws round trip
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+# fraction of per-request info logs that are written; set with SetRequestLogSampleRate
+REQUEST_LOG_SAMPLE_RATE = 1.0
+
+def SetRequestLogSampleRate(rate):
+    global REQUEST_LOG_SAMPLE_RATE
+    REQUEST_LOG_SAMPLE_RATE = max(0.0, min(1.0, rate))
+
+def ShouldLogRequest():
+    # check this before building a per-request log message, so skipped messages cost no formatting
+    return REQUEST_LOG_SAMPLE_RATE >= 1.0 or (REQUEST_LOG_SAMPLE_RATE > 0.0 and random.random() < REQUEST_LOG_SAMPLE_RATE)
+
+def FormatLabels(labelNames, labelValues, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(labelNames, labelValues)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    # a monotonically increasing count per combination of label values (passed positionally, in labelNames order)
+    kind = "counter"
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def Inc(self, *labelValues, amount=1):
+        with self.lock:
+            self.values[labelValues] = self.values.get(labelValues, 0) + amount
+
+    def Get(self, *labelValues):
+        with self.lock:
+            return self.values.get(labelValues, 0)
+
+    def Samples(self):
+        with self.lock:
+            return [(self.name, FormatLabels(self.labelNames, labels), value) for labels, value in sorted(self.values.items())]
+
+class Gauge(Counter):
+    # a value that goes up and down; with a function set, the value is read from it when the metrics are rendered
+    kind = "gauge"
+
+    def __init__(self, name, help, labelNames=(), function=None):
+        super().__init__(name, help, labelNames)
+        self.function = function
+
+    def Set(self, value, *labelValues):
+        with self.lock:
+            self.values[labelValues] = value
+
+    def Dec(self, *labelValues, amount=1):
+        self.Inc(*labelValues, amount=-amount)
+
+    def SetFunction(self, function):
+        self.function = function
+
+    def Samples(self):
+        if self.function:
+            try:
+                return [(self.name, "", self.function())]
+            except Exception as e:
+                logging.warning(f"Error reading gauge {self.name}: {e}")
+                return []
+        return super().Samples()
+
+class Histogram:
+    # counts observations into cumulative buckets and keeps their sum, per combination of label values
+    kind = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [per-bucket counts (last is +Inf), sum, count]
+        self.lock = threading.Lock()
+
+    def Observe(self, value, *labelValues):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labelValues)
+            if entry is None:
+                entry = self.values[labelValues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def Count(self, *labelValues):
+        with self.lock:
+            entry = self.values.get(labelValues)
+            return entry[2] if entry else 0
+
+    def Samples(self):
+        samples = []
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucketCount in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += bucketCount
+                    samples.append((f"{self.name}_bucket", FormatLabels(self.labelNames, labels, f'le="{bound}"'), cumulative))
+                samples.append((f"{self.name}_sum", FormatLabels(self.labelNames, labels), total))
+                samples.append((f"{self.name}_count", FormatLabels(self.labelNames, labels), count))
+        return samples
+
+    def Summary(self):
+        # label values -> (count, mean, approximate p99 taken from the bucket bounds)
+        summary = {}
+        with self.lock:
+            for labels, (counts, total, count) in self.values.items():
+                target, cumulative, p99 = count * 0.99, 0, float("inf")
+                for bound, bucketCount in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucketCount
+                    if cumulative >= target:
+                        p99 = bound
+                        break
+                summary[labels] = (count, total / count if count else 0.0, p99)
+        return summary
+
+class MetricsRegistry:
+    # metrics are registered once by name; asking for an existing name returns the metric already registered
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def _Register(self, metricClass, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = metricClass(name, *args, **kwargs)
+            return metric
+
+    def Counter(self, name, help, labelNames=()):
+        return self._Register(Counter, name, help, labelNames)
+
+    def Gauge(self, name, help, labelNames=(), function=None):
+        return self._Register(Gauge, name, help, labelNames, function)
+
+    def Histogram(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        return self._Register(Histogram, name, help, labelNames, buckets)
+
+    def Render(self):
+        # the prometheus text exposition format
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.Samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+    def Dump(self):
+        # one compact line per metric, for the periodic stats log
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            if isinstance(metric, Histogram):
+                for labels, (count, mean, p99) in sorted(metric.Summary().items()):
+                    lines.append(f"{metric.name}{FormatLabels(metric.labelNames, labels)} count={count} mean={mean:.4g} p99<={p99:g}")
+            else:
+                for name, labels, value in metric.Samples():
+                    lines.append(f"{name}{labels}={value}")
+        return lines
+
+REGISTRY = MetricsRegistry()
+
+class MetricsServer:
+    # serves REGISTRY.Render() at /metrics from a daemon thread
+    def __init__(self, port, host="127.0.0.1", registry=None):
+        registry = registry or REGISTRY
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.Render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def Start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        logging.info(f"Serving metrics at http://{self.server.server_address[0]}:{self.port}/metrics")
+        return self
+
+    def Stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread:
+            self.thread.join()
+
+class StatsDumper:
+    # logs REGISTRY.Dump() every interval seconds
+    def __init__(self, interval, registry=None, prefix="Stats"):
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self.prefix = prefix
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _Run(self):
+        while not self.stopped.wait(self.interval):
+            logging.info(f"{self.prefix}: " + "; ".join(self.registry.Dump()))
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="stats-dumper", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
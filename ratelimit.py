@@ -0,0 +1,133 @@
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+# error codes aws answers with when a caller is going faster than the destination's capacity
+THROTTLE_ERROR_CODES = {
+    "ProvisionedThroughputExceededException", "ThrottlingException", "Throttling", "RequestLimitExceeded",
+    "SlowDown", "TooManyRequestsException", "RequestThrottled", "RequestThrottledException",
+}
+
+def IsThrottle(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+
+class TokenBucket:
+    # a token bucket whose rate adapts to throttling (aimd). each throttle cuts the rate by `decrease`, at most once per
+    # cooldown since one overshoot usually comes back as a burst of throttles. while callers keep the bucket empty the
+    # rate climbs back by `increase` per second: quickly up to 90% of the rate that was last throttled, then slowly up to
+    # that rate, so it settles just under the capacity instead of swinging around it, then quickly again past it in case
+    # the capacity has grown. with no rate the bucket is unlimited until the first throttle, which starts it from the
+    # throughput measured over the last second
+    def __init__(self, rate=None, maxRate=None, minRate=1.0, decrease=0.7, increase=None, cooldown=1.0, burstSeconds=0.1, clock=time.monotonic):
+        self.rate = rate
+        self.maxRate = maxRate if maxRate is not None else rate
+        self.minRate = minRate
+        self.decrease = decrease
+        self.increase = increase
+        self.cooldown = cooldown
+        self.burstSeconds = burstSeconds
+        self.clock = clock
+        now = clock()
+        self.tokens = self._Burst() if rate else 0.0
+        self.updatedAt = now
+        self.increasedAt = now
+        self.step = increase or (rate * 0.05 if rate else 0.0)
+        self.ceiling = None  # the rate at the last throttle
+        self.lastThrottle = None
+        self.windowStart, self.windowCount, self.lastWindowRate = now, 0, 0.0
+        self.throttles = 0
+        self.lock = threading.Lock()
+
+    def _Burst(self):
+        return max(1.0, self.rate * self.burstSeconds)
+
+    def _Measure(self, now):
+        elapsed = now - self.windowStart
+        if elapsed >= 1.0:
+            self.lastWindowRate = self.windowCount / elapsed
+            self.windowStart, self.windowCount = now, 0
+        self.windowCount += 1
+
+    def _Increase(self, now):
+        if self.lastThrottle is not None and now - self.lastThrottle < self.cooldown:
+            return
+        # slow down only just under the last throttled rate; past it the capacity has evidently grown
+        step = self.step * 0.1 if self.ceiling is not None and 0.9 * self.ceiling <= self.rate < self.ceiling else self.step
+        self.rate += step * min(now - self.increasedAt, 1.0)
+        if self.maxRate is not None:
+            self.rate = min(self.rate, self.maxRate)
+
+    def Reserve(self):
+        # takes a token and returns how long to wait before using it; the bucket may go into debt, which later callers
+        # wait out in turn, so callers queue fairly without polling
+        with self.lock:
+            now = self.clock()
+            self._Measure(now)
+            if self.rate is None:
+                return 0.0
+            self.tokens = min(self._Burst(), self.tokens + (now - self.updatedAt) * self.rate)
+            self.updatedAt = now
+            if self.tokens < 1:
+                self._Increase(now)
+            if self.tokens < 1 or self.tokens >= self._Burst():
+                # time with the bucket full is not time spent at the limit, so it does not count towards an increase
+                self.increasedAt = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def Throttled(self):
+        with self.lock:
+            now = self.clock()
+            self.throttles += 1
+            if self.lastThrottle is not None and now - self.lastThrottle < self.cooldown:
+                return self.rate
+            self.lastThrottle = now
+            current = self.rate if self.rate is not None else max(self.lastWindowRate, self.windowCount / max(now - self.windowStart, 1e-3))
+            self.ceiling = current
+            self.rate = max(self.minRate, current * self.decrease)
+            self.step = self.increase or max(self.minRate, self.rate * 0.05)
+            self.tokens = min(self.tokens, self._Burst())
+            self.increasedAt = now
+            return self.rate
+
+class AdaptiveRateLimiter:
+    # one TokenBucket per key (a destination, or one owner prefix of a destination), created on first use. the least
+    # recently used keys are dropped past maxKeys
+    def __init__(self, rate=None, maxKeys=10000, sleep=time.sleep, **bucketSettings):
+        self.rate = rate
+        self.maxKeys = maxKeys
+        self.sleep = sleep
+        self.bucketSettings = bucketSettings
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def Bucket(self, key):
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(self.rate, **self.bucketSettings)
+                while len(self.buckets) > self.maxKeys:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+            return bucket
+
+    def Acquire(self, key):
+        # blocks until the write may go ahead and returns how long that took
+        delay = self.Bucket(key).Reserve()
+        if delay > 0:
+            self.sleep(delay)
+        return delay
+
+    def Throttled(self, key):
+        previous = self.Bucket(key).rate
+        rate = self.Bucket(key).Throttled()
+        if rate != previous:
+            logging.warning(f"Writes to {key} are being throttled; slowing down to {rate:.1f} per second")
+        return rate
+
+    def LowestRate(self):
+        with self.lock:
+            rates = [bucket.rate for bucket in self.buckets.values() if bucket.rate is not None]
+        return min(rates) if rates else 0.0
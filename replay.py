@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import logging
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from codec import Loads
+
+try:
+    import resource
+except ImportError:  # not available on windows
+    resource = None
+
+# ---- READ REQUESTS FROM DISK ----
+def ReadRawRequests(path):
+    # a directory holds one request per file (numeric names, replayed in numeric order); anything else is read as jsonl
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path), key=lambda name: (len(name), name)):
+            with open(os.path.join(path, filename), 'rb') as file:
+                yield file.read()
+    else:
+        with open(path, 'rb') as file:
+            for line in file:
+                if line.strip():
+                    yield line
+
+def ParseRequest(raw):
+    try:
+        request = Loads(raw)
+    except ValueError:
+        return None
+    return request if isinstance(request, dict) else None
+
+def Chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def Percentile(sortedValues, percent):
+    if not sortedValues:
+        return 0.0
+    index = min(len(sortedValues) - 1, int(round(percent / 100 * (len(sortedValues) - 1))))
+    return sortedValues[index]
+
+def PeakRssMB():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macOS reports bytes
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+# ---- REPLAY PIPELINE ----
+def Replay(path, handleBatch, batchSize=25, parseWorkers=1, chunkSize=1000):
+    # streams requests from path through handleBatch(requests) in batches. files are read and parsed a chunk at a time
+    # (in parseWorkers processes when > 1), so memory stays bounded no matter how large the input is
+    executor = ProcessPoolExecutor(max_workers=parseWorkers) if parseWorkers > 1 else None
+    latencies = []
+    processed = skipped = failed = 0
+    start = time.perf_counter()
+    try:
+        for chunk in Chunks(ReadRawRequests(path), chunkSize):
+            readAt = time.perf_counter()
+            if executor:
+                parsed = executor.map(ParseRequest, chunk, chunksize=max(1, len(chunk) // (parseWorkers * 4)))
+            else:
+                parsed = map(ParseRequest, chunk)
+            requests = []
+            for request in parsed:
+                if request is None:
+                    skipped += 1
+                else:
+                    requests.append(request)
+
+            for batch in Chunks(requests, batchSize):
+                try:
+                    handleBatch(batch)
+                    processed += len(batch)
+                except Exception as e:
+                    logging.error(f"Error replaying batch of {len(batch)} requests: {e}")
+                    failed += len(batch)
+                    continue
+                # latency is measured from the moment the request's chunk was read until its batch was written
+                finishedAt = time.perf_counter()
+                latencies.extend([finishedAt - readAt] * len(batch))
+    finally:
+        if executor:
+            executor.shutdown()
+
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": processed,
+        "skipped": skipped,
+        "failed": failed,
+        "seconds": elapsed,
+        "requestsPerSecond": processed / elapsed if elapsed else 0.0,
+        "p50LatencyMs": Percentile(latencies, 50) * 1000,
+        "p99LatencyMs": Percentile(latencies, 99) * 1000,
+        "peakRssMB": PeakRssMB(),
+    }
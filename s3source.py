@@ -0,0 +1,132 @@
+import time
+import logging
+import threading
+from codec import LoadRequest
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from metrics import REGISTRY, ShouldLogRequest
+
+# delete_objects accepts at most 1000 keys per call
+MAX_DELETE_BATCH = 1000
+
+# the consumer's own metrics, registered under the same names, so this source fills the same per-stage histograms
+STAGE_SECONDS = REGISTRY.Histogram("consumer_stage_seconds", "Time spent in each stage of the pipeline", ("stage",))
+ERRORS = REGISTRY.Counter("consumer_errors_total", "Errors by stage and exception type", ("stage", "exception"))
+
+class S3RequestSource:
+    # streams requests out of a bucket: keys are listed a page at a time, object bodies are fetched concurrently into a
+    # bounded read-ahead buffer, and processed keys are removed in bulk with delete_objects. a key that fails to load, or
+    # whose request is released after failing, is picked up again by listing from the start once retryDelay has passed
+    def __init__(self, s3Client, bucket, pageSize=1000, readAhead=32, fetchWorkers=8, retryDelay=5.0):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.pageSize = pageSize
+        self.readAhead = readAhead
+        self.executor = ThreadPoolExecutor(max_workers=fetchWorkers, thread_name_prefix="s3-prefetch")
+        # keys are only ever listed after the last one we handed out, so in-flight keys are not fetched twice
+        self.lastKey = None
+        self.doneKeys = []
+        # keys handed out and not yet deleted or released; a listing from the start skips them
+        self.handedOut = set()
+        self.retryDelay = retryDelay
+        self.relistAt = None
+        self.lock = threading.Lock()
+
+    def _ListKeys(self):
+        kwargs = {"Bucket": self.bucket, "MaxKeys": self.pageSize}
+        if self.lastKey:
+            kwargs["StartAfter"] = self.lastKey
+        while True:
+            start = time.perf_counter()
+            response = self.s3Client.list_objects_v2(**kwargs)
+            STAGE_SECONDS.Observe(time.perf_counter() - start, "receive")
+            # keys are numeric with the same number of digits, so sorting by (length, key) keeps numeric order
+            for key in sorted((item["Key"] for item in response.get("Contents", [])), key=lambda key: (len(key), key)):
+                yield key
+            if not response.get("IsTruncated"):
+                return
+            kwargs.pop("StartAfter", None)
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def _Fetch(self, key):
+        start = time.perf_counter()
+        myObject = self.s3Client.get_object(Bucket=self.bucket, Key=key)
+        body = myObject["Body"].read()
+        parseStart = time.perf_counter()
+        STAGE_SECONDS.Observe(parseStart - start, "receive")
+        request = LoadRequest(body)
+        STAGE_SECONDS.Observe(time.perf_counter() - parseStart, "parse")
+        return request
+
+    def Requests(self):
+        # yields (request, key) in key order until the bucket is drained; requests that fail to load are logged and
+        # released, so a later pass lists them again
+        with self.lock:
+            if self.relistAt is not None and time.monotonic() >= self.relistAt:
+                self.lastKey, self.relistAt = None, None
+            skipped = set(self.handedOut)
+        inFlight = deque()
+        keys = (key for key in self._ListKeys() if key not in skipped)
+        while True:
+            while len(inFlight) < self.readAhead:
+                key = next(keys, None)
+                if key is None:
+                    break
+                with self.lock:
+                    self.handedOut.add(key)
+                inFlight.append((key, self.executor.submit(self._Fetch, key)))
+            if not inFlight:
+                return
+            key, future = inFlight.popleft()
+            if self.lastKey is None or (len(key), key) > (len(self.lastKey), self.lastKey):
+                self.lastKey = key
+            try:
+                request = future.result()
+            except Exception as e:
+                ERRORS.Inc("receive", type(e).__name__)
+                logging.error(f"Error retrieving request with key {key}: {e}")
+                self.Release(key)
+                continue
+            if ShouldLogRequest():
+                logging.info(f"Request with key {key} retrieved.")
+            yield request, key
+
+    def Release(self, key):
+        # the key's request was not processed; it stays in the bucket and is listed again after retryDelay
+        with self.lock:
+            self.handedOut.discard(key)
+            if self.relistAt is None:
+                self.relistAt = time.monotonic() + self.retryDelay
+
+    def MarkDone(self, key):
+        with self.lock:
+            self.doneKeys.append(key)
+            full = len(self.doneKeys) >= MAX_DELETE_BATCH
+        if full:
+            self.Flush()
+
+    def Flush(self):
+        with self.lock:
+            keys, self.doneKeys = self.doneKeys, []
+        for start in range(0, len(keys), MAX_DELETE_BATCH):
+            batch = keys[start:start + MAX_DELETE_BATCH]
+            try:
+                start = time.perf_counter()
+                response = self.s3Client.delete_objects(
+                    Bucket=self.bucket,
+                    Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True}
+                )
+                STAGE_SECONDS.Observe(time.perf_counter() - start, "ack")
+                for error in response.get("Errors", []):
+                    logging.error(f"Error deleting request with key {error.get('Key')}: {error.get('Message')}")
+                logging.info(f"Deleted {len(batch) - len(response.get('Errors', []))} requests from {self.bucket}")
+            except Exception as e:
+                ERRORS.Inc("ack", type(e).__name__)
+                logging.error(f"Error deleting requests from {self.bucket}: {e}")
+            # a key whose delete failed is processed again when it is next listed
+            with self.lock:
+                self.handedOut.difference_update(batch)
+
+    def Close(self):
+        self.Flush()
+        self.executor.shutdown()
@@ -0,0 +1,86 @@
+import math
+import random
+import logging
+import threading
+
+class ReceiveScheduler:
+    # decides how long to wait before the next receive, and for a queue how long that receive may long-poll. with a
+    # batchSize, only a full batch means more work is waiting: the next receive goes right away with a short poll, while
+    # after a partial batch it pauses for a fraction of baseDelay (the emptier the batch, the longer) so the next batch
+    # is fuller. without one, any work means receiving again right away. while the source stays empty the delay grows
+    # exponentially with full jitter (capped at maxDelay), and the time the empty receive already spent long-polling
+    # counts towards it, so a 20 second long poll is not followed by a sleep as well
+    def __init__(self, baseDelay=0.1, maxDelay=5.0, rng=None, batchSize=None, minWait=1, maxWait=20):
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.rng = rng or random.Random()
+        self.batchSize = batchSize
+        self.minWait = minWait
+        self.maxWait = maxWait
+        self.waitTime = maxWait
+        self.idleReceives = 0
+
+    def WaitTime(self):
+        # WaitTimeSeconds for the next receive
+        return self.waitTime
+
+    def Next(self, received, waited=0.0):
+        if received:
+            self.idleReceives = 0
+            if self.batchSize is None or received >= self.batchSize:
+                self.waitTime = self.minWait
+                return 0.0
+            self.waitTime = self.maxWait
+            return self.baseDelay * (1 - received / self.batchSize)
+        self.idleReceives += 1
+        self.waitTime = self.maxWait
+        # cap the exponent so a long idle stretch cannot overflow the float
+        ceiling = min(self.maxDelay, self.baseDelay * (2 ** min(self.idleReceives - 1, 30)))
+        return max(0.0, self.rng.uniform(0, ceiling) - waited)
+
+class ReceiverScaler:
+    # polls ApproximateNumberOfMessages and decides how many concurrent receivers should be pulling from the queue:
+    # one per messagesPerReceiver waiting messages, between 1 and maxReceivers. receiver 0 is always active
+    def __init__(self, sqsClient, queueURL, maxReceivers, messagesPerReceiver=100, interval=10):
+        self.sqsClient = sqsClient
+        self.queueURL = queueURL
+        self.maxReceivers = maxReceivers
+        self.messagesPerReceiver = messagesPerReceiver
+        self.interval = interval
+        self.active = 1
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def Desired(self, depth):
+        return max(1, min(self.maxReceivers, math.ceil(depth / self.messagesPerReceiver)))
+
+    def Poll(self):
+        try:
+            response = self.sqsClient.get_queue_attributes(QueueUrl=self.queueURL, AttributeNames=['ApproximateNumberOfMessages'])
+            depth = int(response['Attributes']['ApproximateNumberOfMessages'])
+        except Exception as e:
+            logging.error(f"Error reading queue depth: {e}")
+            return self.active
+        desired = self.Desired(depth)
+        if desired != self.active:
+            logging.info(f"Queue depth is {depth}; scaling from {self.active} to {desired} receivers")
+            self.active = desired
+        return self.active
+
+    def IsActive(self, index):
+        return index < self.active
+
+    def _Run(self):
+        self.Poll()
+        while not self.stopped.wait(self.interval):
+            self.Poll()
+
+    def Start(self):
+        self.thread = threading.Thread(target=self._Run, name="receiver-scaler", daemon=True)
+        self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
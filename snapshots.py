@@ -0,0 +1,263 @@
+import gzip
+import logging
+import threading
+from codec import Loads, Dumps
+from storage import WidgetStore, GetOwnerPrefix
+
+# layout under the bucket:
+#   snapshots/{owner}/index.json                  the owner's current snapshot and where each widget sits in it
+#   snapshots/{owner}/{generation}.jsonl[.gz]     every live widget of the owner, one json document per line
+SNAPSHOT_PREFIX = "snapshots/"
+# snapshots kept per owner; the one before the current stays around for readers still holding the older index
+KEPT_SNAPSHOTS = 2
+
+def GetIndexKey(owner):
+    return f"{SNAPSHOT_PREFIX}{GetOwnerPrefix(owner)}/index.json"
+
+def GetSnapshotKey(owner, generation, compress):
+    return f"{SNAPSHOT_PREFIX}{GetOwnerPrefix(owner)}/{generation:010d}.jsonl" + (".gz" if compress else "")
+
+def IsMissing(error):
+    return getattr(error, "response", {}).get("Error", {}).get("Code") in ("NoSuchKey", "404", "NotFound")
+
+class SnapshotReader:
+    # reads the compacted layout written by S3SnapshotStore. a single widget is fetched with a ranged get when the
+    # snapshot is uncompressed; scans stream the snapshot line by line
+    def __init__(self, s3Client, bucket):
+        self.s3Client = s3Client
+        self.bucket = bucket
+
+    def GetIndex(self, owner):
+        try:
+            response = self.s3Client.get_object(Bucket=self.bucket, Key=GetIndexKey(owner))
+        except Exception as e:
+            if IsMissing(e):
+                return None
+            raise
+        return Loads(response["Body"].read())
+
+    def ListOwners(self):
+        owners = []
+        kwargs = {"Bucket": self.bucket, "Prefix": SNAPSHOT_PREFIX, "Delimiter": "/"}
+        while True:
+            response = self.s3Client.list_objects_v2(**kwargs)
+            owners.extend(prefix["Prefix"][len(SNAPSHOT_PREFIX):-1] for prefix in response.get("CommonPrefixes", []))
+            if not response.get("IsTruncated"):
+                return owners
+            kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+    def GetWidget(self, owner, widgetId, index=None):
+        index = index or self.GetIndex(owner)
+        location = index["widgets"].get(widgetId) if index else None
+        if location is None:
+            return None
+        offset, length = location
+        if index["compressed"]:
+            response = self.s3Client.get_object(Bucket=self.bucket, Key=index["snapshot"])
+            # parsed through a view of the decompressed snapshot rather than a copy of the widget's line
+            return Loads(memoryview(gzip.decompress(response["Body"].read()))[offset:offset + length])
+        response = self.s3Client.get_object(Bucket=self.bucket, Key=index["snapshot"], Range=f"bytes={offset}-{offset + length - 1}")
+        return Loads(response["Body"].read())
+
+    def ScanOwner(self, owner, index=None):
+        index = index or self.GetIndex(owner)
+        if not index or not index["widgets"]:
+            return
+        body = self.s3Client.get_object(Bucket=self.bucket, Key=index["snapshot"])["Body"]
+        try:
+            lines = gzip.GzipFile(fileobj=body) if index["compressed"] else body.iter_lines()
+            for line in lines:
+                if line.strip():
+                    yield Loads(line)
+        finally:
+            body.close()
+
+class S3SnapshotStore(WidgetStore):
+    # keeps each owner's widgets in memory and periodically rewrites one snapshot per changed owner, instead of one
+    # object per widget. writes are deferred: onComplete runs only once a snapshot holding the change has landed, so a
+    # message is never acknowledged before its widget is in s3. with interval 0 every Put/Delete flushes right away.
+    # the store must be the only writer for its bucket, since each flush rewrites an owner's snapshot as a whole
+    name = "S3 snapshots"
+    deferred = True
+
+    def __init__(self, s3Client, bucket, interval=30, compress=False):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        self.interval = interval
+        self.compress = compress
+        self.reader = SnapshotReader(s3Client, bucket)
+        self.owners = {}  # owner prefix -> {"widgets": {widgetId: widget}, "generation": n, "snapshots": [keys]}
+        self.widgetOwners = {}  # widgetId -> owner prefix, to resolve deletes that carry no owner
+        self.dirty = {}  # owner prefix -> callbacks waiting for its next snapshot
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.allIndexesLoaded = False
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _Owner(self, ownerPrefix):
+        # called with the lock held; loads the owner's current snapshot the first time it is touched
+        state = self.owners.get(ownerPrefix)
+        if state is None:
+            index = self.reader.GetIndex(ownerPrefix)
+            widgets = {widget["widgetId"]: widget for widget in self.reader.ScanOwner(ownerPrefix, index)} if index else {}
+            state = self.owners[ownerPrefix] = {
+                "widgets": widgets,
+                "generation": index["generation"] if index else 0,
+                "snapshots": [index["snapshot"]] if index else [],
+            }
+            for widgetId in widgets:
+                self.widgetOwners[widgetId] = ownerPrefix
+        return state
+
+    def _FindOwner(self, widgetId):
+        # called with the lock held; reads every owner's index once if the widget has not been seen yet
+        if widgetId not in self.widgetOwners and not self.allIndexesLoaded:
+            for ownerPrefix in self.reader.ListOwners():
+                index = self.reader.GetIndex(ownerPrefix)
+                for knownId in (index or {}).get("widgets", {}):
+                    self.widgetOwners.setdefault(knownId, ownerPrefix)
+            self.allIndexesLoaded = True
+        return self.widgetOwners.get(widgetId)
+
+    def _Remove(self, widgetId, ownerPrefix, touched):
+        state = self._Owner(ownerPrefix)
+        if state["widgets"].pop(widgetId, None) is not None:
+            touched.add(ownerPrefix)
+        if self.widgetOwners.get(widgetId) == ownerPrefix:
+            del self.widgetOwners[widgetId]
+
+    def _Wait(self, touched, onComplete):
+        # called with the lock held; onComplete runs once every touched owner's snapshot has landed. returns True when
+        # nothing changed, in which case the caller runs onComplete itself once the lock is released
+        for ownerPrefix in touched:
+            self.dirty.setdefault(ownerPrefix, [])
+        if not touched:
+            return True
+        if not onComplete:
+            return False
+        remaining = [len(touched)]
+        def Landed():
+            with self.lock:
+                remaining[0] -= 1
+                done = remaining[0] == 0
+            if done:
+                onComplete()
+        for ownerPrefix in touched:
+            self.dirty[ownerPrefix].append(Landed)
+        return False
+
+    def Put(self, widgets, onComplete=None):
+        with self.lock:
+            touched = set()
+            for widget in widgets:
+                ownerPrefix = GetOwnerPrefix(widget["owner"])
+                previousOwner = self.widgetOwners.get(widget["widgetId"])
+                if previousOwner and previousOwner != ownerPrefix:
+                    self._Remove(widget["widgetId"], previousOwner, touched)
+                self._Owner(ownerPrefix)["widgets"][widget["widgetId"]] = widget
+                self.widgetOwners[widget["widgetId"]] = ownerPrefix
+                touched.add(ownerPrefix)
+            unchanged = self._Wait(touched, onComplete)
+        if unchanged and onComplete:
+            onComplete()
+        if self.interval <= 0:
+            self.Flush()
+
+    def Delete(self, requests, onComplete=None):
+        with self.lock:
+            touched = set()
+            for request in requests:
+                widgetId = request["widgetId"]
+                ownerPrefix = self.widgetOwners.get(widgetId)
+                if ownerPrefix is None and request.get("owner"):
+                    ownerPrefix = GetOwnerPrefix(request["owner"])
+                    self._Owner(ownerPrefix)
+                    ownerPrefix = self.widgetOwners.get(widgetId)
+                if ownerPrefix is None:
+                    ownerPrefix = self._FindOwner(widgetId)
+                if ownerPrefix is None:
+                    logging.warning(f"Widget with ID {widgetId} is not in any snapshot; nothing to delete")
+                    continue
+                self._Remove(widgetId, ownerPrefix, touched)
+            unchanged = self._Wait(touched, onComplete)
+        if unchanged and onComplete:
+            onComplete()
+        if self.interval <= 0:
+            self.Flush()
+
+    def Get(self, owner, widgetId):
+        with self.lock:
+            return self._Owner(GetOwnerPrefix(owner))["widgets"].get(widgetId)
+
+    def Pending(self):
+        with self.lock:
+            return len(self.dirty)
+
+    def Flush(self):
+        with self.flushLock:
+            with self.lock:
+                work = [(ownerPrefix, list(self.owners[ownerPrefix]["widgets"].values()), callbacks) for ownerPrefix, callbacks in self.dirty.items()]
+                self.dirty = {}
+            for ownerPrefix, widgets, callbacks in work:
+                try:
+                    self._WriteSnapshot(ownerPrefix, widgets)
+                except Exception as e:
+                    # keep the owner dirty; its callbacks wait for the next successful flush
+                    logging.error(f"Error writing the snapshot for {ownerPrefix}: {e}")
+                    with self.lock:
+                        self.dirty[ownerPrefix] = callbacks + self.dirty.get(ownerPrefix, [])
+                    continue
+                for callback in callbacks:
+                    callback()
+
+    def _WriteSnapshot(self, ownerPrefix, widgets):
+        lines, locations, offset = [], {}, 0
+        for widget in widgets:
+            line = Dumps(widget)
+            locations[widget["widgetId"]] = [offset, len(line)]
+            lines.append(line)
+            offset += len(line) + 1
+        data = b"\n".join(lines) + (b"\n" if lines else b"")
+        if self.compress:
+            data = gzip.compress(data)
+        with self.lock:
+            state = self.owners[ownerPrefix]
+            generation = state["generation"] + 1
+        snapshotKey = GetSnapshotKey(ownerPrefix, generation, self.compress)
+        self.s3Client.put_object(Bucket=self.bucket, Key=snapshotKey, Body=data,
+                                 ContentType="application/x-ndjson", **({"ContentEncoding": "gzip"} if self.compress else {}))
+        # the index is written after the snapshot it points at, so a reader never sees an index without its snapshot
+        index = {"owner": ownerPrefix, "generation": generation, "snapshot": snapshotKey, "compressed": self.compress,
+                 "count": len(locations), "widgets": locations}
+        self.s3Client.put_object(Bucket=self.bucket, Key=GetIndexKey(ownerPrefix), Body=Dumps(index), ContentType="application/json")
+        with self.lock:
+            state["generation"] = generation
+            state["snapshots"].append(snapshotKey)
+            expired = state["snapshots"][:-KEPT_SNAPSHOTS]
+            state["snapshots"] = state["snapshots"][-KEPT_SNAPSHOTS:]
+        for key in expired:
+            try:
+                self.s3Client.delete_object(Bucket=self.bucket, Key=key)
+            except Exception as e:
+                logging.warning(f"Error deleting the old snapshot {key}: {e}")
+        logging.info(f"Wrote snapshot generation {generation} for {ownerPrefix} with {len(locations)} widgets")
+
+    def _Run(self):
+        while not self.stopped.wait(self.interval):
+            self.Flush()
+
+    def Start(self):
+        if self.interval > 0:
+            self.thread = threading.Thread(target=self._Run, name="snapshot-writer", daemon=True)
+            self.thread.start()
+        return self
+
+    def Stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        self.Flush()
+
+    def Close(self):
+        self.Stop()
@@ -0,0 +1,315 @@
+import os
+import re
+import json
+import logging
+import math
+import fnmatch
+import hashlib
+import tempfile
+import threading
+from decimal import Decimal
+from urllib.parse import quote
+from dynamowriter import DynamoBatchWriter
+from digests import WidgetDigest
+from codec import Dumps, RawBody
+from deadletter import PermanentError
+
+# ---- DYNAMODB ATTRIBUTES ----
+# strings that look like numbers; IsDynamoNumber also checks the range, and anything else under a numeric attribute is
+# stored as a string
+NUMBER_PATTERN = re.compile(r'-?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?\Z')
+# the widget's partition key; an attribute of the same name would replace it
+KEY_ATTRIBUTE = "id"
+# per-key decisions are cached, but attribute names come from producers, so the cache is cleared past this size
+MAX_CACHED_KEYS = 10000
+
+def IsDynamoNumber(value):
+    # dynamodb numbers have at most 38 significant digits and a magnitude between 1e-130 and 1e126
+    if NUMBER_PATTERN.match(value) is None:
+        return False
+    number = Decimal(value)
+    if not number:
+        return True
+    digits = "".join(map(str, number.as_tuple().digits)).strip("0")
+    return len(digits) <= 38 and -130 <= number.adjusted() <= 125
+
+class DynamoMarshaller:
+    # turns widgets into dynamodb items in a single pass over each value, dispatching on the exact type first.
+    # string attributes whose names match one of numericAttributes (fnmatch patterns such as "price" or "width*") are
+    # stored as N when they look like a number; whether a key matches is decided once and cached
+    def __init__(self, numericAttributes=()):
+        self.numericAttributes = tuple(numericAttributes)
+        self.numericKeys = {}  # key -> True when its numeric-looking strings are stored as N
+        self.encoders = {
+            str: lambda value: {"S": value},
+            bool: lambda value: {"BOOL": value},
+            int: lambda value: {"N": str(value)},
+            float: self._MarshalFloat,
+            Decimal: self._MarshalFloat,
+            type(None): lambda value: {"NULL": True},
+            list: lambda value: {"L": [self.Marshal(item) for item in value]},
+            tuple: lambda value: {"L": [self.Marshal(item) for item in value]},
+            dict: lambda value: {"M": {str(key): self.Marshal(item) for key, item in value.items()}},
+        }
+
+    def _MarshalFloat(self, value):
+        if not math.isfinite(value):
+            raise ValueError(f"DynamoDB cannot store the number {value}")
+        return {"N": str(value)}
+
+    def Marshal(self, value):
+        encoder = self.encoders.get(type(value))
+        if encoder:
+            return encoder(value)
+        # subclasses (e.g. an IntEnum) fall back to the first matching base type
+        for baseType, encoder in self.encoders.items():
+            if isinstance(value, baseType):
+                return encoder(value)
+        raise TypeError(f"DynamoDB cannot store a value of type {type(value).__name__}")
+
+    def IsNumericKey(self, key):
+        numeric = self.numericKeys.get(key)
+        if numeric is None:
+            if len(self.numericKeys) >= MAX_CACHED_KEYS:
+                self.numericKeys.clear()
+            numeric = self.numericKeys[key] = any(fnmatch.fnmatchcase(key, pattern) for pattern in self.numericAttributes)
+        return numeric
+
+    def MarshalItem(self, widget):
+        item = {}
+        encoders, numericKeys, isNumber = self.encoders, self.numericKeys, IsDynamoNumber
+        hinted = bool(self.numericAttributes)
+        for key, value in widget.items():
+            if type(value) is str:
+                if hinted:
+                    numeric = numericKeys.get(key)
+                    if numeric is None:
+                        numeric = self.IsNumericKey(key)
+                    if numeric and isNumber(value):
+                        item[key] = {"N": value}
+                        continue
+                item[key] = {"S": value}
+                continue
+            encoder = encoders.get(type(value))
+            item[key] = encoder(value) if encoder else self.Marshal(value)
+        # set last, so no attribute can point the write at another widget
+        item[KEY_ATTRIBUTE] = {"S": widget["widgetId"]}
+        return item
+
+# used by GetDynamoItem; replaced by ConfigureMarshaller when numeric attributes are configured
+DYNAMO_MARSHALLER = DynamoMarshaller()
+
+def ConfigureMarshaller(numericAttributes=()):
+    global DYNAMO_MARSHALLER
+    DYNAMO_MARSHALLER = DynamoMarshaller(numericAttributes)
+    return DYNAMO_MARSHALLER
+
+def GetDynamoAttribute(value):
+    return DYNAMO_MARSHALLER.Marshal(value)
+
+def GetDynamoItem(widget):
+    return DYNAMO_MARSHALLER.MarshalItem(widget)
+
+def GetOwnerPrefix(owner):
+    return owner.replace(" ", "-").lower()
+
+# where stores that check digests keep them: s3 object metadata, and an attribute of the dynamodb item
+DIGEST_METADATA_KEY = "content-digest"
+DIGEST_ATTRIBUTE = "contentDigest"
+# names an otherAttribute may not take, since the stores set them themselves
+RESERVED_ATTRIBUTES = frozenset([KEY_ATTRIBUTE, "widgetId", DIGEST_ATTRIBUTE])
+
+# ---- WIDGET STORES ----
+# every store takes lists so callers can hand over a whole batch at once. Put receives widgets with otherAttributes
+# already flattened, and may be given their content digests (in the same order) so stores that keep them do not hash
+# the widgets again; Delete receives the delete requests themselves (widgetId and owner). deferred stores also take an
+# onComplete callback and call it once the change is durable, rather than before Put/Delete returns
+class WidgetStore:
+    name = "store"
+    deferred = False
+
+    def Put(self, widgets, digests=None):
+        raise NotImplementedError
+
+    def Unchanged(self, widget, digest):
+        # whether the stored widget already has this content digest; stores that cannot tell cheaply say no
+        return False
+
+    def Delete(self, requests):
+        raise NotImplementedError
+
+    def Close(self):
+        pass
+
+class S3WidgetStore(WidgetStore):
+    name = "S3"
+
+    def __init__(self, s3Client, bucket, checkDigests=False):
+        self.s3Client = s3Client
+        self.bucket = bucket
+        # with checkDigests, each object carries its content digest in its metadata and Unchanged asks s3 with a HEAD
+        self.checkDigests = checkDigests
+
+    def GetKey(self, widget):
+        return f"widgets/{GetOwnerPrefix(widget['owner'])}/{widget['widgetId']}"
+
+    def GetBody(self, widget):
+        # a widget that is still exactly the request it was decoded from is written as the body it arrived in, with no
+        # second encode; otherwise (such as after otherAttributes were flattened) it is encoded again
+        body = RawBody(widget)
+        return body if body is not None else Dumps(widget)
+
+    def Put(self, widgets, digests=None):
+        # s3 has no batch put, so each widget is its own object
+        for index, widget in enumerate(widgets):
+            extra = {"Metadata": {DIGEST_METADATA_KEY: digests[index] if digests else WidgetDigest(widget)[0]}} if self.checkDigests else {}
+            self.s3Client.put_object(Body=self.GetBody(widget), Bucket=self.bucket, Key=self.GetKey(widget), ContentType='application/json', **extra)
+
+    def Unchanged(self, widget, digest):
+        if not self.checkDigests:
+            return False
+        try:
+            response = self.s3Client.head_object(Bucket=self.bucket, Key=self.GetKey(widget))
+        except Exception as e:
+            if getattr(e, "response", {}).get("Error", {}).get("Code") not in ("404", "NoSuchKey", "NotFound"):
+                logging.warning(f"Error checking widget with ID {widget['widgetId']} in S3: {e}")
+            return False
+        if response.get("Metadata", {}).get(DIGEST_METADATA_KEY) == digest:
+            return True
+        # objects written without the metadata still match when the body is byte for byte the same (a redelivery);
+        # the etag of a single-part upload without kms encryption is the md5 of its body
+        body = self.GetBody(widget)
+        return response.get("ETag", "").strip('"') == hashlib.md5(body.encode("utf-8") if isinstance(body, str) else body).hexdigest()
+
+    def Delete(self, requests):
+        # widgets are written under their owner, so a delete without one cannot be resolved to a key. the rest of the
+        # batch is still deleted before that fails the request, so it is dead-lettered rather than silently dropped
+        missing = []
+        for request in requests:
+            if not request.get("owner"):
+                missing.append(request["widgetId"])
+                continue
+            self.s3Client.delete_object(Bucket=self.bucket, Key=self.GetKey(request))
+        if missing:
+            raise PermanentError(f"Cannot delete widgets with IDs {', '.join(map(str, missing))} from S3 without their owner")
+
+class DynamoDBWidgetStore(WidgetStore):
+    name = "DynamoDB"
+
+    def __init__(self, dynamoClient, tableName, checkDigests=False):
+        self.dynamoClient = dynamoClient
+        self.tableName = tableName
+        self.writer = DynamoBatchWriter(dynamoClient, tableName)
+        # with checkDigests, each item stores its content digest and Unchanged reads it back with a consistent GetItem,
+        # which costs a fraction of the write it can save
+        self.checkDigests = checkDigests
+
+    def GetItem(self, widget, digest=None):
+        item = GetDynamoItem(widget)
+        if self.checkDigests:
+            item[DIGEST_ATTRIBUTE] = {"S": digest or WidgetDigest(widget)[0]}
+        return item
+
+    def Put(self, widgets, digests=None):
+        if len(widgets) == 1:
+            self.dynamoClient.put_item(TableName=self.tableName, Item=self.GetItem(widgets[0], digests[0] if digests else None))
+            return
+        landed = []
+        for index, widget in enumerate(widgets):
+            self.writer.Put(self.GetItem(widget, digests[index] if digests else None), lambda: landed.append(True))
+        self.writer.Flush()
+        if len(landed) < len(widgets):
+            raise RuntimeError(f"{len(widgets) - len(landed)} widgets were not written to DynamoDB")
+
+    def Unchanged(self, widget, digest):
+        if not self.checkDigests:
+            return False
+        try:
+            response = self.dynamoClient.get_item(TableName=self.tableName, Key={"id": {"S": widget["widgetId"]}}, ConsistentRead=True,
+                                                  ProjectionExpression="#digest", ExpressionAttributeNames={"#digest": DIGEST_ATTRIBUTE})
+        except Exception as e:
+            logging.warning(f"Error checking widget with ID {widget['widgetId']} in DynamoDB: {e}")
+            return False
+        return response.get("Item", {}).get(DIGEST_ATTRIBUTE, {}).get("S") == digest
+
+    def Delete(self, requests):
+        if len(requests) == 1:
+            self.dynamoClient.delete_item(TableName=self.tableName, Key={"id": {"S": requests[0]["widgetId"]}})
+            return
+        landed = []
+        for request in requests:
+            self.writer.Delete(request["widgetId"], lambda: landed.append(True))
+        self.writer.Flush()
+        if len(landed) < len(requests):
+            raise RuntimeError(f"{len(requests) - len(landed)} widgets were not deleted from DynamoDB")
+
+class MemoryWidgetStore(WidgetStore):
+    # keeps widgets in a dict; used to load-test the pipeline without any aws round trips
+    name = "memory"
+
+    def __init__(self):
+        self.widgets = {}
+        self.lock = threading.Lock()
+
+    def Put(self, widgets, digests=None):
+        with self.lock:
+            for widget in widgets:
+                self.widgets[widget["widgetId"]] = widget
+
+    def Delete(self, requests):
+        with self.lock:
+            for request in requests:
+                self.widgets.pop(request["widgetId"], None)
+
+    def Get(self, widgetId):
+        with self.lock:
+            return self.widgets.get(widgetId)
+
+class LocalWidgetStore(WidgetStore):
+    # writes each widget to {root}/{owner}/{widgetId}.json. files are written to a temporary name in the same directory
+    # and renamed into place, so readers never see a partially written widget
+    name = "local directory"
+
+    def __init__(self, root):
+        self.root = root
+        self.resolvedRoot = os.path.abspath(root)
+        os.makedirs(root, exist_ok=True)
+
+    def GetPath(self, widget):
+        # the owner and id come from producers, so each is quoted into a single path segment (no separators) and the
+        # result must still be under the root (which rules out "." and "..")
+        owner = widget.get("owner")
+        if not isinstance(owner, str) or not owner:
+            raise PermanentError(f"Cannot resolve widget with ID {widget.get('widgetId')} to a file without its owner")
+        path = os.path.join(self.resolvedRoot, quote(GetOwnerPrefix(owner), safe=""), quote(f"{widget['widgetId']}.json", safe=""))
+        if os.path.dirname(os.path.dirname(os.path.normpath(path))) != self.resolvedRoot:
+            raise PermanentError(f"Owner {owner!r} of widget with ID {widget.get('widgetId')} does not name a directory under {self.root}")
+        return path
+
+    def Put(self, widgets, digests=None):
+        for widget in widgets:
+            path = self.GetPath(widget)
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fileDescriptor, tempPath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fileDescriptor, "w") as file:
+                    json.dump(widget, file)
+                os.replace(tempPath, path)
+            except BaseException:
+                os.unlink(tempPath)
+                raise
+
+    def Delete(self, requests):
+        for request in requests:
+            try:
+                os.remove(self.GetPath(request))
+            except FileNotFoundError:
+                pass
+
+    def Get(self, owner, widgetId):
+        try:
+            with open(self.GetPath({"owner": owner, "widgetId": widgetId})) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
@@ -0,0 +1,86 @@
+import zlib
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+class ProcessSupervisor:
+    # runs target(index, workQueue, *args) in numProcesses worker processes and routes work to them by key, so all work
+    # for one key (widgetId) goes to the same process in order. workers that crash are restarted and pick up their
+    # queue where it was left; Stop() lets every worker drain its queue before exiting
+    def __init__(self, numProcesses, target, args=(), queueSize=100, checkInterval=1.0):
+        if numProcesses < 1:
+            raise ValueError("numProcesses must be at least 1")
+        # spawn instead of fork: boto3 clients and the threads they own are not safe to carry across a fork
+        self.context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.args = args
+        self.queues = [self.context.Queue(maxsize=queueSize) for _ in range(numProcesses)]
+        self.processes = [None] * numProcesses
+        self.checkInterval = checkInterval
+        self.restarts = 0
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.monitor = None
+
+    def _StartWorker(self, index):
+        process = self.context.Process(target=self.target, args=(index, self.queues[index]) + tuple(self.args), name=f"widget-process-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def Start(self):
+        for index in range(len(self.processes)):
+            self._StartWorker(index)
+        self.monitor = threading.Thread(target=self._Monitor, name="process-monitor", daemon=True)
+        self.monitor.start()
+        return self
+
+    def CheckWorkers(self):
+        with self.lock:
+            if self.stopping.is_set():
+                return
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    logging.error(f"Worker process {index} exited with code {process.exitcode}; restarting it")
+                    self.restarts += 1
+                    self._StartWorker(index)
+
+    def _Monitor(self):
+        while not self.stopping.wait(self.checkInterval):
+            self.CheckWorkers()
+
+    def Route(self, key):
+        return zlib.crc32(key.encode('utf-8')) % len(self.queues)
+
+    def Submit(self, key, item):
+        # blocks while the worker's queue is full, which holds back the receive loop
+        self.queues[self.Route(key)].put(item)
+
+    def Stop(self, timeout=None):
+        # a None sentinel is queued behind the remaining work, so each worker drains its queue and then exits. workers
+        # are no longer restarted once stopping, so a dead worker's full queue would never make room for the sentinel;
+        # the put is retried only while its worker is alive, and the messages a dead worker held are redelivered by sqs
+        with self.lock:
+            self.stopping.set()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for index, workQueue in enumerate(self.queues):
+            while True:
+                if not self.processes[index].is_alive():
+                    logging.error(f"Worker process {index} is not running; its queued work is left for redelivery")
+                    break
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                try:
+                    workQueue.put(None, timeout=self.checkInterval)
+                    break
+                except queue.Full:
+                    pass
+        for index, process in enumerate(self.processes):
+            process.join(None if deadline is None else max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.error(f"Worker process {index} did not finish draining; terminating it")
+                process.terminate()
+                process.join()
+        if self.monitor:
+            self.monitor.join()
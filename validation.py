@@ -0,0 +1,77 @@
+import re
+
+# one definition of a valid id for every component: a canonical 8-4-4-4-12 hex uuid in either case
+UUID_PATTERN = re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}\Z')
+REQUEST_TYPES = frozenset(["create", "update", "delete"])
+
+# every request sent to the lambda must carry all of these
+REQUEST_FIELDS = ("type", "requestId", "widgetId", "owner", "label", "description", "otherAttributes")
+# the consumer only needs enough to route a request, since producers leave the rest out of deletes and partial updates
+ROUTING_FIELDS = ("type", "widgetId")
+# fields the consumer may go without but uses when they are there (the owner picks the s3 key), so they are checked
+# whenever present
+OPTIONAL_ROUTING_FIELDS = ("owner",)
+
+def IsValidId(value):
+    return isinstance(value, str) and UUID_PATTERN.match(value) is not None
+
+def CheckType(value):
+    if not isinstance(value, str) or value.lower() not in REQUEST_TYPES:
+        return "must be one of create, update or delete"
+    return None
+
+def CheckId(value):
+    if not isinstance(value, str) or UUID_PATTERN.match(value) is None:
+        return "must be a UUID"
+    return None
+
+def CheckText(value):
+    if not isinstance(value, str) or not value.strip():
+        return "must be a non-empty string"
+    return None
+
+def CheckAttributes(value):
+    if not isinstance(value, list):
+        return "must be a list"
+    for i, attribute in enumerate(value):
+        if not isinstance(attribute, dict):
+            return f"item {i} must be an object with a name and a value"
+        name, attributeValue = attribute.get("name"), attribute.get("value")
+        if not isinstance(name, str) or not name.strip() or not isinstance(attributeValue, str) or not attributeValue.strip():
+            return f"item {i} must have a non-empty string name and value"
+    return None
+
+# field -> check, where a check returns None for a valid value or a message saying what is wrong with it
+FIELD_CHECKS = {
+    "type": CheckType,
+    "requestId": CheckId,
+    "widgetId": CheckId,
+    "owner": CheckText,
+    "label": CheckText,
+    "description": CheckText,
+    "otherAttributes": CheckAttributes,
+}
+
+def ValidateRequest(request, fields=REQUEST_FIELDS, optional=()):
+    # checks each of the given fields once and returns a list of {"field", "error"} dicts; an empty list means valid.
+    # optional fields are only checked when the request has them
+    if not isinstance(request, dict):
+        return [{"field": None, "error": "request must be a JSON object"}]
+    errors = []
+    for field in fields:
+        if field not in request:
+            errors.append({"field": field, "error": "is required"})
+            continue
+        error = FIELD_CHECKS[field](request[field])
+        if error:
+            errors.append({"field": field, "error": error})
+    for field in optional:
+        if field in request:
+            error = FIELD_CHECKS[field](request[field])
+            if error:
+                errors.append({"field": field, "error": error})
+    return errors
+
+def ValidateRequests(requests, fields=REQUEST_FIELDS, optional=()):
+    # validates a whole batch in one pass; returns one error list per request, in order
+    return [ValidateRequest(request, fields, optional) for request in requests]
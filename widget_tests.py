@@ -2,7 +2,38 @@ import unittest
 from unittest.mock import patch, Mock
 import json
 import os
-from consumer import RetrieveRequestFromS3, RetrieveRequestsFromQueue, ProcessRequest, CreateOrUpdateWidget, DeleteWidget, DeleteFromStorage, DeleteFromQueue, IsValidWidgetId
+import io
+import math
+import queue
+import hashlib
+import tempfile
+import time
+import threading
+from urllib.request import urlopen
+from botocore.response import StreamingBody
+from botocore.exceptions import ClientError
+from consumer import RetrieveRequestFromS3, RetrieveRequestsFromQueue, ProcessRequest, CreateOrUpdateWidget, DeleteWidget, DeleteFromStorage, DeleteFromQueue, IsValidWidgetId, FlattenOtherAttributes, ProcessQueueMessage, DispatchQueueMessages, ExtractWidgetId, GetWidgetStore, ProcessRequestBatch, ReceiveFromQueue, ProcessStorageRequest, RunWorkerProcess, main, ProcessCoalescedRequest
+from replay import Replay
+from coalescer import Coalescer
+from dedup import DedupCache
+from heartbeat import VisibilityHeartbeat
+from scheduler import ReceiveScheduler, ReceiverScaler
+from supervisor import ProcessSupervisor
+from claimcheck import ClaimCheckFetcher, Offload, IsPointer
+from validation import ValidateRequest, ValidateRequests, ROUTING_FIELDS
+from workerpool import KeyedWorkerPool
+from acks import AckBuffer
+from dynamowriter import DynamoBatchWriter
+from s3source import S3RequestSource
+from snapshots import S3SnapshotStore, SnapshotReader
+from deadletter import PermanentError, IsPermanent, LocalDeadLetterSink, RetryQueue
+from digests import WidgetDigest, DigestCache
+from ratelimit import TokenBucket, AdaptiveRateLimiter, IsThrottle
+from storage import S3WidgetStore, MemoryWidgetStore, LocalWidgetStore, DynamoDBWidgetStore, DynamoMarshaller
+from codec import Loads, Dumps, LoadRequest, ConfigureCodec, RawBody
+import clients
+import metrics
+import codec
 from lambda_function import *
 
 # place the folder of sample requests into a list for testing purposes
@@ -21,6 +52,17 @@ def LoadSampleRequests(directory):
 
 SAMPLE_REQUESTS = LoadSampleRequests("sample-requests/")
 
+def RecordingWorker(index, workQueue, path):
+    # worker process target for the supervisor tests: appends each item to a file, and exits hard on "crash"
+    while True:
+        item = workQueue.get()
+        if item is None:
+            return
+        if item == "crash":
+            os._exit(1)
+        with open(path, 'a') as file:
+            file.write(f"{index} {item}\n")
+
 class TestRetrieveRequestFromS3(unittest.TestCase):
 
     @patch('consumer.S3_CLIENT.list_objects_v2')
@@ -68,7 +110,12 @@ class TestProcessRequest(unittest.TestCase):
     def test_process_functions_called_once(self, mock_delete_widget, mock_create_update_widget):
         for request in SAMPLE_REQUESTS:
             with self.subTest(request=request):
-                ProcessRequest(request, 'destination', 's3')  # Call ProcessRequest once per iteration
+                if request['type'] not in ('create', 'update', 'delete'):
+                    # malformed requests are rejected as permanent failures instead of being acknowledged
+                    with self.assertRaises(PermanentError):
+                        ProcessRequest(request, 'destination', 's3')
+                else:
+                    ProcessRequest(request, 'destination', 's3')  # Call ProcessRequest once per iteration
                 
                 # check the number of times CreateOrUpdateWidget was called
                 if request['type'] == 'create' or request['type'] == 'update':
@@ -154,6 +201,1406 @@ class TestDeleteRequest(unittest.TestCase):
         )
 
 
+class TestKeyedWorkerPool(unittest.TestCase):
+
+    def test_same_key_keeps_submission_order(self):
+        pool = KeyedWorkerPool(4)
+        results = {}
+        lock = threading.Lock()
+
+        def record(key, value):
+            with lock:
+                results.setdefault(key, []).append(value)
+
+        for i in range(50):
+            for key in ["widget-a", "widget-b", "widget-c"]:
+                pool.Submit(key, record, key, i)
+        pool.Shutdown()
+
+        for key in ["widget-a", "widget-b", "widget-c"]:
+            self.assertEqual(results[key], list(range(50)))
+
+    def test_submit_blocks_when_saturated(self):
+        pool = KeyedWorkerPool(1, queueSize=1)
+        release = threading.Event()
+        pool.Submit("widget", release.wait)  # occupies the worker
+        pool.Submit("widget", lambda: None)  # fills the queue
+
+        submitted = threading.Event()
+        def submitThird():
+            pool.Submit("widget", lambda: None)
+            submitted.set()
+        thread = threading.Thread(target=submitThird)
+        thread.start()
+
+        # the third submit must wait until the worker frees up
+        self.assertFalse(submitted.wait(0.2))
+        release.set()
+        self.assertTrue(submitted.wait(2))
+        thread.join()
+        pool.Shutdown()
+
+    def test_failing_task_does_not_stop_worker(self):
+        pool = KeyedWorkerPool(1)
+        done = threading.Event()
+        pool.Submit("widget", lambda: 1 / 0)
+        pool.Submit("widget", done.set)
+        pool.Shutdown()
+        self.assertTrue(done.is_set())
+
+    @patch('consumer.DeleteFromQueue')
+    @patch('consumer.ProcessRequest')
+    def test_process_queue_message_acks_after_processing(self, mock_process_request, mock_delete_from_queue):
+        mock_process_request.side_effect = lambda request, destination, storageStrategy, onComplete: onComplete()
+        ProcessQueueMessage(SAMPLE_REQUESTS[0], 'handle', 'destination', 's3', 'queue')
+        mock_process_request.assert_called_once()
+        mock_delete_from_queue.assert_called_once_with('queue', 'handle')
+
+    @patch('consumer.DeleteFromQueue')
+    @patch('consumer.ProcessRequest')
+    def test_process_queue_message_no_ack_on_failure(self, mock_process_request, mock_delete_from_queue):
+        mock_process_request.side_effect = Exception("write failed")
+        ProcessQueueMessage(SAMPLE_REQUESTS[0], 'handle', 'destination', 's3', 'queue')
+        mock_delete_from_queue.assert_not_called()
+
+
+class TestAckBuffer(unittest.TestCase):
+
+    def test_flushes_full_batches(self):
+        sqs = Mock()
+        sqs.delete_message_batch.return_value = {'Successful': [], 'Failed': []}
+        buffer = AckBuffer(sqs, 'queue')
+        for i in range(25):
+            buffer.Add(f"handle-{i}")
+
+        # two full batches of 10 go out immediately, the remaining 5 wait for the deadline
+        self.assertEqual(sqs.delete_message_batch.call_count, 2)
+        self.assertEqual(buffer.Pending(), 5)
+        firstCall = sqs.delete_message_batch.call_args_list[0][1]
+        self.assertEqual(firstCall['QueueUrl'], 'queue')
+        self.assertEqual([entry['ReceiptHandle'] for entry in firstCall['Entries']], [f"handle-{i}" for i in range(10)])
+
+        buffer.Flush()
+        self.assertEqual(sqs.delete_message_batch.call_count, 3)
+        self.assertEqual(buffer.Pending(), 0)
+
+    def test_retries_failed_entries_only(self):
+        sqs = Mock()
+        sqs.delete_message_batch.side_effect = [
+            {'Successful': [{'Id': '0'}], 'Failed': [{'Id': '1', 'SenderFault': False, 'Code': 'InternalError'},
+                                                     {'Id': '2', 'SenderFault': True, 'Code': 'ReceiptHandleIsInvalid'}]},
+            {'Successful': [{'Id': '0'}], 'Failed': []},
+        ]
+        buffer = AckBuffer(sqs, 'queue')
+        for handle in ["a", "b", "c"]:
+            buffer.Add(handle)
+        buffer.Flush()
+        self.assertEqual(buffer.Pending(), 1)
+        buffer.Flush()
+        retryCall = sqs.delete_message_batch.call_args_list[1][1]
+        self.assertEqual([entry['ReceiptHandle'] for entry in retryCall['Entries']], ["b"])
+        self.assertEqual(buffer.Pending(), 0)
+
+    def test_drops_expired_receipt_handles(self):
+        sqs = Mock()
+        sqs.delete_message_batch.return_value = {'Successful': [], 'Failed': []}
+        buffer = AckBuffer(sqs, 'queue', visibilityTimeout=30)
+        buffer.Add("expired", receivedAt=time.monotonic() - 31)
+        buffer.Add("fresh")
+        buffer.Flush()
+        entries = sqs.delete_message_batch.call_args[1]['Entries']
+        self.assertEqual([entry['ReceiptHandle'] for entry in entries], ["fresh"])
+
+    def test_background_flush_on_deadline(self):
+        sqs = Mock()
+        sqs.delete_message_batch.return_value = {'Successful': [{'Id': '0'}], 'Failed': []}
+        buffer = AckBuffer(sqs, 'queue', maxDelay=0.05).Start()
+        buffer.Add("handle")
+        time.sleep(0.3)
+        buffer.Stop()
+        sqs.delete_message_batch.assert_called_once()
+
+    @patch('consumer.DeleteFromQueue')
+    @patch('consumer.ProcessRequest')
+    def test_process_queue_message_uses_ack_buffer(self, mock_process_request, mock_delete_from_queue):
+        buffer = Mock()
+        mock_process_request.side_effect = lambda request, destination, storageStrategy, onComplete: onComplete()
+        ProcessQueueMessage(SAMPLE_REQUESTS[0], 'handle', 'destination', 's3', 'queue', buffer, 12.5)
+        buffer.Add.assert_called_once_with('handle', 12.5)
+        mock_delete_from_queue.assert_not_called()
+
+
+class TestDynamoBatchWriter(unittest.TestCase):
+
+    def item(self, widgetId, label="label"):
+        return {"id": {"S": widgetId}, "label": {"S": label}}
+
+    def test_collapses_writes_for_same_id(self):
+        dynamo = Mock()
+        dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+        writer = DynamoBatchWriter(dynamo, 'table')
+        acks = []
+        writer.Put(self.item("a", "first"), lambda: acks.append(1))
+        writer.Put(self.item("b"), lambda: acks.append(2))
+        writer.Put(self.item("a", "second"), lambda: acks.append(3))
+        writer.Delete("b", lambda: acks.append(4))
+        writer.Flush()
+
+        dynamo.batch_write_item.assert_called_once()
+        writeRequests = dynamo.batch_write_item.call_args[1]['RequestItems']['table']
+        self.assertEqual(writeRequests, [
+            {"PutRequest": {"Item": self.item("a", "second")}},
+            {"DeleteRequest": {"Key": {"id": {"S": "b"}}}},
+        ])
+        # every message is acknowledged once its surviving write has landed
+        self.assertEqual(sorted(acks), [1, 2, 3, 4])
+
+    def test_flushes_at_25_items(self):
+        dynamo = Mock()
+        dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+        writer = DynamoBatchWriter(dynamo, 'table')
+        for i in range(30):
+            writer.Put(self.item(f"widget-{i}"))
+        self.assertEqual(dynamo.batch_write_item.call_count, 1)
+        self.assertEqual(len(dynamo.batch_write_item.call_args[1]['RequestItems']['table']), 25)
+        self.assertEqual(writer.Pending(), 5)
+
+    def test_resubmits_unprocessed_items(self):
+        dynamo = Mock()
+        unprocessed = {"PutRequest": {"Item": self.item("b")}}
+        dynamo.batch_write_item.side_effect = [{'UnprocessedItems': {'table': [unprocessed]}}, {'UnprocessedItems': {}}]
+        writer = DynamoBatchWriter(dynamo, 'table', baseBackoff=0)
+        acks = []
+        writer.Put(self.item("a"), lambda: acks.append("a"))
+        writer.Put(self.item("b"), lambda: acks.append("b"))
+        writer.Flush()
+        self.assertEqual(dynamo.batch_write_item.call_count, 2)
+        self.assertEqual(dynamo.batch_write_item.call_args[1]['RequestItems'], {'table': [unprocessed]})
+        self.assertEqual(sorted(acks), ["a", "b"])
+
+    def test_no_ack_when_write_never_lands(self):
+        dynamo = Mock()
+        dynamo.batch_write_item.side_effect = Exception("throttled")
+        writer = DynamoBatchWriter(dynamo, 'table', maxAttempts=3, baseBackoff=0)
+        acks = []
+        writer.Put(self.item("a"), lambda: acks.append("a"))
+        writer.Flush()
+        self.assertEqual(dynamo.batch_write_item.call_count, 3)
+        self.assertEqual(acks, [])
+
+    @patch('consumer.AcknowledgeMessage')
+    @patch('consumer.ReleaseMessage')
+    def test_dropped_item_releases_its_message(self, mock_release, mock_acknowledge):
+        dynamo = Mock()
+        dropped = {"PutRequest": {"Item": self.item(SAMPLE_REQUESTS[2]['widgetId'])}}
+        dynamo.batch_write_item.return_value = {'UnprocessedItems': {'table': [dropped]}}
+        writer = DynamoBatchWriter(dynamo, 'table', maxAttempts=2, baseBackoff=0)
+        with patch('consumer.DYNAMODB_BATCH_WRITER', writer), patch('consumer.DEAD_LETTER_SINK', None), patch('consumer.RETRY_QUEUE', None):
+            for request, handle in [(SAMPLE_REQUESTS[1], 'h1'), (SAMPLE_REQUESTS[2], 'h2')]:
+                ProcessQueueMessage(dict(request, type="create"), handle, 'destination', 'dynamodb', 'queue')
+            writer.Flush()
+        # the message is handed back (which also stops the heartbeat extending it) instead of staying in flight
+        mock_release.assert_called_once_with('h2')
+        self.assertEqual([call[0][1] for call in mock_acknowledge.call_args_list], ['h1'])
+
+    def test_invalid_item_fails_alone(self):
+        dynamo = Mock()
+        invalid = ClientError({'Error': {'Code': 'ValidationException'}}, 'BatchWriteItem')
+        dynamo.batch_write_item.side_effect = invalid
+        itemError = ClientError({'Error': {'Code': 'ValidationException'}}, 'PutItem')
+        def PutItem(TableName, Item):
+            if Item["id"]["S"] == "bad":
+                raise itemError
+        dynamo.put_item.side_effect = PutItem
+        writer = DynamoBatchWriter(dynamo, 'table', baseBackoff=0)
+        acks, failures = [], []
+        for widgetId in ["a", "b", "bad", "c"]:
+            writer.Put(self.item(widgetId), lambda widgetId=widgetId: acks.append(widgetId),
+                       lambda error, attempts, widgetId=widgetId: failures.append((widgetId, error)))
+        writer.Flush()
+        # the batch is not retried; the good items land one by one and the bad one fails with its own, permanent, error
+        dynamo.batch_write_item.assert_called_once()
+        self.assertEqual(sorted(acks), ["a", "b", "c"])
+        self.assertEqual(failures, [("bad", itemError)])
+        self.assertTrue(IsPermanent(failures[0][1]))
+
+    @patch('consumer.DYNAMODB_CLIENT.put_item')
+    def test_create_widget_uses_batch_writer(self, mock_put_item):
+        writer = Mock()
+        onComplete = Mock()
+        with patch('consumer.DYNAMODB_BATCH_WRITER', writer):
+            CreateOrUpdateWidget(dict(SAMPLE_REQUESTS[0]), 'destination', 'dynamodb', operation="created", onComplete=onComplete)
+        mock_put_item.assert_not_called()
+        writer.Put.assert_called_once()
+        self.assertEqual(writer.Put.call_args[0][0]['id'], {"S": SAMPLE_REQUESTS[0]['widgetId']})
+        # acknowledging is left to the writer
+        onComplete.assert_not_called()
+
+
+class TestS3RequestSource(unittest.TestCase):
+
+    def mockBucket(self, keys, pageSize):
+        s3 = Mock()
+        pages = []
+        for start in range(0, len(keys), pageSize):
+            page = {'Contents': [{'Key': key} for key in keys[start:start + pageSize]], 'IsTruncated': start + pageSize < len(keys)}
+            if page['IsTruncated']:
+                page['NextContinuationToken'] = f"token-{start}"
+            pages.append(page)
+        s3.list_objects_v2.side_effect = pages
+        s3.get_object.side_effect = lambda Bucket, Key: {'Body': Mock(read=lambda: json.dumps({'key': Key}).encode('utf-8'))}
+        return s3
+
+    def test_streams_all_pages_in_key_order(self):
+        keys = [str(1612306368000 + i) for i in range(7)]
+        s3 = self.mockBucket(keys, pageSize=3)
+        source = S3RequestSource(s3, 'bucket', pageSize=3, readAhead=4, fetchWorkers=4)
+        results = list(source.Requests())
+        source.Close()
+
+        self.assertEqual([key for request, key in results], keys)
+        self.assertEqual([request['key'] for request, key in results], keys)
+        self.assertEqual(s3.list_objects_v2.call_count, 3)
+        self.assertEqual(s3.list_objects_v2.call_args_list[1][1]['ContinuationToken'], 'token-0')
+
+    def test_fills_stage_metrics_and_samples_its_logs(self):
+        keys = [str(1612306368000 + i) for i in range(3)]
+        s3 = self.mockBucket(keys, pageSize=1000)
+        s3.delete_objects.return_value = {}
+        stages = metrics.REGISTRY.Histogram("consumer_stage_seconds", "Time spent in each stage of the pipeline", ("stage",))
+        before = {stage: stages.Count(stage) for stage in ["receive", "parse", "ack"]}
+        source = S3RequestSource(s3, 'bucket')
+        metrics.SetRequestLogSampleRate(0)
+        try:
+            with patch('s3source.logging.info') as mockInfo:
+                for request, key in source.Requests():
+                    source.MarkDone(key)
+        finally:
+            metrics.SetRequestLogSampleRate(1.0)
+        mockInfo.assert_not_called()
+        source.Close()
+        self.assertEqual(stages.Count("receive") - before["receive"], 4)  # one listing and three fetches
+        self.assertEqual(stages.Count("parse") - before["parse"], 3)
+        self.assertEqual(stages.Count("ack") - before["ack"], 1)
+
+    def test_lists_after_last_key_on_next_pass(self):
+        s3 = self.mockBucket(['0001', '0002'], pageSize=1000)
+        source = S3RequestSource(s3, 'bucket')
+        list(source.Requests())
+        s3.list_objects_v2.side_effect = [{'KeyCount': 0}]
+        self.assertEqual(list(source.Requests()), [])
+        self.assertEqual(s3.list_objects_v2.call_args[1]['StartAfter'], '0002')
+        source.Close()
+
+    def test_skips_objects_that_fail_to_load(self):
+        s3 = self.mockBucket(['0001', '0002'], pageSize=1000)
+        s3.get_object.side_effect = [Exception("missing"), {'Body': Mock(read=lambda: b'{"ok": true}')}]
+        source = S3RequestSource(s3, 'bucket', fetchWorkers=1)
+        self.assertEqual(list(source.Requests()), [({'ok': True}, '0002')])
+        source.Close()
+
+    def test_lists_failed_keys_again(self):
+        s3 = self.mockBucket(['0001', '0002', '0003'], pageSize=1000)
+        fetch = s3.get_object.side_effect
+        def FlakyFetch(Bucket, Key):
+            if Key == '0001':
+                raise Exception("timeout")
+            return fetch(Bucket, Key)
+        s3.get_object.side_effect = FlakyFetch
+        source = S3RequestSource(s3, 'bucket', fetchWorkers=1, retryDelay=0)
+        self.assertEqual([key for request, key in source.Requests()], ['0002', '0003'])
+        source.MarkDone('0002')
+        # 0003 was released after its processing failed; 0002 is done but not yet deleted, so it is not handed out again
+        source.Release('0003')
+        s3.get_object.side_effect = fetch
+        s3.list_objects_v2.side_effect = [{'Contents': [{'Key': key} for key in ['0001', '0002', '0003']]}]
+        self.assertEqual([key for request, key in source.Requests()], ['0001', '0003'])
+        self.assertNotIn('StartAfter', s3.list_objects_v2.call_args[1])
+        source.Close()
+
+    def test_deletes_processed_keys_in_bulk(self):
+        s3 = Mock()
+        s3.delete_objects.return_value = {'Errors': []}
+        source = S3RequestSource(s3, 'bucket')
+        for i in range(1500):
+            source.MarkDone(str(i))
+        self.assertEqual(s3.delete_objects.call_count, 1)
+        self.assertEqual(len(s3.delete_objects.call_args[1]['Delete']['Objects']), 1000)
+        source.Close()
+        self.assertEqual(s3.delete_objects.call_count, 2)
+        self.assertEqual(len(s3.delete_objects.call_args[1]['Delete']['Objects']), 500)
+
+
+class TestWidgetStores(unittest.TestCase):
+
+    def widget(self, widgetId="8123f304-f23f-440b-a6d3-80e979fa4cd6", owner="Mary Matthews", label="JWJYY"):
+        return {"widgetId": widgetId, "owner": owner, "label": label}
+
+    def test_memory_store(self):
+        store = MemoryWidgetStore()
+        store.Put([self.widget(), self.widget(widgetId="other")])
+        self.assertEqual(store.Get("other")["label"], "JWJYY")
+        store.Delete([{"widgetId": "other", "owner": "Mary Matthews"}])
+        self.assertIsNone(store.Get("other"))
+        self.assertIsNotNone(store.Get(self.widget()["widgetId"]))
+
+    def test_local_store_shards_by_owner(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalWidgetStore(root)
+            store.Put([self.widget()])
+            path = os.path.join(root, "mary-matthews", "8123f304-f23f-440b-a6d3-80e979fa4cd6.json")
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(store.Get("Mary Matthews", "8123f304-f23f-440b-a6d3-80e979fa4cd6"), self.widget())
+
+            # overwriting leaves no temporary files behind
+            store.Put([self.widget(label="NEW")])
+            self.assertEqual(os.listdir(os.path.dirname(path)), [os.path.basename(path)])
+            self.assertEqual(store.Get("Mary Matthews", "8123f304-f23f-440b-a6d3-80e979fa4cd6")["label"], "NEW")
+
+            store.Delete([{"widgetId": "8123f304-f23f-440b-a6d3-80e979fa4cd6", "owner": "Mary Matthews"}])
+            self.assertFalse(os.path.exists(path))
+            store.Delete([{"widgetId": "8123f304-f23f-440b-a6d3-80e979fa4cd6", "owner": "Mary Matthews"}])
+
+    def test_local_store_stays_under_its_root(self):
+        with tempfile.TemporaryDirectory() as root:
+            store = LocalWidgetStore(os.path.join(root, "widgets"))
+            # separators are quoted into the owner's directory name, so this lands under the root
+            store.Put([self.widget(owner="../../etc")])
+            self.assertEqual(os.listdir(os.path.join(root, "widgets")), ["..%2F..%2Fetc"])
+            for owner in ["..", "."]:
+                with self.assertRaises(PermanentError):
+                    store.Put([self.widget(owner=owner)])
+            with self.assertRaises(PermanentError):
+                store.Delete([{"widgetId": "8123f304-f23f-440b-a6d3-80e979fa4cd6", "owner": None}])
+
+    def test_dynamodb_store_batches_multiple_widgets(self):
+        dynamo = Mock()
+        dynamo.batch_write_item.return_value = {'UnprocessedItems': {}}
+        store = DynamoDBWidgetStore(dynamo, 'table')
+        store.Put([self.widget(widgetId=str(i)) for i in range(30)])
+        dynamo.put_item.assert_not_called()
+        self.assertEqual(dynamo.batch_write_item.call_count, 2)
+
+    @patch('consumer.WIDGET_STORES', {})
+    def test_create_and_delete_widget_in_memory(self):
+        request = dict(SAMPLE_REQUESTS[0])
+        CreateOrUpdateWidget(request, 'load-test', 'memory', operation="created")
+        store = GetWidgetStore('memory', 'load-test')
+        self.assertEqual(store.Get(request['widgetId'])['owner'], request['owner'])
+        DeleteWidget(request['widgetId'], 'load-test', 'memory', owner=request['owner'])
+        self.assertIsNone(store.Get(request['widgetId']))
+
+
+class TestReplay(unittest.TestCase):
+
+    def test_replay_jsonl_in_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'requests.jsonl')
+            with open(path, 'w') as file:
+                for request in SAMPLE_REQUESTS:
+                    file.write(json.dumps(request) + "\n")
+                file.write("\n{not json}\n")
+            batches = []
+            report = Replay(path, batches.append, batchSize=10)
+
+        self.assertEqual([request for batch in batches for request in batch], SAMPLE_REQUESTS)
+        self.assertTrue(all(len(batch) <= 10 for batch in batches))
+        self.assertEqual(report['requests'], len(SAMPLE_REQUESTS))
+        self.assertEqual(report['skipped'], 1)
+        self.assertLessEqual(report['p50LatencyMs'], report['p99LatencyMs'])
+
+    def test_replay_directory_in_key_order(self):
+        batches = []
+        report = Replay("sample-requests/", batches.append)
+        self.assertEqual(report['requests'] + report['skipped'], len(os.listdir("sample-requests/")))
+        self.assertEqual(batches[0][0]['requestId'], 'e80fab52-71a5-4a76-8c4d-11b66b83ca2a')
+
+    def test_replay_counts_failed_batches(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'requests.jsonl')
+            with open(path, 'w') as file:
+                file.write(json.dumps(SAMPLE_REQUESTS[0]) + "\n")
+            report = Replay(path, Mock(side_effect=Exception("write failed")))
+        self.assertEqual(report['failed'], 1)
+        self.assertEqual(report['requests'], 0)
+
+    def test_process_request_batch_keeps_write_delete_order(self):
+        store = Mock()
+        widgetId = "8123f304-f23f-440b-a6d3-80e979fa4cd6"
+        otherId = "ad0bb9e1-28e9-46e0-ad08-8192f4d3b6c6"
+        requests = [
+            {"type": "create", "widgetId": widgetId, "owner": "Mary Matthews", "label": "A"},
+            {"type": "update", "widgetId": widgetId, "owner": "Mary Matthews", "label": "B"},
+            {"type": "create", "widgetId": otherId, "owner": "John Jones", "label": "C"},
+            {"type": "delete", "widgetId": widgetId, "owner": "Mary Matthews"},
+            {"type": "create", "widgetId": widgetId, "owner": "Mary Matthews", "label": "D"},
+            {"type": "create", "widgetId": "not-a-uuid", "owner": "Mary Matthews", "label": "E"},
+        ]
+        with patch('consumer.GetWidgetStore', return_value=store):
+            ProcessRequestBatch(requests, 'destination', 'memory')
+
+        calls = [(call[0], [widget.get("label") for widget in call[1][0]]) for call in store.method_calls]
+        self.assertEqual(calls, [("Put", ["B", "C"]), ("Delete", [None]), ("Put", ["D"])])
+
+
+class TestCoalescer(unittest.TestCase):
+
+    def request(self, requestType, widgetId="w1", label=None):
+        return {"type": requestType, "widgetId": widgetId, "label": label}
+
+    def test_keeps_last_state_and_acks_all(self):
+        emitted = []
+        coalescer = Coalescer(60, lambda request, callbacks, releases: emitted.append((request, callbacks)))
+        acks = []
+        coalescer.Add(self.request("update", label="A"), lambda: acks.append(1))
+        coalescer.Add(self.request("update", label="B"), lambda: acks.append(2))
+        coalescer.Add(self.request("update", widgetId="w2", label="C"), lambda: acks.append(3))
+        coalescer.Add(self.request("update", label="D"), lambda: acks.append(4))
+        coalescer.Flush()
+
+        self.assertEqual([request["label"] for request, callbacks in emitted], ["D", "C"])
+        self.assertEqual(acks, [])
+        for request, callbacks in emitted:
+            for callback in callbacks:
+                callback()
+        self.assertEqual(sorted(acks), [1, 2, 3, 4])
+        self.assertEqual(coalescer.received, 4)
+        self.assertEqual(coalescer.emitted, 2)
+
+    def test_create_then_delete_forwards_the_delete(self):
+        # the create may be a redelivery of a widget that already exists, so the delete still has to reach the store
+        emitted = []
+        coalescer = Coalescer(60, lambda request, callbacks, releases: emitted.append((request, callbacks)))
+        acks = []
+        coalescer.Add(self.request("create"), lambda: acks.append(1))
+        coalescer.Add(self.request("update"), lambda: acks.append(2))
+        coalescer.Add(self.request("delete"), lambda: acks.append(3))
+        coalescer.Flush()
+        self.assertEqual([request["type"] for request, callbacks in emitted], ["delete"])
+        self.assertEqual(acks, [])
+        for callback in emitted[0][1]:
+            callback()
+        self.assertEqual(acks, [1, 2, 3])
+
+    def test_delete_of_existing_widget_is_kept(self):
+        emitted = []
+        coalescer = Coalescer(60, lambda request, callbacks, releases: emitted.append(request))
+        coalescer.Add(self.request("update"), Mock())
+        coalescer.Add(self.request("delete"), Mock())
+        coalescer.Flush()
+        self.assertEqual([request["type"] for request in emitted], ["delete"])
+
+    def test_only_due_entries_flush_before_window(self):
+        emitted = []
+        coalescer = Coalescer(60, lambda request, callbacks, releases: emitted.append(request))
+        coalescer.Add(self.request("update"), Mock())
+        coalescer.Flush(force=False)
+        self.assertEqual(emitted, [])
+        self.assertEqual(coalescer.Pending(), 1)
+
+    def test_overflow_emits_oldest(self):
+        emitted = []
+        coalescer = Coalescer(60, lambda request, callbacks, releases: emitted.append(request), maxPending=2)
+        for widgetId in ["w1", "w2", "w3"]:
+            coalescer.Add(self.request("update", widgetId=widgetId), Mock())
+        self.assertEqual([request["widgetId"] for request in emitted], ["w1"])
+
+    def test_overflow_and_flush_emit_one_widget_in_order(self):
+        # the overflow emit is slow, so the flush thread takes the widget's newer entry out while it is still running
+        order, started = [], threading.Event()
+        def Emit(request, callbacks, releases):
+            if request["label"] == "old":
+                started.set()
+                time.sleep(0.1)
+            order.append(request["label"])
+        coalescer = Coalescer(60, Emit, maxPending=1)
+        coalescer.Add(self.request("update", label="old"), Mock())
+        overflow = threading.Thread(target=coalescer.Add, args=(self.request("update", widgetId="w2"), Mock()))
+        overflow.start()
+        started.wait(2)
+        coalescer.Add(self.request("update", label="new"), Mock())
+        coalescer.Flush()
+        overflow.join()
+        self.assertEqual([label for label in order if label], ["old", "new"])
+
+    @patch('consumer.AcknowledgeMessage')
+    @patch('consumer.ReleaseMessage')
+    @patch('consumer.ProcessRequest')
+    def test_failed_coalesced_write_releases_every_message(self, mock_process, mock_release, mock_acknowledge):
+        # with no dead-letter sink, a write that ran out of retries hands its messages back instead of leaving them in flight
+        mock_process.side_effect = ConnectionError("timed out")
+        coalescer = Coalescer(60, lambda request, callbacks, releases: ProcessCoalescedRequest(request, callbacks, 'destination', 'memory', releases))
+        with patch('consumer.DEAD_LETTER_SINK', None), patch('consumer.RETRY_QUEUE', None):
+            DispatchQueueMessages([{'Body': json.dumps(self.request("update", label=label)), 'ReceiptHandle': handle} for label, handle in [("A", "h1"), ("B", "h2")]],
+                                  None, 'destination', 'memory', 'queue', coalescer=coalescer)
+            coalescer.Flush()
+        self.assertEqual([call[0][0] for call in mock_release.call_args_list], ['h1', 'h2'])
+        mock_acknowledge.assert_not_called()
+
+    def test_background_flush(self):
+        emitted = threading.Event()
+        coalescer = Coalescer(0.05, lambda request, callbacks, releases: emitted.set()).Start()
+        coalescer.Add(self.request("update"), Mock())
+        self.assertTrue(emitted.wait(2))
+        coalescer.Stop()
+
+
+class TestDedupCache(unittest.TestCase):
+
+    def request(self, requestId="e80fab52-71a5-4a76-8c4d-11b66b83ca2a", requestType="create"):
+        return {"requestId": requestId, "type": requestType}
+
+    def test_seen_after_add(self):
+        cache = DedupCache()
+        self.assertFalse(cache.Seen(self.request()))
+        cache.Add(self.request())
+        self.assertTrue(cache.Seen(self.request()))
+        # the same requestId with another type is a different request
+        self.assertFalse(cache.Seen(self.request(requestType="delete")))
+        self.assertEqual(cache.Stats(), {"entries": 1, "hits": 1, "misses": 2})
+
+    def test_keys_are_compact(self):
+        self.assertEqual(len(DedupCache.GetKey(self.request())), 17)
+        self.assertIsNone(DedupCache.GetKey({"requestId": "not-a-uuid", "type": "create"}))
+        self.assertFalse(DedupCache().Seen({"type": "create"}))
+
+    def test_evicts_least_recently_used(self):
+        cache = DedupCache(maxEntries=2)
+        first, second, third = [self.request(requestId=f"00000000-0000-4000-8000-00000000000{i}") for i in range(3)]
+        cache.Add(first)
+        cache.Add(second)
+        cache.Seen(first)  # touching first makes second the oldest
+        cache.Add(third)
+        self.assertTrue(cache.Seen(first))
+        self.assertFalse(cache.Seen(second))
+        self.assertTrue(cache.Seen(third))
+
+    def test_entries_expire(self):
+        cache = DedupCache(ttl=10)
+        cache.Add(self.request())
+        with patch('dedup.time.time', return_value=time.time() + 11):
+            self.assertFalse(cache.Seen(self.request()))
+
+    def test_persists_across_restarts(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'dedup.db')
+            cache = DedupCache(path=path)
+            cache.Add(self.request())
+            cache.Close()
+
+            reopened = DedupCache(path=path)
+            self.assertTrue(reopened.Seen(self.request()))
+            reopened.Close()
+
+    @patch('consumer.CreateOrUpdateWidget')
+    def test_process_request_skips_duplicates(self, mock_create_update_widget):
+        mock_create_update_widget.side_effect = lambda request, destination, storageStrategy, operation, onComplete, onFailure=None: onComplete()
+        request = dict(next(request for request in SAMPLE_REQUESTS if request['type'] == 'create'))
+        onComplete = Mock()
+        with patch('consumer.DEDUP_CACHE', DedupCache()):
+            ProcessRequest(request, 'destination', 's3', onComplete=onComplete)
+            ProcessRequest(request, 'destination', 's3', onComplete=onComplete)
+        mock_create_update_widget.assert_called_once()
+        # both deliveries are acknowledged
+        self.assertEqual(onComplete.call_count, 2)
+
+
+class TestVisibilityHeartbeat(unittest.TestCase):
+
+    def test_extends_messages_past_half_their_visibility(self):
+        sqs = Mock()
+        sqs.change_message_visibility_batch.return_value = {'Successful': [], 'Failed': []}
+        heartbeat = VisibilityHeartbeat(sqs, 'queue', visibilityTimeout=30)
+        now = time.monotonic()
+        heartbeat.Track("old", receivedAt=now - 20)
+        heartbeat.Track("new", receivedAt=now)
+        heartbeat.Beat()
+
+        sqs.change_message_visibility_batch.assert_called_once_with(
+            QueueUrl='queue', Entries=[{'Id': '0', 'ReceiptHandle': 'old', 'VisibilityTimeout': 30}]
+        )
+        # freshly extended, so the next beat leaves it alone
+        heartbeat.Beat()
+        self.assertEqual(sqs.change_message_visibility_batch.call_count, 1)
+        self.assertEqual(heartbeat.extended, 1)
+
+    def test_done_messages_are_not_extended(self):
+        sqs = Mock()
+        heartbeat = VisibilityHeartbeat(sqs, 'queue', visibilityTimeout=30)
+        heartbeat.Track("handle", receivedAt=time.monotonic() - 20)
+        heartbeat.Done("handle")
+        heartbeat.Beat()
+        sqs.change_message_visibility_batch.assert_not_called()
+        self.assertEqual(heartbeat.InFlight(), 0)
+
+    def test_failed_extensions_stop_tracking(self):
+        sqs = Mock()
+        sqs.change_message_visibility_batch.return_value = {'Failed': [{'Id': '0', 'Code': 'ReceiptHandleIsInvalid'}]}
+        heartbeat = VisibilityHeartbeat(sqs, 'queue', visibilityTimeout=30)
+        heartbeat.Track("handle", receivedAt=time.monotonic() - 20)
+        heartbeat.Beat()
+        self.assertEqual(heartbeat.InFlight(), 0)
+
+    def test_stops_extending_after_max_age(self):
+        sqs = Mock()
+        heartbeat = VisibilityHeartbeat(sqs, 'queue', visibilityTimeout=30, maxAge=60)
+        heartbeat.Track("handle", receivedAt=time.monotonic() - 61)
+        heartbeat.Beat()
+        sqs.change_message_visibility_batch.assert_not_called()
+        self.assertEqual(heartbeat.InFlight(), 0)
+
+    def test_release_sets_visibility_to_zero(self):
+        sqs = Mock()
+        sqs.change_message_visibility_batch.return_value = {'Successful': [{'Id': '0'}], 'Failed': []}
+        heartbeat = VisibilityHeartbeat(sqs, 'queue')
+        heartbeat.Track("handle")
+        heartbeat.Release(["handle"])
+        sqs.change_message_visibility_batch.assert_called_once_with(
+            QueueUrl='queue', Entries=[{'Id': '0', 'ReceiptHandle': 'handle', 'VisibilityTimeout': 0}]
+        )
+        self.assertEqual(heartbeat.InFlight(), 0)
+        self.assertEqual(heartbeat.released, 1)
+
+    @patch('consumer.ProcessRequest')
+    def test_failed_queue_message_is_released(self, mock_process_request):
+        mock_process_request.side_effect = Exception("write failed")
+        heartbeat = Mock()
+        with patch('consumer.VISIBILITY_HEARTBEAT', heartbeat):
+            ProcessQueueMessage(SAMPLE_REQUESTS[0], 'handle', 'destination', 's3', 'queue')
+        heartbeat.Release.assert_called_once_with(['handle'])
+
+
+class TestReceiveScheduler(unittest.TestCase):
+
+    def test_repolls_immediately_while_receiving(self):
+        scheduler = ReceiveScheduler()
+        self.assertEqual(scheduler.Next(10), 0)
+        self.assertEqual(scheduler.Next(3), 0)
+
+    def test_idle_backoff_grows_and_is_capped(self):
+        rng = Mock()
+        rng.uniform.side_effect = lambda low, high: high
+        scheduler = ReceiveScheduler(baseDelay=0.1, maxDelay=1.0, rng=rng)
+        delays = [scheduler.Next(0) for _ in range(6)]
+        self.assertEqual(delays, [0.1, 0.2, 0.4, 0.8, 1.0, 1.0])
+        # any work resets the backoff
+        scheduler.Next(1)
+        self.assertEqual(scheduler.Next(0), 0.1)
+
+    def test_backoff_is_jittered(self):
+        scheduler = ReceiveScheduler(baseDelay=1.0, maxDelay=1.0)
+        delays = {scheduler.Next(0) for _ in range(20)}
+        self.assertGreater(len(delays), 1)
+        self.assertTrue(all(0 <= delay <= 1.0 for delay in delays))
+
+    def test_only_full_batches_repoll_right_away(self):
+        scheduler = ReceiveScheduler(baseDelay=0.1, batchSize=10, minWait=1, maxWait=20)
+        self.assertEqual(scheduler.WaitTime(), 20)
+        self.assertEqual(scheduler.Next(10), 0)
+        self.assertEqual(scheduler.WaitTime(), 1)
+        # a partial batch pauses for longer the emptier it was, and goes back to long polls
+        self.assertAlmostEqual(scheduler.Next(8), 0.02)
+        self.assertAlmostEqual(scheduler.Next(2), 0.08)
+        self.assertEqual(scheduler.WaitTime(), 20)
+
+    def test_long_poll_counts_towards_the_idle_backoff(self):
+        rng = Mock()
+        rng.uniform.side_effect = lambda low, high: high
+        scheduler = ReceiveScheduler(baseDelay=1.0, maxDelay=5.0, rng=rng, batchSize=10)
+        self.assertEqual(scheduler.Next(0, waited=20.0), 0.0)
+        self.assertEqual(scheduler.Next(0, waited=0.5), 1.5)
+
+    def test_scaler_follows_queue_depth(self):
+        sqs = Mock()
+        scaler = ReceiverScaler(sqs, 'queue', maxReceivers=4, messagesPerReceiver=100)
+        for depth, expected in [("0", 1), ("150", 2), ("10000", 4), ("50", 1)]:
+            sqs.get_queue_attributes.return_value = {'Attributes': {'ApproximateNumberOfMessages': depth}}
+            self.assertEqual(scaler.Poll(), expected)
+        self.assertTrue(scaler.IsActive(0))
+        self.assertFalse(scaler.IsActive(1))
+
+    def test_scaler_keeps_receivers_when_depth_is_unknown(self):
+        sqs = Mock()
+        sqs.get_queue_attributes.side_effect = Exception("throttled")
+        scaler = ReceiverScaler(sqs, 'queue', maxReceivers=4)
+        scaler.active = 3
+        self.assertEqual(scaler.Poll(), 3)
+
+    @patch('consumer.time.sleep')
+    @patch('consumer.RetrieveRequestsFromQueue')
+    def test_receive_from_queue_backs_off_when_empty(self, mock_retrieve, mock_sleep):
+        dispatch = Mock()
+        scheduler = Mock()
+        mock_retrieve.return_value = [{'Body': '{}', 'ReceiptHandle': 'handle'}]
+        scheduler.Next.return_value = 0
+        scheduler.WaitTime.return_value = 1
+        ReceiveFromQueue('queue', dispatch, scheduler)
+        dispatch.assert_called_once()
+        mock_sleep.assert_not_called()
+        self.assertEqual(mock_retrieve.call_args[1]['waitTime'], 1)
+
+        mock_retrieve.return_value = []
+        scheduler.Next.return_value = 0.4
+        ReceiveFromQueue('queue', dispatch, scheduler)
+        self.assertEqual(dispatch.call_count, 1)
+        mock_sleep.assert_called_once_with(0.4)
+
+
+class TestProcessSupervisor(unittest.TestCase):
+    def test_extract_widget_id(self):
+        self.assertEqual(ExtractWidgetId('{"type": "create", "widgetId": "abc-123"}'), "abc-123")
+        self.assertEqual(ExtractWidgetId('{"widgetId":"x"}'), "x")
+        self.assertEqual(ExtractWidgetId('{"widgetId": 7}'), "7")
+        self.assertEqual(ExtractWidgetId('not json'), "")
+
+    def test_route_is_stable(self):
+        supervisor = ProcessSupervisor(4, RecordingWorker)
+        routes = {supervisor.Route(f"widget-{i}") for i in range(50)}
+        self.assertEqual(routes, {0, 1, 2, 3})
+        self.assertEqual(supervisor.Route("widget-1"), supervisor.Route("widget-1"))
+
+    def test_stop_skips_a_dead_worker_with_a_full_queue(self):
+        supervisor = ProcessSupervisor(2, RecordingWorker, queueSize=1, checkInterval=0.05)
+        supervisor.processes = [Mock(is_alive=Mock(return_value=False)), Mock(is_alive=Mock(side_effect=[True, False]))]
+        supervisor.queues = [queue.Queue(maxsize=1), queue.Queue(maxsize=1)]
+        supervisor.queues[0].put("stuck")
+        supervisor.Stop(timeout=1)
+        # the dead worker's queue is left alone; the live one gets its sentinel
+        self.assertEqual(supervisor.queues[0].get_nowait(), "stuck")
+        self.assertIsNone(supervisor.queues[1].get_nowait())
+        for process in supervisor.processes:
+            process.join.assert_called_once()
+
+    def test_keys_stay_ordered_and_crashed_workers_restart(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'out.txt')
+            supervisor = ProcessSupervisor(2, RecordingWorker, (path,), checkInterval=0.05).Start()
+            supervisor.Submit("a", "crash")
+            for i in range(20):
+                supervisor.Submit("a", f"a{i}")
+                supervisor.Submit("b", f"b{i}")
+            deadline = time.monotonic() + 30
+            while supervisor.restarts == 0 and time.monotonic() < deadline:
+                time.sleep(0.05)
+            supervisor.Stop(timeout=30)
+            with open(path) as file:
+                lines = [line.split() for line in file]
+            self.assertEqual(supervisor.restarts, 1)
+            for key in ["a", "b"]:
+                items = [item for _, item in lines if item.startswith(key)]
+                self.assertEqual(items, [f"{key}{i}" for i in range(20)])
+                self.assertEqual({index for index, item in lines if item.startswith(key)}, {str(supervisor.Route(key))})
+
+    @patch('consumer.ConfigureClients')
+    @patch('consumer.signal.signal')
+    @patch('consumer.DispatchQueueMessages')
+    def test_worker_process_keeps_the_receive_time(self, mockDispatch, mockSignal, mockClients):
+        # the ack buffer drops handles by their age, which counts from the supervisor's receive
+        workQueue = queue.Queue()
+        workQueue.put(('body', 'h1', 12.5))
+        workQueue.put(None)
+        with patch('consumer.RETRY_QUEUE', None), patch('consumer.DEAD_LETTER_SINK', None), patch('consumer.DYNAMODB_BATCH_WRITER', None):
+            RunWorkerProcess(0, workQueue, 'destination', 's3', 'queue', maxRetries=0)
+        mockDispatch.assert_called_once_with([{'Body': 'body', 'ReceiptHandle': 'h1'}], 12.5, 'destination', 's3', 'queue', None, None)
+
+    @patch('consumer.ConfigureClients')
+    @patch('consumer.RunSupervisor')
+    def test_processes_reject_options_they_would_ignore(self, mockSupervisor, mockClients):
+        for options in [{"heartbeat": True}, {"coalesceWindow": 1}, {"dedupCacheSize": 100}]:
+            with self.subTest(**options):
+                with self.assertRaises(ValueError):
+                    main(None, 'destination', 's3', 'queue', processes=2, **options)
+        mockSupervisor.assert_not_called()
+
+class TestDynamoMarshaller(unittest.TestCase):
+    def test_marshals_every_json_type(self):
+        marshaller = DynamoMarshaller()
+        self.assertEqual(marshaller.Marshal(True), {"BOOL": True})
+        self.assertEqual(marshaller.Marshal(None), {"NULL": True})
+        self.assertEqual(marshaller.Marshal(3), {"N": "3"})
+        self.assertEqual(marshaller.Marshal([1, "a", {"b": False}]), {"L": [{"N": "1"}, {"S": "a"}, {"M": {"b": {"BOOL": False}}}]})
+        with self.assertRaises(TypeError):
+            marshaller.Marshal(object())
+        with self.assertRaises(ValueError):
+            marshaller.Marshal(float("nan"))
+
+    def test_numeric_hints(self):
+        marshaller = DynamoMarshaller(["price", "width*"])
+        item = marshaller.MarshalItem({"widgetId": "w", "price": "12.50", "width-2": "7", "label": "42", "quantity": "3", "width": "wide"})
+        self.assertEqual(item["id"], {"S": "w"})
+        self.assertEqual(item["price"], {"N": "12.50"})
+        self.assertEqual(item["width-2"], {"N": "7"})
+        self.assertEqual(item["label"], {"S": "42"})
+        self.assertEqual(item["quantity"], {"S": "3"})
+        self.assertEqual(item["width"], {"S": "wide"})
+        self.assertEqual(marshaller.numericKeys, {"widgetId": False, "price": True, "width-2": True, "label": False, "quantity": False, "width": True})
+
+    def test_flatten_other_attributes(self):
+        request = {"widgetId": "w", "owner": "Mary Matthews", "otherAttributes": [{"name": "color", "value": "red"}, {"name": "owner", "value": "someone else"}]}
+        self.assertEqual(FlattenOtherAttributes(request), {"widgetId": "w", "owner": "Mary Matthews", "color": "red"})
+
+    def test_attributes_cannot_replace_the_key(self):
+        request = {"widgetId": "w", "otherAttributes": [{"name": "id", "value": "someone-elses-widget"}, {"name": "contentDigest", "value": "x"}]}
+        self.assertEqual(FlattenOtherAttributes(request), {"widgetId": "w"})
+        # even a widget that reaches the marshaller with an id attribute is written under its own widgetId
+        self.assertEqual(DynamoMarshaller().MarshalItem({"widgetId": "w", "id": "someone-elses-widget"})["id"], {"S": "w"})
+
+    def test_numbers_dynamodb_rejects_stay_strings(self):
+        marshaller = DynamoMarshaller(["price"])
+        for value, stored in [("1" * 38, "N"), ("1" * 39, "S"), ("1" + "0" * 50, "N"), ("1e125", "N"), ("1e999", "S"), ("1e-131", "S"), ("0.000", "N")]:
+            with self.subTest(value=value):
+                self.assertEqual(marshaller.MarshalItem({"widgetId": "w", "price": value})["price"], {stored: value})
+
+class TestClients(unittest.TestCase):
+    def setUp(self):
+        self.session = Mock()
+        for patcher in [patch.dict(clients.CLIENTS, clear=True), patch.dict(clients.CLIENT_SETTINGS), patch('clients.SESSION', self.session)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_client_is_created_once_on_first_use(self):
+        proxy = clients.LazyClient('sqs', 'us-east-1')
+        self.session.client.assert_not_called()
+        threads = [threading.Thread(target=lambda: proxy.send_message(QueueUrl='queue')) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.session.client.assert_called_once()
+        self.assertEqual(self.session.client.call_args[0], ('sqs',))
+        self.assertEqual(self.session.client.return_value.send_message.call_count, 8)
+
+    def test_configure_clients(self):
+        clients.ConfigureClients(maxPoolConnections=50, retryMode='adaptive', readTimeout=None)
+        config = clients.GetClientConfig()
+        self.assertEqual(config.max_pool_connections, 50)
+        self.assertEqual(config.retries, {'mode': 'adaptive', 'max_attempts': 3})
+        self.assertEqual(config.read_timeout, 60)
+        self.assertTrue(config.tcp_keepalive)
+        with self.assertRaises(ValueError):
+            clients.ConfigureClients(poolSize=5)
+
+    def test_lambda_reuses_its_client(self):
+        for _ in range(3):
+            send_to_sqs({"type": "create"}, 'queue')
+        self.session.client.assert_called_once()
+        self.assertEqual(self.session.client.return_value.send_message.call_count, 3)
+
+class TestClaimCheck(unittest.TestCase):
+    def setUp(self):
+        self.objects = {}
+        self.s3 = Mock()
+        self.s3.put_object.side_effect = lambda Bucket, Key, Body, ContentType: self.objects.__setitem__((Bucket, Key), Body)
+        self.s3.get_object.side_effect = lambda Bucket, Key: {'Body': StreamingBody(io.BytesIO(self.objects[(Bucket, Key)]), len(self.objects[(Bucket, Key)])),
+                                                               'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def test_round_trip(self):
+        request = dict(SAMPLE_REQUESTS[0], description="é" * 100000)
+        pointer = json.loads(Offload(self.s3, 'bucket', request, json.dumps(request)))
+        self.assertTrue(IsPointer(pointer))
+        self.assertEqual(pointer['widgetId'], request['widgetId'])
+        self.assertNotIn('description', pointer)
+        fetcher = ClaimCheckFetcher(self.s3, bucket='bucket')
+        self.assertEqual(fetcher.Submit(pointer).result(), request)
+        fetcher.Close()
+
+    def test_spoofed_pointers_are_not_followed(self):
+        self.objects[('private', 'secrets.json')] = json.dumps(SAMPLE_REQUESTS[0]).encode('utf-8')
+        self.objects[('bucket', 'secrets.json')] = json.dumps(SAMPLE_REQUESTS[0]).encode('utf-8')
+        fetcher = ClaimCheckFetcher(self.s3, bucket='bucket')
+        for location in [{"bucket": "private", "key": "claim-checks/secrets.json"}, {"bucket": "bucket", "key": "secrets.json"}]:
+            with self.subTest(**location):
+                with self.assertRaises(ValueError):
+                    fetcher.Fetch({"widgetId": "w", "claimCheck": location})
+        # without a configured bucket no pointer is followed at all
+        with self.assertRaises(ValueError):
+            ClaimCheckFetcher(self.s3).Fetch(json.loads(Offload(self.s3, 'bucket', SAMPLE_REQUESTS[0], json.dumps(SAMPLE_REQUESTS[0]))))
+        self.s3.get_object.assert_not_called()
+        fetcher.Close()
+
+    @patch('lambda_function.GetClient')
+    def test_lambda_rejects_requests_carrying_a_claim_check(self, mock_get_client):
+        spoofed = dict(SAMPLE_REQUESTS[0], claimCheck={"bucket": "private", "key": "secrets.json"})
+        self.assertEqual(lambda_handler(spoofed, None)['statusCode'], 400)
+        self.assertEqual(json.loads(lambda_handler([spoofed], None)['body'])['results'][0]['status'], 'invalid')
+        mock_get_client.return_value.send_message.assert_not_called()
+        mock_get_client.return_value.send_message_batch.assert_not_called()
+
+    @patch('consumer.AcknowledgeMessage')
+    @patch('consumer.ReleaseMessage')
+    @patch('consumer.ProcessQueueMessage')
+    def test_dispatch_resolves_pointers_in_order(self, mock_process, mock_release, mock_acknowledge):
+        inline = SAMPLE_REQUESTS[1]
+        offloaded = dict(SAMPLE_REQUESTS[0], label="offloaded")
+        pointer = Offload(self.s3, 'bucket', offloaded, json.dumps(offloaded))
+        missing = json.dumps({"widgetId": "w", "claimCheck": {"bucket": "bucket", "key": "claim-checks/missing"}})
+        with patch('consumer.CLAIM_CHECK_FETCHER', ClaimCheckFetcher(self.s3, bucket='bucket')):
+            DispatchQueueMessages([{'Body': pointer, 'ReceiptHandle': 'h1'}, {'Body': missing, 'ReceiptHandle': 'h2'}, {'Body': json.dumps(inline), 'ReceiptHandle': 'h3'}],
+                                  None, 'destination', 'memory', 'queue')
+        self.assertEqual([call[0][:2] for call in mock_process.call_args_list], [(offloaded, 'h1'), (inline, 'h3')])
+        # a claim check whose body is gone can never be resolved, so it is not handed back to the queue
+        mock_release.assert_not_called()
+        mock_acknowledge.assert_called_once_with('queue', 'h2', None, None)
+
+    @patch('lambda_function.CLAIM_CHECK_THRESHOLD', 1024)
+    @patch('lambda_function.CLAIM_CHECK_BUCKET', 'claims')
+    @patch('lambda_function.GetClient')
+    def test_lambda_offloads_large_requests(self, mock_get_client):
+        mock_get_client.return_value = self.s3
+        small = dict(SAMPLE_REQUESTS[0], description="small")
+        large = dict(small, description="L" * 2048)
+        send_to_sqs(small, 'queue')
+        send_to_sqs(large, 'queue')
+        bodies = [json.loads(call[1]['MessageBody']) for call in self.s3.send_message.call_args_list]
+        self.assertEqual(bodies[0], small)
+        self.assertEqual(bodies[1]['claimCheck']['bucket'], 'claims')
+        self.assertEqual(self.s3.put_object.call_count, 1)
+
+class SnapshotBucket:
+    # a dict-backed stand-in for the s3 calls the snapshot store makes
+    def __init__(self):
+        self.objects = {}
+        self.ranges = []
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[Key] = Body.encode('utf-8') if isinstance(Body, str) else Body
+
+    def get_object(self, Bucket, Key, Range=None):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        data = self.objects[Key]
+        if Range:
+            self.ranges.append(Range)
+            start, end = map(int, Range[len("bytes="):].split("-"))
+            data = data[start:end + 1]
+        return {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ContentLength': len(data)}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop(Key, None)
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter):
+        prefixes = sorted({Prefix + key[len(Prefix):].split(Delimiter)[0] + Delimiter for key in self.objects if key.startswith(Prefix)})
+        return {'CommonPrefixes': [{'Prefix': prefix} for prefix in prefixes]}
+
+class TestSnapshotStore(unittest.TestCase):
+    def widget(self, widgetId, owner="Mary Matthews", label="JWJYY"):
+        return {"widgetId": widgetId, "owner": owner, "label": label}
+
+    def test_writes_are_acknowledged_once_the_snapshot_lands(self):
+        bucket = SnapshotBucket()
+        store = S3SnapshotStore(bucket, 'bucket', interval=60)
+        done = []
+        store.Put([self.widget("a")], lambda: done.append("a"))
+        store.Put([self.widget("b"), self.widget("c", owner="John Jones")], lambda: done.append("bc"))
+        self.assertEqual(done, [])
+        store.Flush()
+        self.assertEqual(sorted(done), ["a", "bc"])
+        self.assertEqual(sorted(bucket.objects), ["snapshots/john-jones/0000000001.jsonl", "snapshots/john-jones/index.json",
+                                                  "snapshots/mary-matthews/0000000001.jsonl", "snapshots/mary-matthews/index.json"])
+
+        reader = SnapshotReader(bucket, 'bucket')
+        self.assertEqual(reader.GetWidget("Mary Matthews", "b"), self.widget("b"))
+        self.assertEqual(len(bucket.ranges), 1)
+        self.assertEqual([widget["widgetId"] for widget in reader.ScanOwner("Mary Matthews")], ["a", "b"])
+        self.assertEqual(sorted(reader.ListOwners()), ["john-jones", "mary-matthews"])
+
+    def test_deletes_resolve_through_the_index_after_a_restart(self):
+        bucket = SnapshotBucket()
+        store = S3SnapshotStore(bucket, 'bucket', interval=0, compress=True)
+        store.Put([self.widget("a"), self.widget("b")])
+        store.Close()
+
+        restarted = S3SnapshotStore(bucket, 'bucket', interval=0, compress=True)
+        done = []
+        restarted.Delete([{"widgetId": "a", "owner": None}], lambda: done.append(True))
+        self.assertEqual(done, [True])
+        reader = SnapshotReader(bucket, 'bucket')
+        self.assertEqual([widget["widgetId"] for widget in reader.ScanOwner("mary-matthews")], ["b"])
+        self.assertIsNone(reader.GetWidget("Mary Matthews", "a"))
+        self.assertEqual(reader.GetWidget("Mary Matthews", "b"), self.widget("b"))
+        # only the current and previous snapshots are kept
+        self.assertEqual(sorted(key for key in bucket.objects if key.endswith(".gz")),
+                         ["snapshots/mary-matthews/0000000001.jsonl.gz", "snapshots/mary-matthews/0000000002.jsonl.gz"])
+
+    def test_failed_snapshot_keeps_waiting(self):
+        bucket = SnapshotBucket()
+        store = S3SnapshotStore(bucket, 'bucket', interval=60)
+        done = []
+        store.Put([self.widget("a")], lambda: done.append(True))
+        with patch.object(bucket, 'put_object', side_effect=Exception("slow down")):
+            store.Flush()
+        self.assertEqual((done, store.Pending()), ([], 1))
+        store.Flush()
+        self.assertEqual((done, store.Pending()), ([True], 0))
+
+    @patch('consumer.WIDGET_STORES', {})
+    @patch('consumer.SNAPSHOT_INTERVAL', 60)
+    def test_consumer_acknowledges_after_the_snapshot(self):
+        request = dict(SAMPLE_REQUESTS[0])
+        onComplete = Mock()
+        with patch('consumer.S3_CLIENT', SnapshotBucket()):
+            CreateOrUpdateWidget(request, 'bucket', 's3-snapshot', operation="created", onComplete=onComplete)
+            store = GetWidgetStore('s3-snapshot', 'bucket')
+        onComplete.assert_not_called()
+        store.Close()
+        onComplete.assert_called_once()
+
+    def test_s3_store_deletes_under_the_owner(self):
+        s3 = Mock()
+        # the rest of the batch is deleted before the delete without an owner fails
+        with self.assertRaises(PermanentError):
+            S3WidgetStore(s3, 'bucket').Delete([{"widgetId": "a", "owner": "Mary Matthews"}, {"widgetId": "b", "owner": None}])
+        s3.delete_object.assert_called_once_with(Bucket='bucket', Key="widgets/mary-matthews/a")
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+
+    def tearDown(self):
+        metrics.SetRequestLogSampleRate(1.0)
+
+    def test_counter_render(self):
+        counter = self.registry.Counter("test_errors_total", "Errors", ("stage", "exception"))
+        counter.Inc("write", "ValueError")
+        counter.Inc("write", "ValueError", amount=2)
+        self.assertIs(self.registry.Counter("test_errors_total", "Errors", ("stage", "exception")), counter)
+        text = self.registry.Render()
+        self.assertIn("# TYPE test_errors_total counter", text)
+        self.assertIn('test_errors_total{stage="write",exception="ValueError"} 3', text)
+
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = self.registry.Histogram("test_seconds", "Latency", ("stage",), buckets=(0.01, 0.1))
+        for value in (0.005, 0.05, 0.5):
+            histogram.Observe(value, "parse")
+        text = self.registry.Render()
+        self.assertIn('test_seconds_bucket{stage="parse",le="0.01"} 1', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="0.1"} 2', text)
+        self.assertIn('test_seconds_bucket{stage="parse",le="+Inf"} 3', text)
+        self.assertIn('test_seconds_count{stage="parse"} 3', text)
+        count, mean, p99 = histogram.Summary()[("parse",)]
+        self.assertEqual((count, p99), (3, float("inf")))
+        self.assertAlmostEqual(mean, 0.185)
+
+    def test_gauge_function_and_dump(self):
+        gauge = self.registry.Gauge("test_depth", "Queue depth", function=lambda: 7)
+        self.assertEqual(gauge.Samples(), [("test_depth", "", 7)])
+        self.assertIn("test_depth=7", self.registry.Dump())
+
+    def test_server_serves_metrics(self):
+        self.registry.Counter("test_served_total", "Served").Inc()
+        server = metrics.MetricsServer(0, registry=self.registry).Start()
+        try:
+            with urlopen(f"http://127.0.0.1:{server.port}/metrics", timeout=5) as response:
+                body = response.read().decode("utf-8")
+        finally:
+            server.Stop()
+        self.assertIn("test_served_total 1", body)
+
+    def test_request_log_sampling(self):
+        metrics.SetRequestLogSampleRate(0)
+        self.assertFalse(any(metrics.ShouldLogRequest() for _ in range(100)))
+        metrics.SetRequestLogSampleRate(1.0)
+        self.assertTrue(all(metrics.ShouldLogRequest() for _ in range(100)))
+
+    @patch('consumer.SQS_CLIENT.delete_message')
+    @patch('consumer.S3_CLIENT.delete_object')
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_queue_message_records_stages(self, mockPut, mockDeleteObject, mockDelete):
+        stages = metrics.REGISTRY.Histogram("consumer_stage_seconds", "", ("stage",))
+        before = {stage: stages.Count(stage) for stage in ("validate", "write", "ack")}
+        acknowledged = metrics.REGISTRY.Counter("consumer_messages_acknowledged_total", "").Get()
+        ProcessQueueMessage(SAMPLE_REQUESTS[0], 'handle', 'destination', 's3', 'queue')
+        for stage, count in before.items():
+            self.assertEqual(stages.Count(stage), count + 1, stage)
+        self.assertEqual(metrics.REGISTRY.Counter("consumer_messages_acknowledged_total", "").Get(), acknowledged + 1)
+
+class TestDeadLetter(unittest.TestCase):
+
+    def test_classifies_failures(self):
+        self.assertTrue(IsPermanent(PermanentError("invalid")))
+        self.assertTrue(IsPermanent(json.JSONDecodeError("bad", "{", 0)))
+        self.assertTrue(IsPermanent(ClientError({'Error': {'Code': 'ValidationException'}}, 'PutItem')))
+        self.assertFalse(IsPermanent(ClientError({'Error': {'Code': 'ProvisionedThroughputExceededException'}}, 'PutItem')))
+        self.assertFalse(IsPermanent(ConnectionError("reset")))
+        self.assertTrue(IsPermanent(AttributeError("'int' object has no attribute 'replace'")))
+
+    def test_retry_queue_retries_transient_failures_in_order(self):
+        retries = RetryQueue(maxAttempts=3, baseDelay=0.01).Start()
+        calls, failures = [], []
+        outcomes = [ConnectionError("reset"), None]
+        def Flaky():
+            calls.append("first")
+            error = outcomes.pop(0)
+            if error:
+                raise error
+        retries.Run("w1", Flaky, lambda error, attempts: failures.append(error))
+        # queued behind the retry instead of overtaking it
+        retries.Run("w1", lambda: calls.append("second"), lambda error, attempts: failures.append(error))
+        deadline = time.time() + 5
+        while retries.Pending() and time.time() < deadline:
+            time.sleep(0.01)
+        retries.Stop()
+        self.assertEqual(calls, ["first", "first", "second"])
+        self.assertEqual(failures, [])
+
+    def test_retry_queue_gives_up(self):
+        retries = RetryQueue(maxAttempts=3, baseDelay=0.01)
+        failures = []
+        retries.Run("w1", Mock(side_effect=PermanentError("invalid")), lambda error, attempts: failures.append(attempts))
+        retries.Run("w2", Mock(side_effect=ConnectionError("reset")), lambda error, attempts: failures.append(attempts), wait=True)
+        self.assertEqual(failures, [1, 3])
+
+    def test_invalid_queue_message_is_dead_lettered(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "dead-letters.jsonl")
+            raw = json.dumps(dict(SAMPLE_REQUESTS[0], type="bad"))
+            with patch('consumer.DEAD_LETTER_SINK', LocalDeadLetterSink(path)), patch('consumer.AcknowledgeMessage') as mockAcknowledge, \
+                 patch('consumer.ReleaseMessage') as mockRelease:
+                DispatchQueueMessages([{'Body': raw, 'ReceiptHandle': 'h1'}, {'Body': '{not json', 'ReceiptHandle': 'h2'}], None, 'destination', 'memory', 'queue')
+            with open(path) as file:
+                records = [json.loads(line) for line in file]
+        self.assertEqual([(record['stage'], record['body']) for record in records], [("parse", '{not json'), ("process", raw)])
+        self.assertIn("PermanentError", records[1]['reason'])
+        self.assertEqual(mockAcknowledge.call_count, 2)
+        mockRelease.assert_not_called()
+
+    def test_storage_request_stays_in_the_bucket_after_transient_failures(self):
+        onComplete = Mock()
+        with patch('consumer.DEAD_LETTER_SINK', None), patch('consumer.RETRY_QUEUE', RetryQueue(maxAttempts=2, baseDelay=0)), \
+             patch('consumer.S3_CLIENT.put_object', side_effect=ConnectionError("reset")):
+            ProcessStorageRequest(dict(SAMPLE_REQUESTS[1], type="create"), 'destination', 's3', onComplete, wait=True)
+            onComplete.assert_not_called()
+            ProcessStorageRequest(dict(SAMPLE_REQUESTS[1], type="bad"), 'destination', 's3', onComplete, wait=True)
+            onComplete.assert_called_once()
+
+    @patch('consumer.AcknowledgeMessage')
+    @patch('consumer.ReleaseMessage')
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_non_string_owner_is_not_redelivered(self, mockPut, mockRelease, mockAcknowledge):
+        # the consumer does not require an owner, but one that is there has to be usable in a key
+        request = dict(SAMPLE_REQUESTS[1], type="create", owner=123)
+        with patch('consumer.DEAD_LETTER_SINK', None):
+            ProcessQueueMessage(request, 'h1', 'destination', 's3', 'queue')
+        mockPut.assert_not_called()
+        mockRelease.assert_not_called()
+        mockAcknowledge.assert_called_once()
+        self.assertEqual(ValidateRequest(request, ROUTING_FIELDS, ["owner"]), [{"field": "owner", "error": "must be a non-empty string"}])
+
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_write_failure_is_not_acknowledged(self, mockPut):
+        mockPut.side_effect = ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+        onComplete = Mock()
+        with self.assertRaises(ClientError):
+            CreateOrUpdateWidget(dict(SAMPLE_REQUESTS[1]), 'destination', 's3', operation="created", onComplete=onComplete)
+        onComplete.assert_not_called()
+
+class TestWriteSuppression(unittest.TestCase):
+
+    def setUp(self):
+        self.request = dict(SAMPLE_REQUESTS[1], type="create")
+        self.request.pop("otherAttributes", None)
+
+    def test_digest_ignores_request_fields_and_key_order(self):
+        digest, size = WidgetDigest(self.request)
+        resent = dict(reversed(list(self.request.items())), type="update", requestId="another")
+        self.assertEqual(WidgetDigest(resent), (digest, size))
+        self.assertNotEqual(WidgetDigest(dict(self.request, label="changed"))[0], digest)
+
+    def test_only_the_latest_write_is_remembered(self):
+        cache = DigestCache()
+        older = cache.Begin("w")
+        newer = cache.Begin("w")
+        self.assertTrue(cache.Writing("w"))
+        cache.Landed("w", older, "a")
+        self.assertFalse(cache.Unchanged("w", "a"))
+        cache.Landed("w", newer, "b")
+        self.assertTrue(cache.Unchanged("w", "b"))
+        self.assertFalse(cache.Writing("w"))
+
+    @patch('consumer.S3_CLIENT.delete_object')
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_unchanged_writes_are_skipped(self, mockPut, mockDelete):
+        onComplete = Mock()
+        with patch('consumer.DIGEST_CACHE', DigestCache()):
+            CreateOrUpdateWidget(dict(self.request), 'destination', 's3', operation="created", onComplete=onComplete)
+            CreateOrUpdateWidget(dict(self.request, type="update", requestId="resent"), 'destination', 's3', operation="updated", onComplete=onComplete)
+            self.assertEqual(mockPut.call_count, 1)
+            CreateOrUpdateWidget(dict(self.request, label="changed"), 'destination', 's3', operation="updated", onComplete=onComplete)
+            self.assertEqual(mockPut.call_count, 2)
+            # after a delete the same state has to be written again
+            DeleteWidget(self.request["widgetId"], 'destination', 's3', owner=self.request["owner"])
+            CreateOrUpdateWidget(dict(self.request, label="changed"), 'destination', 's3', operation="created", onComplete=onComplete)
+            self.assertEqual(mockPut.call_count, 3)
+        self.assertEqual(onComplete.call_count, 4)
+
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_failed_write_does_not_leave_the_widget_writing(self, mockPut):
+        cache = DigestCache()
+        mockPut.side_effect = ClientError({'Error': {'Code': 'InternalError'}}, 'PutObject')
+        with patch('consumer.DIGEST_CACHE', cache):
+            with self.assertRaises(ClientError):
+                CreateOrUpdateWidget(dict(self.request), 'destination', 's3', operation="created")
+        self.assertFalse(cache.Writing(self.request["widgetId"]))
+        self.assertFalse(cache.Unchanged(self.request["widgetId"], WidgetDigest(self.request)[0]))
+
+    def test_stores_compare_stored_digests(self):
+        digest = WidgetDigest(self.request)[0]
+        s3 = Mock()
+        s3.head_object.return_value = {'Metadata': {'content-digest': digest}, 'ETag': '"0"'}
+        self.assertTrue(S3WidgetStore(s3, 'bucket', checkDigests=True).Unchanged(self.request, digest))
+        s3.head_object.side_effect = ClientError({'Error': {'Code': '404'}}, 'HeadObject')
+        self.assertFalse(S3WidgetStore(s3, 'bucket', checkDigests=True).Unchanged(self.request, digest))
+        dynamo = Mock()
+        dynamo.get_item.return_value = {'Item': {'contentDigest': {'S': digest}}}
+        store = DynamoDBWidgetStore(dynamo, 'table', checkDigests=True)
+        self.assertTrue(store.Unchanged(self.request, digest))
+        self.assertTrue(dynamo.get_item.call_args[1]['ConsistentRead'])
+        store.Put([self.request])
+        self.assertEqual(dynamo.put_item.call_args[1]['Item']['contentDigest'], {'S': digest})
+        # a digest the caller already has is stored as it is
+        with patch('storage.WidgetDigest') as mockDigest:
+            store.Put([self.request], [digest])
+        mockDigest.assert_not_called()
+        self.assertEqual(dynamo.put_item.call_args[1]['Item']['contentDigest'], {'S': digest})
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_bucket_spaces_out_writes(self):
+        clock = FakeClock()
+        bucket = TokenBucket(10, burstSeconds=0.1, clock=clock)
+        self.assertEqual(bucket.Reserve(), 0.0)
+        self.assertAlmostEqual(bucket.Reserve(), 0.1)
+        self.assertAlmostEqual(bucket.Reserve(), 0.2)
+
+    def test_throttles_decrease_once_per_cooldown_then_recover(self):
+        clock = FakeClock()
+        bucket = TokenBucket(100, maxRate=100, decrease=0.5, cooldown=1.0, clock=clock)
+        self.assertEqual(bucket.Throttled(), 50)
+        # the rest of the burst of throttles from the same overshoot
+        self.assertEqual(bucket.Throttled(), 50)
+        for _ in range(200):
+            clock.now += 0.05
+            while bucket.Reserve() == 0.0:
+                pass
+        self.assertGreater(bucket.rate, 50)
+        self.assertLessEqual(bucket.rate, 100)
+
+    def test_unlimited_bucket_starts_from_measured_throughput(self):
+        clock = FakeClock()
+        bucket = TokenBucket(clock=clock, decrease=0.5)
+        for _ in range(400):
+            clock.now += 0.005
+            self.assertEqual(bucket.Reserve(), 0.0)
+        self.assertAlmostEqual(bucket.Throttled(), 100, delta=5)
+
+    def test_throttles_are_attributed_per_strategy(self):
+        throttle = ClientError({'Error': {'Code': 'SlowDown'}}, 'PutObject')
+        self.assertTrue(IsThrottle(throttle))
+        sleeps = []
+        destinationLimiter, ownerLimiter = AdaptiveRateLimiter(sleep=sleeps.append), AdaptiveRateLimiter(sleep=sleeps.append)
+        request = dict(SAMPLE_REQUESTS[1])
+        with patch('consumer.WRITE_LIMITER', destinationLimiter), patch('consumer.OWNER_WRITE_LIMITER', ownerLimiter), \
+             patch('consumer.S3_CLIENT.put_object', side_effect=throttle):
+            with self.assertRaises(ClientError):
+                CreateOrUpdateWidget(request, 'destination', 's3', operation="created")
+        # s3 throttles the owner's key prefix, not the whole bucket
+        ownerKey = ('destination', request['owner'].replace(' ', '-').lower())
+        self.assertIsNotNone(ownerLimiter.Bucket(ownerKey).rate)
+        self.assertIsNone(destinationLimiter.Bucket('destination').rate)
+
+    def test_batch_writer_reports_unprocessed_items(self):
+        dynamo, onThrottle = Mock(), Mock()
+        item = {"id": {"S": "w1"}}
+        dynamo.batch_write_item.side_effect = [{'UnprocessedItems': {'table': [{"PutRequest": {"Item": item}}]}}, {'UnprocessedItems': {}}]
+        writer = DynamoBatchWriter(dynamo, 'table', baseBackoff=0, onThrottle=onThrottle)
+        writer.Put(item)
+        writer.Flush()
+        onThrottle.assert_called_once()
+
+class TestCodec(unittest.TestCase):
+    def setUp(self):
+        self.request = dict(SAMPLE_REQUESTS[1], type="create")
+        self.request.pop("otherAttributes", None)
+        self.body = json.dumps(self.request)
+
+    def tearDown(self):
+        ConfigureCodec("auto")
+
+    def test_decodes_every_buffer_type_with_either_codec(self):
+        data = self.body.encode("utf-8")
+        for name in ["json", "orjson"] if codec.orjson else ["json"]:
+            with self.subTest(codec=name):
+                ConfigureCodec(name)
+                for body in [self.body, data, bytearray(data), memoryview(data)]:
+                    self.assertEqual(Loads(body), self.request)
+                self.assertEqual(json.loads(Dumps(self.request)), self.request)
+
+    def test_falls_back_to_json_for_what_orjson_declines(self):
+        self.assertTrue(math.isnan(Loads(b'{"rating": NaN}')["rating"]))
+        self.assertEqual(json.loads(Dumps({"big": 2 ** 70})), {"big": 2 ** 70})
+        with self.assertRaises(ValueError):
+            Loads(b"not json")
+        with patch('codec.orjson', None):
+            with self.assertRaises(ValueError):
+                ConfigureCodec("orjson")
+            self.assertEqual(ConfigureCodec("auto"), "json")
+
+    def test_request_forgets_its_body_once_flattened(self):
+        request = LoadRequest(self.body)
+        self.assertIs(request.raw, self.body)
+        data = self.body.encode("utf-8")
+        self.assertIs(LoadRequest(memoryview(data)).raw, data)
+        # a view over part of a buffer is not the whole body
+        self.assertIsNone(LoadRequest(memoryview(b" " + data)[1:]).raw)
+        FlattenOtherAttributes(request)
+        self.assertIs(request.raw, self.body)
+        # a request that will be flattened is not copied into a Request at all
+        withAttributes = LoadRequest(json.dumps(dict(self.request, otherAttributes=[{"name": "finish", "value": "matte"}])))
+        self.assertIs(type(withAttributes), dict)
+        FlattenOtherAttributes(withAttributes)
+        self.assertIsNone(RawBody(withAttributes))
+
+    def test_s3_writes_the_body_it_received(self):
+        s3 = Mock()
+        store = S3WidgetStore(s3, 'bucket')
+        store.Put([LoadRequest(self.body)])
+        self.assertIs(s3.put_object.call_args[1]['Body'], self.body)
+        flattened = LoadRequest(json.dumps(dict(self.request, otherAttributes=[{"name": "finish", "value": "matte"}])))
+        store.Put([FlattenOtherAttributes(flattened)])
+        self.assertEqual(json.loads(s3.put_object.call_args[1]['Body']), dict(self.request, finish="matte"))
+        # the etag fallback hashes the body that would be written
+        s3.head_object.return_value = {'Metadata': {}, 'ETag': '"%s"' % hashlib.md5(self.body.encode("utf-8")).hexdigest()}
+        self.assertTrue(S3WidgetStore(s3, 'bucket', checkDigests=True).Unchanged(LoadRequest(self.body), "other"))
+
+    @patch('consumer.AcknowledgeMessage')
+    @patch('consumer.S3_CLIENT.put_object')
+    def test_dispatch_passes_the_message_body_through(self, mockPut, mockAcknowledge):
+        DispatchQueueMessages([{'Body': self.body, 'ReceiptHandle': 'h1'}], None, 'destination', 's3', 'queue')
+        self.assertIs(mockPut.call_args[1]['Body'], self.body)
+        mockAcknowledge.assert_called_once()
+
+    def test_other_stores_do_not_keep_the_body(self):
+        request = LoadRequest(self.body)
+        with patch('consumer.WIDGET_STORES', {}):
+            CreateOrUpdateWidget(request, 'destination', 'memory', operation="created")
+        self.assertIsNone(request.raw)
+
+    def test_claim_check_keeps_the_fetched_buffer(self):
+        s3 = Mock()
+        data = self.body.encode("utf-8")
+        s3.get_object.return_value = {'Body': StreamingBody(io.BytesIO(data), len(data)), 'ContentLength': len(data)}
+        request = ClaimCheckFetcher(s3, bucket="bucket").Fetch({"claimCheck": {"bucket": "bucket", "key": "claim-checks/key"}})
+        self.assertEqual(request, self.request)
+        self.assertEqual(bytes(request.raw), data)
+
 class TestValidation(unittest.TestCase):
 
     def setUp(self):
@@ -227,6 +1674,23 @@ class TestValidation(unittest.TestCase):
         data['otherAttributes'][0]['name'] = ''
         self.assertFalse(validate_request(data))
 
+    def test_validate_request_reports_each_bad_field(self):
+        data = dict(self.valid_data, type='badtype', widgetId='bad')
+        del data['owner']
+        errors = ValidateRequest(data)
+        self.assertEqual([error['field'] for error in errors], ['type', 'widgetId', 'owner'])
+
+    def test_consumer_only_requires_routing_fields(self):
+        data = {"type": "delete", "requestId": "e80fab52-71a5-4a76-8c4d-11b66b83ca2a", "widgetId": "8123F304-F23F-440B-A6D3-80E979FA4CD6"}
+        self.assertEqual(ValidateRequest(data, ROUTING_FIELDS), [])
+        self.assertNotEqual(ValidateRequest(data), [])
+
+    def test_validate_requests_batch(self):
+        results = ValidateRequests([self.valid_data, "not a request", dict(self.valid_data, otherAttributes={})])
+        self.assertEqual(results[0], [])
+        self.assertIsNone(results[1][0]['field'])
+        self.assertEqual(results[2], [{'field': 'otherAttributes', 'error': 'must be a list'}])
+
 
 class TestLambdaHandler(unittest.TestCase):
 
@@ -331,6 +1795,43 @@ class TestLambdaHandler(unittest.TestCase):
         response = lambda_handler(invalid_event, {})
         self.assertEqual(response['statusCode'], 400)
         self.assertIn("Invalid request data", response['body'])
+        self.assertEqual(json.loads(response['body'])['errors'], [{'field': 'type', 'error': 'must be one of create, update or delete'}])
+
+    def batch_request(self, i, size=10):
+        return {"type": "create", "requestId": "e80fab52-71a5-4a76-8c4d-11b66b83ca2a", "widgetId": "8123f304-f23f-440b-a6d3-80e979fa4cd6",
+                "owner": "Mary Matthews", "label": f"L{i}", "description": "D" * size, "otherAttributes": []}
+
+    @patch('lambda_function.GetClient')
+    def test_batch_is_sent_in_groups_of_ten(self, mock_get_client):
+        sqs = mock_get_client.return_value
+        sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {'Successful': [{'Id': entry['Id'], 'MessageId': f"m{entry['Id']}"} for entry in Entries]}
+        requests = [self.batch_request(i) for i in range(25)]
+        requests[3]['widgetId'] = 'bad'
+
+        response = lambda_handler(requests, {})
+        body = json.loads(response['body'])
+        self.assertEqual(response['statusCode'], 207)
+        self.assertEqual((body['queued'], body['failed']), (24, 1))
+        self.assertEqual([len(call[1]['Entries']) for call in sqs.send_message_batch.call_args_list], [10, 10, 4])
+        self.assertEqual(body['results'][3]['status'], 'invalid')
+        self.assertEqual(body['results'][4], {'index': 4, 'status': 'queued', 'messageId': 'm4'})
+
+    @patch('lambda_function.GetClient')
+    def test_batch_stays_under_the_payload_limit(self, mock_get_client):
+        sqs = mock_get_client.return_value
+        sqs.send_message_batch.side_effect = lambda QueueUrl, Entries: {
+            'Successful': [{'Id': entry['Id'], 'MessageId': 'm'} for entry in Entries[1:]],
+            'Failed': [{'Id': Entries[0]['Id'], 'Code': 'InternalError', 'SenderFault': False}]
+        }
+        requests = [self.batch_request(i, 100 * 1024) for i in range(4)] + [self.batch_request(4, 300 * 1024)]
+
+        response = lambda_handler(requests, {})
+        results = json.loads(response['body'])['results']
+        for call in sqs.send_message_batch.call_args_list:
+            self.assertLessEqual(sum(len(entry['MessageBody']) for entry in call[1]['Entries']), 256 * 1024)
+        self.assertEqual(sqs.send_message_batch.call_count, 2)
+        self.assertEqual([result['status'] for result in results], ['failed', 'queued', 'failed', 'queued', 'failed'])
+        self.assertIn('larger than', results[4]['error'])
 
 
 if __name__ == '__main__':
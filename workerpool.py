@@ -0,0 +1,56 @@
+import queue
+import zlib
+import logging
+import threading
+
+# sentinel placed on a worker's queue to tell it to exit
+_STOP = object()
+
+class KeyedWorkerPool:
+    # a bounded pool of worker threads where every task is routed by key; all tasks with the same key (widgetId)
+    # land on the same worker and therefore run in the order they were submitted (create -> update -> delete)
+    def __init__(self, numWorkers, queueSize=20):
+        if numWorkers < 1:
+            raise ValueError("numWorkers must be at least 1")
+        self.queues = [queue.Queue(maxsize=queueSize) for _ in range(numWorkers)]
+        self.threads = []
+        for i, workQueue in enumerate(self.queues):
+            thread = threading.Thread(target=self._Run, args=(workQueue,), name=f"widget-worker-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _Route(self, key):
+        # crc32 instead of hash() so the routing is stable across processes and restarts
+        return zlib.crc32(key.encode('utf-8')) % len(self.queues)
+
+    def Submit(self, key, function, *args, **kwargs):
+        # blocks while the target worker's queue is full, which stops the receive loop from pulling more work (backpressure)
+        self.queues[self._Route(key)].put((function, args, kwargs))
+
+    def InFlight(self):
+        return sum(workQueue.unfinished_tasks for workQueue in self.queues)
+
+    def Join(self):
+        # wait until every submitted task has finished
+        for workQueue in self.queues:
+            workQueue.join()
+
+    def Shutdown(self):
+        self.Join()
+        for workQueue in self.queues:
+            workQueue.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+
+    def _Run(self, workQueue):
+        while True:
+            task = workQueue.get()
+            try:
+                if task is _STOP:
+                    return
+                function, args, kwargs = task
+                function(*args, **kwargs)
+            except Exception as e:
+                logging.error(f"Error in worker task: {e}")
+            finally:
+                workQueue.task_done()